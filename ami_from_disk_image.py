@@ -18,29 +18,107 @@
 from optparse import OptionParser
 import os.path
 import logging
-from aws_utils import EBSHelper, AMIHelper
+import sys
+from aws_utils import EBSHelper, AMIHelper, UtilityPool, PVGRUB_AKIS
+import compress_utils
+import ebs_direct
+import trace_utils
 
 def get_opts():
     usage = """%prog [options] image_file
+       %prog [options] --reap
 
-Create an AMI on EC2 from a bootable disk image."""
+Create an AMI on EC2 from a bootable disk image, or with --reap terminate
+the utility instances earlier --pool runs left running."""
     parser = OptionParser(usage=usage)
     parser.add_option('-r', '--region', default='us-east-1',
         help='set an EC2 region (us-east-1)')
+    parser.add_option('--regions', default='', metavar='REGION,...',
+        help='also copy the snapshot to these regions and register an AMI '
+        'in each of them')
+    parser.add_option('--no-sparse', default=True, action='store_false',
+        dest='sparse', help='upload every block, including holes and zeros')
+    parser.add_option('-w', '--workers', default=None, type='int',
+        help='number of parallel ssh streams to upload over (1), or of '
+        'threads with --direct (%d)' % ebs_direct.THREADS)
+    parser.add_option('--direct', default=False, action='store_true',
+        help='write the image straight into a snapshot with the EBS direct '
+        'APIs instead of through a utility instance')
+    parser.add_option('-c', '--codec', default='gzip',
+        help='compress the upload with none, gzip[-N], pgzip[-N], zstd[-N], '
+        'lz4 or auto (gzip)')
+    parser.add_option('--parent', default=None, metavar='SNAPSHOT',
+        help='only upload the blocks that changed since SNAPSHOT, an earlier '
+        'upload of an image the same size, or "latest" for the newest one')
+    parser.add_option('-p', '--pool', default=0, type='int', metavar='N',
+        help='keep up to N utility instances running for later uploads; '
+        'they keep running (and billing) until an upload or --reap finds '
+        'them idle too long (0)')
+    parser.add_option('--reap', default=False, action='store_true',
+        help='terminate the pooled utility instances in the region that no '
+        'running upload holds, and exit')
+    parser.add_option('--trace', default=None, metavar='FILE',
+        help='append per-phase timings to FILE (see trace_summary.py)')
     opts, args = parser.parse_args()
+    if opts.reap:
+        if args:
+            parser.error('--reap takes no disk image')
+        return opts, None
     if len(args) != 1:
         parser.error('You must provide a disk image file')
     if not os.path.exists(args[0]):
         parser.error('Could not find %s' % args[0])
-    return opts.region, args[0]
+    if opts.direct and opts.pool:
+        parser.error('--direct does not use utility instances')
+    opts.regions = [ r for r in opts.regions.split(',')
+                     if r and r != opts.region ]
+    for region in [ opts.region ] + opts.regions:
+        if region not in PVGRUB_AKIS:
+            parser.error('No pvgrub AKI known for region %s' % region)
+    if opts.codec != 'auto':
+        try:
+            compress_utils.get_codec(opts.codec)
+        except Exception, e:
+            parser.error(str(e))
+    return opts, args[0]
 
 logging.basicConfig(level=logging.DEBUG, format='%(message)s')
 
 if __name__ == '__main__':
-    region, image_file = get_opts()
-    ebs_helper = EBSHelper(region)
-    snapshot = ebs_helper.safe_upload_and_shutdown(image_file)
-    ami_helper = AMIHelper(region)
-    ami = ami_helper.register_ebs_ami(snapshot)
-
-print "Got AMI: %s" % ami
+    opts, image_file = get_opts()
+    if opts.trace:
+        trace_utils.enable(opts.trace)
+    if opts.reap:
+        # An empty pool adopts nothing, so recover() terminates everything
+        # it finds that no live process holds
+        pool = UtilityPool(opts.region, size=0)
+        pool.recover()
+        pool.close()
+        sys.exit(0)
+    ebs_helper = EBSHelper(opts.region)
+    pool = None
+    if opts.pool:
+        # Pick up instances left running by earlier uploads and leave ours
+        # running for the next one. Nothing runs in the background to reap
+        # them: ones idle too long are only terminated by the recover() of
+        # a later upload, or by --reap
+        pool = UtilityPool(opts.region, size=opts.pool)
+        pool.recover()
+    if opts.direct:
+        snapshot = ebs_helper.direct_to_snapshot(image_file,
+            threads=opts.workers or ebs_direct.THREADS, parent=opts.parent)
+    else:
+        snapshot = ebs_helper.safe_upload_and_shutdown(image_file,
+            sparse=opts.sparse, workers=opts.workers or 1, pool=pool,
+            codec=opts.codec, parent=opts.parent)
+    ami_helper = AMIHelper(opts.region)
+    if opts.regions:
+        # The copies run at once, so each region adds no more than the
+        # slowest copy does
+        amis = ami_helper.replicate_ebs_ami(snapshot,
+            [ opts.region ] + opts.regions)
+        for region in [ opts.region ] + opts.regions:
+            print "Got AMI in %s: %s" % (region, amis[region])
+    else:
+        ami = ami_helper.register_ebs_ami(snapshot)
+        print "Got AMI: %s" % ami
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# The tests launch_tests.py runs, expanded from a kickstart matrix (see
+# ks_matrix).
+
+from fnmatch import fnmatch
+
+import ks_matrix
+
+class AnacondaTest(object):
+    """
+    One install to test: a kickstart, the disk size (resources, in GiB) and
+    instance type to run it with and its scheduling priority.
+    """
+
+    def __init__(self, name, ks, resources=ks_matrix.DEFAULT_DISK_SIZE,
+                 inst_type=ks_matrix.DEFAULT_INSTANCE_TYPE, priority=0,
+                 axes=None):
+        self.name = name
+        self.ks = ks
+        self.resources = resources
+        self.inst_type = inst_type
+        self.priority = priority
+        self.axes = axes or {}
+
+    def install_key(self):
+        """
+        Tests with the same key run the same install, see
+        ks_matrix.install_key.
+        """
+        return ks_matrix.install_key(self.ks, self.inst_type, self.resources)
+
+def get_test(name='all', matrix=ks_matrix.MATRIX_FILE, tree=None):
+    """
+    Return the tests of matrix called name, which may be 'all', a shell
+    pattern or several of them separated by commas. tree is the install
+    tree for tests whose axes do not pick one.
+    """
+    patterns = name.split(',')
+    tests = []
+    for test_name, ks, settings in ks_matrix.expand(
+            ks_matrix.load_matrix(matrix), tree):
+        if name == 'all' or [ p for p in patterns if fnmatch(test_name, p) ]:
+            tests.append(AnacondaTest(test_name, ks, settings['disk_size'],
+                settings['instance_type'], settings['priority'],
+                settings['axes']))
+    if not tests:
+        raise Exception("No test in %s matches %s" % (matrix, name))
+    return tests
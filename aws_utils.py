@@ -19,12 +19,25 @@
 import boto.ec2
 import random
 import logging
+import compress_utils
+import console_utils
+import ebs_direct
+import journal_utils
+import lifecycle
+import manifest_utils
 import process_utils
+import upload_utils
+import pipes
+import profile_utils
 import re
 import os.path
+import socket
+import threading
+import trace_utils
+from contextlib import contextmanager
 from boto.exception import EC2ResponseError
 from tempfile import NamedTemporaryFile
-from time import sleep
+from time import sleep, time
 from boto.ec2.blockdevicemapping import EBSBlockDeviceType, BlockDeviceMapping
 
 # Boto is very verbose - shut it up
@@ -52,6 +65,49 @@ PVGRUB_AKIS =  { 'us-east-1':      { 'i386':'aki-b2aa75db' ,'x86_64':'aki-b4aa75
 
 resource_tag = 'anaconda-test'
 
+# EC2 cannot tag key pairs, so the use-once ones start_ami() creates are
+# known by their name
+KEY_PREFIX = 'ebs-helper-tmp-'
+
+# Deletes destroy_all() has in flight at once
+DESTROY_THREADS = 8
+
+# Concurrent copies replicate_ebs_ami() drives
+REPLICATE_THREADS = 8
+
+# Seconds a resource we created may take to show up in describe calls
+# before its absence means it has gone
+VISIBILITY_GRACE = 300
+
+# Seconds between looks at the console of an instance being installed, and
+# those its installer then gets to finish powering off
+CONSOLE_INTERVAL = 10
+POWEROFF_TIMEOUT = 300
+
+# Seconds between fetches of the installer's logs, when there is a command
+# for it, and those one fetch may take before it is given up on
+LOG_INTERVAL = 60
+LOG_TIMEOUT = 30
+
+# Pooled utility instances carry their key pair name in this tag, the time
+# they were last returned to the pool in the idle tag and the host:pid of
+# the process whose pool holds them (idle or leased out) in the owner tag
+POOL_TAG = 'anaconda-utility-pool'
+POOL_IDLE_TAG = 'anaconda-utility-idle-since'
+POOL_OWNER_TAG = 'anaconda-utility-owner'
+POOL_DIR = os.path.expanduser('~/.cache/anaconda-ec2/pool')
+
+# Seed AMIs are tagged with a digest of their boot content so later runs
+# can reuse them, see disk_utils.seed_digest
+SEED_DIGEST_TAG = 'anaconda-seed-digest'
+
+def volume_size(image_size):
+    """
+    Return the size in GiB of a volume to hold image_size bytes.
+    """
+    # Gigabytes, rounded up
+    return int( (image_size/(1024 ** 3)) + 1 )
+
 def safe_call(call, args, log, die=False):
     """
     Safely call an EC2 API and catch an error if something happens.
@@ -70,100 +126,599 @@ def safe_call(call, args, log, die=False):
         raise RuntimeError('safe_call blew up')
     return retval
 
-def wait_for_ec2_instance_state(instance, log, final_state='running', timeout=300):
-    for i in range(timeout):
-        if i % 10 == 0:
-            log.debug(
-                "Waiting for EC2 instance to enter state (%s): %d/%d" %
-                (final_state, i, timeout))
-            request = safe_call(instance.update, [], log)
-            if type(request) == Exception:
-                safe_call(instance.terminate, [], log)
-                break
-        if instance.state == final_state:
-            break
-        sleep(1)
-    if instance.state != final_state:
+# States an instance cannot come back from on its way to the key state
+INSTANCE_FAILURE_STATES = {
+    'running': ('stopping', 'stopped', 'shutting-down', 'terminated'),
+    'stopped': ('shutting-down', 'terminated'),
+    'terminated': () }
+
+class Waiter(object):
+    """
+    Poll until something is done. The first checks come quickly and the gap
+    grows exponentially (with some jitter so parallel waiters spread out) up
+    to max_interval, so short transitions are seen within a second or two
+    and long ones do not hammer the API.
+    """
+
+    def __init__(self, log, initial=1.0, max_interval=15.0, factor=1.5,
+                 jitter=0.2):
+        self.log = log
+        self.initial = initial
+        self.max_interval = max_interval
+        self.factor = factor
+        self.jitter = jitter
+
+    def refresh(self, resource):
+        """
+        Bring resource up to date. Errors are logged by safe_call and the
+        resource is simply checked again on the next pass.
+        """
+        safe_call(resource.update, (), self.log)
+
+    def refresh_many(self, resources):
+        """
+        Bring several resources up to date at once, see LifecycleEngine.
+        """
+        for resource in resources:
+            self.refresh(resource)
+
+    def until(self, predicate, timeout, what):
+        """
+        Call predicate until it returns something true, and return that.
+        Raises an exception once timeout seconds have gone by.
+        """
+        deadline = time() + timeout
+        interval = self.initial
+        while True:
+            result = predicate()
+            if result:
+                return result
+            remaining = deadline - time()
+            if remaining <= 0:
+                raise Exception("Timed out after %d seconds waiting for %s" %
+                    (timeout, what))
+            delay = min(interval, self.max_interval)
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+            sleep(min(delay, remaining))
+            interval *= self.factor
+
+    def until_task(self, check, timeout, what):
+        """
+        Lifecycle task version of until(). check() returns something to
+        yield (a lifecycle.Call, Command or sub-task) rather than the result
+        itself, so the engine is not held up while it runs.
+        """
+        deadline = time() + timeout
+        interval = self.initial
+        while True:
+            result = yield check()
+            if result:
+                raise lifecycle.Return(result)
+            remaining = deadline - time()
+            if remaining <= 0:
+                raise Exception("Timed out after %d seconds waiting for %s" %
+                    (timeout, what))
+            delay = min(interval, self.max_interval)
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+            yield lifecycle.Sleep(min(delay, remaining))
+            interval *= self.factor
+
+    def wait(self, resource, target, timeout=300, failure=(),
+             state=lambda r: r.state, detail=None, what=None):
+        """
+        Refresh resource until state(resource) is target (a state or a tuple
+        of them). Hitting one of the failure states raises at once. detail,
+        if given, adds extra information to the progress messages.
+        """
+        if not isinstance(target, tuple):
+            target = (target,)
+        if not what:
+            what = '%s to become %s' % (resource.id, '/'.join(target))
+        started = time()
+
+        def _check():
+            self.refresh(resource)
+            current = state(resource)
+            if current in failure:
+                raise Exception("%s entered state (%s) while waiting for %s" %
+                    (resource.id, current, '/'.join(target)))
+            if current in target:
+                return True
+            extra = ''
+            if detail:
+                extra = ' - %s' % detail(resource)
+            self.log.debug("Waiting for %s: state (%s)%s [%d of %d seconds]" %
+                (what, current, extra, time() - started, timeout))
+            return False
+
+        self.until(_check, timeout, what)
+
+class DescribePoller(object):
+    """
+    Refresh tracked instances, volumes, snapshots and images for every thread
+    in the process with one describe call per resource type per tick. Waiters
+    ask for a refresh whenever their own backoff says so; requests that come
+    in during a tick are batched into the next one, so API usage depends on
+    the number of resource types rather than the number of waiters.
+    """
+
+    # ID prefix -> (describe call, keyword for the ID list)
+    DESCRIBE = { 'i': ('get_all_instances', 'instance_ids'),
+                 'vol': ('get_all_volumes', 'volume_ids'),
+                 'snap': ('get_all_snapshots', 'snapshot_ids'),
+                 'ami': ('get_all_images', 'image_ids') }
+
+    def __init__(self, conn, log, min_interval=1.0):
+        self.conn = conn
+        self.log = log
+        self.min_interval = min_interval
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.generation = 0
+        self.thread = None
+
+    def refresh(self, resource):
+        """
+        Block until resource has been brought up to date by a batched
+        describe call.
+        """
+        self.refresh_many([ resource ])
+
+    def refresh_many(self, resources):
+        """
+        Like refresh() for a list of resources, which all go into one tick.
+        """
+        self.cond.acquire()
+        try:
+            for resource in resources:
+                self.pending.setdefault(resource.id, []).append(resource)
+            # generation goes up as a tick starts and again as it ends, so
+            # it is odd while one runs. That one does not include us; wait
+            # for the end of the one after it.
+            if self.generation % 2:
+                wanted = self.generation + 3
+            else:
+                wanted = self.generation + 2
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run,
+                    name='describe-poller-%s' % self.conn.region.name)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify_all()
+            while self.generation < wanted:
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+    def _run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.pending:
+                    self.cond.wait()
+                # Anything that started this tick needs the next one
+                self.generation += 1
+                batch = self.pending
+                self.pending = {}
+            finally:
+                self.cond.release()
+            try:
+                self._describe(batch)
+            except Exception, e:
+                self.log.warning('Describe poller failed: %s' % e)
+            self.cond.acquire()
+            try:
+                self.generation += 1
+                self.cond.notify_all()
+            finally:
+                self.cond.release()
+            # Give other waiters a chance to join the next batch
+            sleep(self.min_interval)
+
+    def _describe(self, batch):
+        by_kind = {}
+        for resource_id, resources in batch.items():
+            kind = resource_id.split('-', 1)[0]
+            by_kind.setdefault(kind, {})[resource_id] = resources
+        for kind, resources in by_kind.items():
+            if kind not in self.DESCRIBE:
+                self._update_each(resources)
+                continue
+            call, keyword = self.DESCRIBE[kind]
+            found = safe_call(
+                lambda: getattr(self.conn, call)(**{keyword: resources.keys()}),
+                (), self.log)
+            if found == 'ERROR':
+                # One unknown ID (often a brand new one) fails the whole
+                # batch, so fall back to describing them one at a time
+                self._update_each(resources)
+                continue
+            if kind == 'i':
+                found = [ inst for r in found for inst in r.instances ]
+            for fresh in found:
+                for resource in resources.get(fresh.id, ()):
+                    # boto's _update copies the connection too; keep the
+                    # owner's, or its later calls would be counted as ours
+                    connection = resource.connection
+                    resource._update(fresh)
+                    resource.connection = connection
+
+    def _update_each(self, resources):
+        for resource_list in resources.values():
+            for resource in resource_list:
+                safe_call(resource.update, (), self.log)
+
+_pollers = {}
+_pollers_lock = threading.Lock()
+
+def get_poller(conn, log):
+    """
+    Return the DescribePoller shared by everything talking to conn's region.
+    """
+    _pollers_lock.acquire()
+    try:
+        if conn.region.name not in _pollers:
+            # A connection of its own keeps its describe calls out of the
+            # API call counts of whichever helper came first
+            _pollers[conn.region.name] = DescribePoller(conn.region.connect(),
+                log)
+        return _pollers[conn.region.name]
+    finally:
+        _pollers_lock.release()
+
+class PolledWaiter(Waiter):
+    """
+    A Waiter that refreshes through a shared DescribePoller instead of
+    calling update() on each resource itself.
+    """
+
+    def __init__(self, log, poller, **kwargs):
+        super(PolledWaiter, self).__init__(log, **kwargs)
+        self.poller = poller
+
+    def refresh(self, resource):
+        self.poller.refresh(resource)
+
+    def refresh_many(self, resources):
+        self.poller.refresh_many(resources)
+
+def wait_for_ec2_instance_state(instance, log, final_state='running',
+                                timeout=300, waiter=None):
+    if not waiter:
+        waiter = Waiter(log)
+    try:
+        waiter.wait(instance, final_state, timeout,
+            failure=INSTANCE_FAILURE_STATES.get(final_state, ()))
+    except Exception:
         safe_call(instance.terminate, [], log)
-        raise Exception("Instance failed to start after %d seconds" % timeout)
+        raise
+
+def wait_for_ec2_instance_state_task(instance, log, final_state='running',
+                                     timeout=300, waiter=None):
+    """
+    Lifecycle task version of wait_for_ec2_instance_state().
+    """
+    if not waiter:
+        waiter = Waiter(log)
+    error = None
+    try:
+        yield lifecycle.Wait(waiter, instance, final_state, timeout,
+            failure=INSTANCE_FAILURE_STATES.get(final_state, ()))
+    except Exception, e:
+        error = e
+    if error:
+        yield lifecycle.Call(safe_call, instance.terminate, [], log)
+        raise error
 
 class EC2Helper(object):
 
-    def __init__(self, ec2_region):
+    def __init__(self, ec2_region, conn=None, journal=None):
+        """
+        conn replaces the boto connection to ec2_region, for instance with
+        a fake_ec2.FakeEC2Connection. journal replaces the shared
+        journal_utils.Journal of the resources we create.
+        """
         self.log = logging.getLogger('%s.%s' %
             (__name__, self.__class__.__name__))
         try:
-            self.region = boto.ec2.get_region(ec2_region)
-            self.conn = self.region.connect()
+            if conn:
+                self.region = conn.region
+                self.conn = conn
+            else:
+                self.region = boto.ec2.get_region(ec2_region)
+                self.conn = self.region.connect()
         except Exception as e:
             self.log.error("Exception while attempting to connect to EC2")
             raise
         self.security_group = None
         self.instance = None
+        self.waiter = PolledWaiter(self.log, get_poller(self.conn, self.log))
+        self.run_id = trace_utils.new_run_id()
+        self.api_calls = trace_utils.CallCounter(self.conn)
+        self.journal = journal or journal_utils.get_journal()
+
+    def _created(self, kind, resource_id):
+        """
+        Put a resource we have just created on the journal.
+        """
+        self.journal.record(self.region.name, kind, resource_id, self.run_id)
+
+    def _gone(self, resource_ids):
+        self.journal.set_state(self.region.name, resource_ids,
+            journal_utils.GONE)
+
+    def _keep(self, resource_ids):
+        """
+        Hand finished results over, so they are not taken for what a
+        crashed run left behind.
+        """
+        self.journal.hand_over(self.region.name, resource_ids)
+
+    def _release(self, call, resource_id, args=(), die=False):
+        """
+        safe_call() call, which deletes resource_id, and take it off the
+        journal if that worked.
+        """
+        retval = safe_call(call, args, self.log, die)
+        if retval != 'ERROR':
+            self._gone([ resource_id ])
+        return retval
+
+    def span(self, name, **attrs):
+        """
+        Return a trace_utils.Span for a phase of this helper's work.
+        """
+        return trace_utils.Span(name, self.run_id, self.api_calls,
+            region=self.region.name, **attrs)
 
     def create_sgroup(self, name, allow_vnc=False):
         security_group_desc = "Temporary security group generated by EC2Helper"
         self.log.debug("Creating temporary security group (%s)" % name)
         self.security_group = safe_call(self.conn.create_security_group,
             (name, security_group_desc), self.log, die=True)
+        self._created('security_group', self.security_group.id)
         self.security_group.authorize('tcp', 22, 22, '0.0.0.0/0')
         if allow_vnc:
             self.security_group.authorize('tcp', 5900, 5950, '0.0.0.0/0')
         self.security_group.add_tag('Name', resource_tag)
 
-    def get_our_instances(self):
-        reservations = self.conn.get_all_instances(
-            filters={'tag-value': resource_tag})
-        return [inst for reserve in reservations for inst in reserve.instances]
+    def pick_zone(self):
+        """
+        Return the name of an available zone in the region, for resources
+        that have to end up in the same one.
+        """
+        zones = [ z.name for z in self.conn.get_all_zones()
+                  if z.state == 'available' ]
+        if not zones:
+            raise Exception("No available zones in %s" % self.region.name)
+        return random.choice(zones)
 
-    def get_our_amis(self):
-        return self.conn.get_all_images(filters={'tag-value': resource_tag})
+    def instance_capacity(self, default_limit=20):
+        """
+        Return how many more instances the account may run in this region:
+        its max-instances attribute (or default_limit if that cannot be
+        read) less the instances already running.
+        """
+        limit = default_limit
+        attrs = safe_call(lambda: self.conn.describe_account_attributes(
+            ['max-instances']), (), self.log)
+        if attrs != 'ERROR':
+            for attr in attrs:
+                if (attr.attribute_name == 'max-instances' and
+                        attr.attribute_values):
+                    limit = int(attr.attribute_values[0])
+        reservations = safe_call(lambda: self.conn.get_all_instances(
+            filters={ 'instance-state-name':
+                      [ 'pending', 'running', 'stopping' ] }), (), self.log)
+        if reservations == 'ERROR':
+            return limit
+        running = sum([ len(r.instances) for r in reservations ])
+        return max(limit - running, 0)
 
-    def get_our_keys(self):
-        return self.conn.get_all_key_pairs()
+    def _get_ours(self, kind, describe, runs=None):
+        """
+        Return the resources of kind the journal has for this region (of
+        the given runs only, if any), from a describe(ids) call. Those EC2
+        no longer knows are marked gone.
+        """
+        ids = self.journal.find(self.region.name, kind, runs)
+        if not ids:
+            return []
+        try:
+            found = describe(ids)
+        except EC2ResponseError:
+            # One that has gone fails the lot
+            found = []
+            for resource_id in ids:
+                try:
+                    found += describe([ resource_id ])
+                except EC2ResponseError:
+                    pass
+        # Key pairs go by name
+        known = set([ getattr(r, 'id', None) or r.name for r in found ])
+        missing = [ r for r in ids if r not in known ]
+        if missing:
+            self.journal.set_state(self.region.name, missing,
+                journal_utils.GONE, before=time() - VISIBILITY_GRACE)
+        return found
 
-    def get_our_sgroups(self):
-        return self.conn.get_all_security_groups(filters={'tag-value': resource_tag})
+    def get_our_instances(self, runs=None):
+        instances = self._get_ours('instance', lambda ids: [ i for r in
+            self.conn.get_all_instances(instance_ids=ids)
+            for i in r.instances ], runs)
+        terminated = [ i.id for i in instances if i.state == 'terminated' ]
+        if terminated:
+            self._gone(terminated)
+        return [ i for i in instances if i.state != 'terminated' ]
 
-    def get_our_volumes(self):
-        return self.conn.get_all_volumes(filters={'tag-value': resource_tag})
+    def get_our_amis(self, runs=None):
+        return self._get_ours('image',
+            lambda ids: self.conn.get_all_images(image_ids=ids), runs)
 
-    def get_our_snapshots(self):
-        return self.conn.get_all_snapshots(filters={'tag-value': resource_tag})
+    def get_our_keys(self, runs=None):
+        return self._get_ours('key_pair',
+            lambda ids: self.conn.get_all_key_pairs(keynames=ids), runs)
 
-    def destroy_sgroups(self):
-        [safe_call(g.delete, (), self.log) for g in self.get_our_sgroups()]
+    def get_our_sgroups(self, runs=None):
+        return self._get_ours('security_group',
+            lambda ids: self.conn.get_all_security_groups(group_ids=ids),
+            runs)
 
-    def destroy_instances(self):
-        [safe_call(i.terminate, (), self.log) for i in self.get_our_instances()]
+    def get_our_volumes(self, runs=None):
+        return self._get_ours('volume',
+            lambda ids: self.conn.get_all_volumes(volume_ids=ids), runs)
 
-    def destroy_amis(self):
-        [safe_call(a.deregister, (), self.log) for a in self.get_our_amis()]
+    def get_our_snapshots(self, runs=None):
+        return self._get_ours('snapshot',
+            lambda ids: self.conn.get_all_snapshots(snapshot_ids=ids), runs)
 
-    def destroy_volumes(self):
-        [safe_call(v.delete, (), self.log) for v in self.get_our_volumes()]
+    def orphaned_runs(self):
+        """
+        Return the runs that left resources in this region behind when
+        their process went away, for destroy_all(runs).
+        """
+        return self.journal.orphaned_runs(self.region.name)
+
+    def _delete_task(self, call, resource_id):
+        result = yield lifecycle.Call(self._release, call, resource_id)
+        if result == 'ERROR':
+            raise Exception("%s of %s did not go through" %
+                (call.func_name, resource_id))
+
+    def _terminate_task(self, instance):
+        if instance.state not in ('shutting-down', 'terminated'):
+            result = yield lifecycle.Call(safe_call, instance.terminate, (),
+                self.log)
+            if result == 'ERROR':
+                raise Exception("terminate of %s did not go through" %
+                    instance.id)
+
+    def _terminated_task(self, instance):
+        if instance.state != 'terminated':
+            yield lifecycle.Wait(self.waiter, instance, 'terminated', 300)
+        yield lifecycle.Call(self._gone, [ instance.id ])
+
+    def _delete_volume_task(self, volume):
+        if volume.status == 'in-use':
+            # Only comes free once its instance has gone
+            yield lifecycle.Wait(self.waiter, volume, 'available', 300,
+                failure=('error',), state=lambda v: v.status)
+        yield self._delete_task(volume.delete, volume.id)
+
+    def _delete_sgroup_task(self, group):
+        # The instances are gone, but EC2 can take a moment to agree
+        deleted = lambda: self._release(group.delete, group.id) != 'ERROR'
+        yield self.waiter.until_task(lambda: lifecycle.Call(deleted), 60,
+            'security group %s to be deleted' % group.name)
+
+    def _destroy(self, tiers, threads=DESTROY_THREADS):
+        """
+        Run the tasks of each (what, tasks) tier concurrently, one tier
+        after the other. Return how many of them failed.
+        """
+        engine = lifecycle.LifecycleEngine(threads)
+        failed = 0
+        try:
+            for what, tasks in tiers:
+                if not tasks:
+                    continue
+                self.log.debug("Removing %s (%d)" % (what, len(tasks)))
+                for task in engine.run_all(tasks):
+                    if task.error:
+                        self.log.warning("Failed removing %s: %s" %
+                            (what, task.error))
+                        failed += 1
+        finally:
+            engine.close()
+        return failed
 
-    def destroy_snapshots(self):
-        [safe_call(s.delete, (), self.log) for s in self.get_our_snapshots()]
+    def destroy_sgroups(self, runs=None):
+        return self._destroy([ ('security groups',
+            [ self._delete_sgroup_task(g)
+              for g in self.get_our_sgroups(runs) ]) ])
 
-    def destroy_keys(self):
-        # TODO: cannot tag these, so need to figure out how to do this
-        pass
+    def destroy_instances(self, runs=None):
+        instances = self.get_our_instances(runs)
+        return self._destroy([ ('instances',
+            [ self._terminate_task(i) for i in instances ]),
+            ('instances shutting down',
+            [ self._terminated_task(i) for i in instances ]) ])
 
-    def destroy_all(self):
-        self.destroy_sgroups()
-        self.destroy_instances()
-        self.destroy_amis()
-        self.destroy_keys()
-        self.destroy_volumes()
-        self.destroy_snapshots()
+    def destroy_amis(self, runs=None):
+        return self._destroy([ ('AMIs', [ self._delete_task(a.deregister, a.id)
+                                         for a in self.get_our_amis(runs) ]) ])
+
+    def destroy_volumes(self, runs=None):
+        return self._destroy([ ('volumes', [ self._delete_volume_task(v)
+            for v in self.get_our_volumes(runs) ]) ])
+
+    def destroy_snapshots(self, runs=None):
+        return self._destroy([ ('snapshots', [ self._delete_task(s.delete, s.id)
+            for s in self.get_our_snapshots(runs) ]) ])
+
+    def destroy_keys(self, runs=None):
+        return self._destroy([ ('key pairs', [ self._delete_task(k.delete,
+            k.name) for k in self.get_our_keys(runs) ]) ])
+
+    def destroy_all(self, threads=DESTROY_THREADS, runs=None):
+        """
+        Remove everything the journal says we have left behind, or only
+        what the given runs did (see orphaned_runs()), in the order things
+        depend on each other: instances, then AMIs, then volumes and
+        snapshots, then security groups and last of all key pairs. Each
+        tier is deleted concurrently, and the only waits are for instances
+        to terminate where a volume or security group needs them gone,
+        which the describe poller batches. Returns how many resources could
+        not be removed.
+        """
+        instances = self.get_our_instances(runs)
+        tiers = [
+            # Nothing has to wait for these calls, only for what they do
+            ('instances', [ self._terminate_task(i) for i in instances ]),
+            ('AMIs', [ self._delete_task(a.deregister, a.id)
+                       for a in self.get_our_amis(runs) ]),
+            # Snapshots can go once no AMI refers to them any more, and
+            # attached volumes once their instances have terminated
+            ('volumes and snapshots',
+             [ self._terminated_task(i) for i in instances ] +
+             [ self._delete_volume_task(v)
+               for v in self.get_our_volumes(runs) ] +
+             [ self._delete_task(s.delete, s.id)
+               for s in self.get_our_snapshots(runs) ]),
+            ('security groups', [ self._delete_sgroup_task(g)
+                                  for g in self.get_our_sgroups(runs) ]),
+            ('key pairs', [ self._delete_task(k.delete, k.name)
+                            for k in self.get_our_keys(runs) ]) ]
+        failed = self._destroy(tiers, threads)
+        if failed:
+            self.log.warning("%d resources could not be removed" % failed)
+        return failed
 
 class AMIHelper(EC2Helper):
 
-    def __init__(self, ec2_region):
-        super(AMIHelper, self).__init__(ec2_region)
+    def __init__(self, ec2_region, conn=None, journal=None):
+        super(AMIHelper, self).__init__(ec2_region, conn, journal)
+        # The profile_utils profile of the last install
+        self.install_profile = None
+
+    def find_seed_ami(self, digest):
+        """
+        Return the ID of an available seed AMI we registered for digest, or
+        None if there is not one (any more).
+        """
+        images = safe_call(lambda: self.conn.get_all_images(owners=['self'],
+            filters={ 'tag:%s' % SEED_DIGEST_TAG: digest }), (), self.log)
+        if images == 'ERROR':
+            return None
+        for image in images:
+            if image.state == 'available':
+                self.log.debug("Reusing seed AMI %s for digest %s" %
+                    (image.id, digest))
+                return image.id
+        return None
+
+    def register_ebs_ami(self, snapshot_id, arch='x86_64', default_ephem_map=True, img_name=None, img_desc=None, tags=None):
 
-    def register_ebs_ami(self, snapshot_id, arch='x86_64', default_ephem_map=True, img_name=None, img_desc=None):
         # register against snapshot
         try:
             aki=PVGRUB_AKIS[self.region.name][arch]
@@ -178,8 +733,14 @@ class AMIHelper(EC2Helper):
             img_desc='Created directly from volume snapshot %s' % snapshot_id
 
         self.log.debug("Registering %s as new EBS AMI" % snapshot_id)
-        self.create_sgroup('ec2helper-vnc-ssh-%x' % random.randrange(2**32),
-            allow_vnc=True)
+        with self.span('register', snapshot=snapshot_id):
+            ami_id = self._register_ebs_ami(snapshot_id, arch, aki,
+                default_ephem_map, img_name, img_desc, tags)
+        return ami_id
+
+    def _register_ebs_ami(self, snapshot_id, arch, aki, default_ephem_map,
+                          img_name, img_desc, tags):
+        # Registering launches nothing, so it needs no security group
         ebs = EBSBlockDeviceType()
         ebs.snapshot_id = snapshot_id
         ebs.delete_on_termination = True
@@ -200,13 +761,133 @@ class AMIHelper(EC2Helper):
             name=img_name, description=img_desc, architecture=arch,
             kernel_id=aki, root_device_name='/dev/sda',
             block_device_map=block_map)
-        sleep(10)
-        new_amis = self.conn.get_all_images([ result ])
+        self._created('image', str(result))
+        # Freshly registered images are not always visible right away
+        with self.span('register-visible', image=result):
+            new_amis = self.waiter.until(
+                lambda: self._get_new_images([ result ]), 60,
+                'image %s to become visible' % result)
         new_amis[0].add_tag('Name', resource_tag)
+        for key, value in (tags or {}).items():
+            new_amis[0].add_tag(key, value)
+        self._keep([ str(result) ])
 
         return str(result)
 
-    def launch_wait_snapshot(self, ami, user_data, img_size=10, inst_type='m1.small', img_name=None, img_desc=None, remote_access_cmd=None):
+    def _get_new_images(self, image_ids):
+        # Returns nothing (rather than raising) while EC2 does not know them
+        images = safe_call(self.conn.get_all_images, [ image_ids ], self.log)
+        if images == 'ERROR':
+            return None
+        return images
+
+    def ami_snapshot(self, ami_id):
+        """
+        Return the ID of the snapshot behind the root device of EBS AMI
+        ami_id.
+        """
+        images = self.conn.get_all_images([ ami_id ])
+        if not images:
+            raise Exception("AMI (%s) not found" % ami_id)
+        root = images[0].block_device_mapping.get('/dev/sda')
+        if not root or not root.snapshot_id:
+            raise Exception("AMI (%s) has no root snapshot" % ami_id)
+        return str(root.snapshot_id)
+
+    def replicate_ebs_ami(self, snapshot_id, regions, arch='x86_64',
+                          tags=None, region_tags=None, conns=None,
+                          threads=REPLICATE_THREADS):
+        """
+        Register snapshot_id, a snapshot in this helper's region, as an AMI
+        in each of regions, copying it to the other regions all at once.
+        Each region's AMI gets the pvgrub AKI for that region, the tags in
+        tags and those for the region in region_tags. conns maps regions to
+        connections to use instead of boto's, as conn does for a helper.
+        Returns a dict of region to AMI id.
+        """
+        # Rather than find out after the copies
+        for region in regions:
+            if arch not in PVGRUB_AKIS.get(region, {}):
+                raise Exception("Unable to find pvgrub hd00 AKI for %s, "
+                    "arch (%s)" % (region, arch))
+        engine = lifecycle.LifecycleEngine(threads)
+        try:
+            tasks = engine.run_all([ self._replicate_task(snapshot_id, region,
+                arch, dict(tags or {}, **(region_tags or {}).get(region, {})),
+                (conns or {}).get(region)) for region in regions ])
+        finally:
+            engine.close()
+        failed = [ (region, task.error) for region, task in
+                   zip(regions, tasks) if task.error ]
+        for region, error in failed:
+            self.log.error("Replicating %s to %s failed: %s" %
+                (snapshot_id, region, error))
+        if failed:
+            raise Exception("Replicating %s failed in %s" % (snapshot_id,
+                ', '.join([ region for region, error in failed ])))
+        return dict([ (region, task.result) for region, task in
+                      zip(regions, tasks) ])
+
+    def _replicate_task(self, snapshot_id, region, arch, tags, conn):
+        if region == self.region.name:
+            helper = self
+        else:
+            helper = AMIHelper(region, conn, self.journal)
+            snapshot_id = yield helper._copy_snapshot_task(self.region.name,
+                snapshot_id)
+        ami = yield lifecycle.Call(helper.register_ebs_ami, snapshot_id, arch,
+            tags=tags)
+        raise lifecycle.Return(ami)
+
+    def _copy_snapshot_task(self, source_region, snapshot_id):
+        """
+        Copy snapshot_id from source_region into this helper's region and
+        return the ID of the copy once it is completed.
+        """
+        with self.span('snapshot-copy', snapshot=snapshot_id,
+                       source_region=source_region) as span:
+            copy_id = yield lifecycle.Call(self.conn.copy_snapshot,
+                source_region, snapshot_id,
+                'Copy of %s from %s' % (snapshot_id, source_region))
+            yield lifecycle.Call(self._created, 'snapshot', copy_id)
+            span.set(copy=copy_id)
+            snapshots = yield self.waiter.until_task(
+                lambda: lifecycle.Call(self._get_new_snapshots, [ copy_id ]),
+                60, 'snapshot %s to become visible' % copy_id)
+            self.log.debug(
+                "Waiting up to 3600 seconds for snapshot (%s) to become completed" %
+                copy_id)
+            yield lifecycle.Wait(self.waiter, snapshots[0], 'completed', 3600,
+                failure=('error',), state=lambda s: s.status,
+                detail=lambda s: 'progress (%s)' % s.progress)
+        yield lifecycle.Call(snapshots[0].add_tag, 'Name', resource_tag)
+        yield lifecycle.Call(self._keep, [ copy_id ])
+        raise lifecycle.Return(str(copy_id))
+
+    def _get_new_snapshots(self, snapshot_ids):
+        # As _get_new_images
+        snapshots = safe_call(self.conn.get_all_snapshots, [ snapshot_ids ],
+            self.log)
+        if snapshots == 'ERROR':
+            return None
+        return snapshots
+
+    def launch_wait_snapshot(self, ami, user_data, img_size=10, inst_type='m1.small', img_name=None, img_desc=None, remote_access_cmd=None, log_command=None):
+        """
+        Install into an instance of ami with the kickstart in user_data and
+        return the AMI made from the result. Afterwards install_profile has
+        the profile_utils profile of the install, from its console and, if
+        log_command is given, its logs (see profile_utils.InstallProfiler).
+        """
+        return lifecycle.run(self.launch_wait_snapshot_task(ami, user_data,
+            img_size, inst_type, img_name, img_desc, remote_access_cmd,
+            log_command))
+
+    def launch_wait_snapshot_task(self, ami, user_data, img_size=10, inst_type='m1.small', img_name=None, img_desc=None, remote_access_cmd=None, log_command=None):
+        """
+        Lifecycle task version of launch_wait_snapshot(), for running many
+        of them at once on a lifecycle.LifecycleEngine.
+        """
         if not img_name:
             rand_id = random.randrange(2**32)
             # These names need to be unique, hence the pseudo-uuid
@@ -214,78 +895,187 @@ class AMIHelper(EC2Helper):
         if not img_desc:
             img_desc = 'Created from modified snapshot of AMI %s' % (ami)
         try:
-            ami = self._launch_wait_snapshot(
-                ami, user_data, img_size, inst_type, img_name, img_desc, remote_access_cmd)
+            with self.span('launch_wait_snapshot', ami=ami,
+                           instance_type=inst_type):
+                ami = yield self._launch_wait_snapshot_task(
+                    ami, user_data, img_size, inst_type, img_name, img_desc, remote_access_cmd, log_command)
         finally:
+            # The group cannot go until the instance in it has
+            if self.instance:
+                try:
+                    yield self._terminate_task(self.instance)
+                    yield self._terminated_task(self.instance)
+                except Exception, e:
+                    self.log.error('Could not terminate %s: %s' %
+                        (self.instance.id, e))
             if self.security_group:
-                safe_call(self.security_group.delete, [], self.log)
-        return ami
+                try:
+                    yield self._delete_sgroup_task(self.security_group)
+                    self.security_group = None
+                except Exception, e:
+                    self.log.error('Could not delete security group %s: %s' %
+                        (self.security_group.name, e))
+        raise lifecycle.Return(ami)
 
-    def _launch_wait_snapshot(self, ami, user_data, img_size=10, inst_type='m1.small', img_name=None, img_desc=None, remote_access_command=None):
+    def prepare_launch_task(self):
+        """
+        Create the security group launch_wait_snapshot() launches into, so
+        that can be done ahead of time.
+        """
+        yield lifecycle.Call(self.create_sgroup,
+            'ec2helper-ssh-%x' % random.randrange(2**32))
+
+    def _launch_wait_snapshot_task(self, ami, user_data, img_size=10, inst_type='m1.small', img_name=None, img_desc=None, remote_access_command=None, log_command=None):
         ebs_root = EBSBlockDeviceType()
         ebs_root.size=img_size
         ebs_root.delete_on_termination = True
         block_map = BlockDeviceMapping()
         block_map['/dev/sda'] = ebs_root
-        sgroup_name = 'ec2helper-ssh-%x' % random.randrange(2**32)
-        self.create_sgroup(sgroup_name)
+        if not self.security_group:
+            yield self.prepare_launch_task()
+        sgroup_name = self.security_group.name
 
         # Now launch it
         self.log.debug("Starting %s in %s with as %s" %
             (ami, self.region.name, inst_type))
-        reservation = self.conn.run_instances(ami, max_count=1,
-            instance_type=inst_type, user_data=user_data,
-            security_groups=[sgroup_name], block_device_map=block_map)
-        if len(reservation.instances) == 0:
-            raise Exception("Attempt to start instance failed")
-        self.instance = reservation.instances[0]
-        wait_for_ec2_instance_state(self.instance, self.log,
-            final_state='running', timeout=300)
-        self.instance.add_tag('Name', resource_tag)
+        with self.span('launch', ami=ami):
+            reservation = yield lifecycle.Call(self.conn.run_instances, ami,
+                max_count=1, instance_type=inst_type, user_data=user_data,
+                security_groups=[sgroup_name], block_device_map=block_map)
+            if len(reservation.instances) == 0:
+                raise Exception("Attempt to start instance failed")
+            self.instance = reservation.instances[0]
+            yield lifecycle.Call(self._created, 'instance', self.instance.id)
+            yield wait_for_ec2_instance_state_task(self.instance, self.log,
+                final_state='running', timeout=300, waiter=self.waiter)
+        yield lifecycle.Call(self.instance.add_tag, 'Name', resource_tag)
         self.log.debug("Instance (%s) is now running" % self.instance.id)
         self.log.debug("Public DNS will be: %s" % self.instance.public_dns_name)
         self.log.debug("Now waiting up to 30 minutes for instance to stop")
-
-        wait_for_ec2_instance_state(self.instance, self.log,
-            final_state='stopped', timeout=1800)
+        profiler = profile_utils.InstallProfiler(log_command)
+        try:
+            yield self._install_wait_task(1800, profiler)
+        finally:
+            self.install_profile = profiler.profile(time())
 
         # Snapshot
         self.log.debug(
             "Creating a new EBS image from completed/stopped EBS instance")
-        new_ami_id = self.conn.create_image(self.instance.id, img_name,
-            img_desc)
+        with self.span('create-image', instance=self.instance.id):
+            new_ami_id = yield lifecycle.Call(self.conn.create_image,
+                self.instance.id, img_name, img_desc)
+            yield lifecycle.Call(self._created, 'image', new_ami_id)
         self.log.debug("boto creat_image call returned AMI ID: %s" % new_ami_id)
         self.log.debug("Waiting for newly generated AMI to become available")
         # As with launching an instance we have seen occasional issues when
-        # trying to query this AMI right away - give it a moment to settle
-        sleep(10)
-        new_amis = self.conn.get_all_images([ new_ami_id ])
-        new_ami = new_amis[0]
-        timeout = 120
-        interval = 10
-        for i in range(timeout):
-            new_ami.update()
-            if new_ami.state == "available":
-                new_ami.add_tag('Name', resource_tag)
-                break
-            elif new_ami.state == "failed":
-                raise Exception("Amazon reports EBS image creation failed")
-            self.log.debug(
-                "AMI status (%s) is not 'available' - [%d of %d seconds]" %
-                (new_ami.state, i * interval, timeout * interval))
-            sleep(interval)
-        self.log.debug("Terminating/deleting instance")
-        safe_call(instance.terminate, (), self.log)
-        sleep(5)
-        if new_ami.state != "available":
-            raise Exception("Failed to produce an AMI ID")
+        # trying to query this AMI right away - retry until it shows up
+        try:
+            with self.span('image-available', image=new_ami_id):
+                new_amis = yield self.waiter.until_task(
+                    lambda: lifecycle.Call(self._get_new_images,
+                        [ new_ami_id ]),
+                    60, 'image %s to become visible' % new_ami_id)
+                new_ami = new_amis[0]
+                yield lifecycle.Wait(self.waiter, new_ami, 'available', 1200,
+                    failure=('failed',))
+            yield lifecycle.Call(new_ami.add_tag, 'Name', resource_tag)
+            yield lifecycle.Call(self._keep, [ new_ami_id ])
+        finally:
+            self.log.debug("Terminating/deleting instance")
+            with self.span('terminate', instance=self.instance.id):
+                yield lifecycle.Call(self._release, self.instance.terminate,
+                    self.instance.id)
         self.log.debug("SUCCESS: %s is now available for launch" % new_ami_id)
-        return new_ami_id
+        raise lifecycle.Return(new_ami_id)
+
+    def _install_wait_task(self, timeout, profiler=None):
+        """
+        Wait for the installer on self.instance to stop it, following its
+        console. An install that fails is given up on (and the instance
+        terminated) as soon as the console shows it, rather than after
+        timeout seconds, and the wait for the stop itself starts as soon as
+        the poweroff does. A profile_utils.InstallProfiler is handed the
+        console events, and fetches the logs every LOG_INTERVAL seconds.
+        """
+        monitor = console_utils.ConsoleMonitor(self.conn, self.instance.id)
+        deadline = time() + timeout
+        error = None
+        with self.span('install', instance=self.instance.id) as span:
+            while not monitor.done():
+                events = yield lifecycle.Call(monitor.poll)
+                for event in events:
+                    self.log.debug("Install on %s: %s" %
+                        (self.instance.id, event.line))
+                    attrs = { 'kind': event.kind, 'marker': event.name }
+                    if event.total:
+                        attrs.update(count=event.count, total=event.total)
+                    span.progress(**attrs)
+                if profiler:
+                    profiler.add_console(events)
+                if monitor.done():
+                    break
+                # An installer that powers off without a word on the console
+                # still has to be noticed
+                yield lifecycle.Call(self.waiter.refresh, self.instance)
+                state = self.instance.state
+                if profiler and profiler.log_command and state == 'running' \
+                   and time() - profiler.fetched >= LOG_INTERVAL:
+                    yield self._fetch_log_task(profiler)
+                if state == 'stopped':
+                    break
+                if state in INSTANCE_FAILURE_STATES['stopped']:
+                    error = "instance entered state (%s)" % state
+                    break
+                if time() >= deadline:
+                    error = "timed out after %d seconds" % timeout
+                    break
+                yield lifecycle.Sleep(min(CONSOLE_INTERVAL,
+                    max(deadline - time(), 0)))
+            if monitor.failure:
+                # The warnings just before the failure tend to explain it
+                error = ' / '.join([ e.line for e in monitor.events
+                                     if e.kind in (console_utils.WARNING,
+                                                   console_utils.FAILURE) ][-5:])
+            span.set(phase=monitor.phase)
+            if error:
+                # The installer is still up to tell us what went wrong
+                if profiler and profiler.log_command and monitor.failure:
+                    yield self._fetch_log_task(profiler)
+                yield lifecycle.Call(safe_call, self.instance.terminate, [],
+                    self.log)
+                raise Exception("Install on %s failed: %s" %
+                    (self.instance.id, error))
+            if monitor.poweroff:
+                self.log.debug("Instance (%s) is powering off" %
+                    self.instance.id)
+            yield wait_for_ec2_instance_state_task(self.instance, self.log,
+                final_state='stopped', timeout=POWEROFF_TIMEOUT,
+                waiter=self.waiter)
+
+    def _fetch_log_task(self, profiler):
+        """
+        Hand profiler the latest copy of the installer's logs. Failing to
+        get them only costs the profile its precision.
+        """
+        if not self.instance.public_dns_name:
+            return
+        output, retcode = yield lifecycle.Command(
+            profiler.log_args(self.instance.public_dns_name), shell=True,
+            check=False, timeout=LOG_TIMEOUT)
+        if retcode:
+            self.log.debug("Could not fetch the install logs from %s" %
+                self.instance.id)
+            output = ''
+        profiler.add_log(output)
 
 class EBSHelper(EC2Helper):
 
-    def __init__(self, ec2_region, utility_ami=None, command_prefix=None, user='root'):
-        super(EBSHelper, self).__init__(ec2_region)
+    # What session() makes ssh connections to the utility instance with
+    session_class = process_utils.SSHSession
+
+    def __init__(self, ec2_region, utility_ami=None, command_prefix=None, user='root', conn=None, direct_conn=None, journal=None):
+        super(EBSHelper, self).__init__(ec2_region, conn, journal)
+        self.direct_conn = direct_conn
         if not utility_ami:
             self.utility_ami = UTILITY_AMIS[ec2_region][0]
             self.command_prefix = UTILITY_AMIS[ec2_region][1]
@@ -296,35 +1086,136 @@ class EBSHelper(EC2Helper):
             self.user = user
         self.key_name = None
         self.key_file_object = None
+        self.sessions = {}
+        # The last volume create_volume_task() made, so whoever asked for it
+        # can clean it up if they never got it back
+        self.new_volume = None
+        # Where the manifests of uploaded snapshots are kept
+        self.manifest_dir = manifest_utils.MANIFEST_DIR
 
-    def safe_upload_and_shutdown(self, image_file):
+    def safe_upload_and_shutdown(self, image_file, compress=True, sparse=True,
+                                 workers=1, pool=None, codec=None,
+                                 parent=None):
         """
         Launch the AMI - terminate
         upload, create volume and then terminate
+        With a UtilityPool the upload runs on a leased instance instead.
+        """
+        return lifecycle.run(self.safe_upload_and_shutdown_task(image_file,
+            compress, sparse, workers, pool, codec, parent))
+
+    def safe_upload_and_shutdown_task(self, image_file, compress=True,
+                                      sparse=True, workers=1, pool=None,
+                                      codec=None, parent=None):
         """
+        Lifecycle task version of safe_upload_and_shutdown().
+        """
+        if pool:
+            helper = yield lifecycle.Call(pool.lease)
+            healthy = False
+            try:
+                snapshot = yield helper.file_to_snapshot_task(image_file,
+                    compress, sparse, workers, codec, parent)
+                healthy = True
+            finally:
+                yield lifecycle.Call(pool.release, helper, healthy)
+            raise lifecycle.Return(snapshot)
         if self.instance:
             raise Exception(
                 "Cannot have a running utility instance with Safe upload")
-        self.start_ami()
         try:
-            snapshot = self.file_to_snapshot(image_file)
+            yield self.start_ami_task()
+            snapshot = yield self.file_to_snapshot_task(image_file, compress,
+                sparse, workers, codec, parent)
         finally:
-            safe_call(self.terminate_ami, (), self.log)
-        return snapshot
+            # As safe_call(self.terminate_ami) does for the blocking version
+            try:
+                yield self.terminate_ami_task()
+            except Exception, e:
+                self.log.warning('Caught a %s in the dirty except' % type(e))
+                self.log.error('Error message: %s' % e)
+        raise lifecycle.Return(snapshot)
 
-    def start_ami(self):
+    def pipelined_upload_task(self, build, image_size, sparse=True,
+                              workers=1, codec=None):
+        """
+        Like safe_upload_and_shutdown_task(), but the image is made by
+        build, a lifecycle task that returns its file name, and the utility
+        instance is started and its volume (for an image of image_size
+        bytes) created while that runs. Returns the snapshot id.
+        """
+        if self.instance:
+            raise Exception(
+                "Cannot have a running utility instance with Safe upload")
+        self.new_volume = None
+        try:
+            image_file, volume = yield lifecycle.All([ build,
+                self._prepare_upload_task(image_size) ])
+            # From here on file_to_snapshot_task() sees to the volume
+            self.new_volume = None
+            snapshot = yield self.file_to_snapshot_task(image_file,
+                sparse=sparse, workers=workers, codec=codec, volume=volume)
+        finally:
+            try:
+                yield self.terminate_ami_task()
+            except Exception, e:
+                self.log.warning('Caught a %s in the dirty except' % type(e))
+                self.log.error('Error message: %s' % e)
+            # Made alongside a build that failed, or failed to come up itself
+            if self.new_volume:
+                volume, self.new_volume = self.new_volume, None
+                self.log.debug("Deleting unused volume (%s)" % volume.id)
+                try:
+                    yield self._delete_volume_task(volume)
+                except Exception, e:
+                    self.log.error('Could not delete volume %s: %s' %
+                        (volume.id, e))
+        raise lifecycle.Return(snapshot)
+
+    def _prepare_upload_task(self, image_size):
+        # Both go in one zone, so the volume need not wait for the instance
+        zone = yield lifecycle.Call(self.pick_zone)
+        started, volume = yield lifecycle.All([
+            self.start_ami_task(placement=zone),
+            self.create_volume_task(volume_size(image_size), zone) ])
+        raise lifecycle.Return(volume)
+
+    def start_ami(self, key_dir=None, placement=None):
+        """
+        Launch the utility instance and make it reachable as root. The key
+        normally lives in a temporary file; pass key_dir to keep it in a
+        file there that outlives this process (see UtilityPool).
+        """
+        lifecycle.run(self.start_ami_task(key_dir, placement))
+
+    def start_ami_task(self, key_dir=None, placement=None):
+        """
+        Lifecycle task version of start_ami().
+        """
+        with self.span('start_ami', ami=self.utility_ami):
+            yield self._start_ami_task(key_dir, placement)
+
+    def _start_ami_task(self, key_dir, placement):
         rand_id = random.randrange(2**32)
         sgroup_name = 'ec2helper-ssh-%x' % rand_id
-        self.create_sgroup(sgroup_name)
+        yield lifecycle.Call(self.create_sgroup, sgroup_name)
 
         # Create a use-once SSH key
         self.log.debug("Creating SSH key pair for image upload")
         # XXX: EC2 does not support tagging key pairs :(
-        self.key_name = "ebs-helper-tmp-%x" % (rand_id)
-        self.key = safe_call(self.conn.create_key_pair, (self.key_name,),
-            self.log, die=True)
+        self.key_name = "%s%x" % (KEY_PREFIX, rand_id)
+        self.key = yield lifecycle.Call(safe_call, self.conn.create_key_pair,
+            (self.key_name,), self.log, die=True)
+        yield lifecycle.Call(self._created, 'key_pair', self.key_name)
         # Shove into a named temp file
-        self.key_file_object = NamedTemporaryFile()
+        if key_dir:
+            if not os.path.isdir(key_dir):
+                os.makedirs(key_dir)
+            key_path = os.path.join(key_dir, '%s.pem' % self.key_name)
+            self.key_file_object = os.fdopen(
+                os.open(key_path, os.O_WRONLY | os.O_CREAT, 0600), 'w')
+        else:
+            self.key_file_object = NamedTemporaryFile()
         self.key_file_object.write(self.key.material)
         self.key_file_object.flush()
         self.log.debug("Temporary key is stored in (%s)" %
@@ -334,204 +1225,791 @@ class EBSHelper(EC2Helper):
         instance_type="m1.small"
         self.log.debug("Starting %s in %s as %s" %
             (self.utility_ami, self.region.name, instance_type))
-        reservation = self.conn.run_instances(
-            self.utility_ami, max_count=1, instance_type=instance_type,
-            key_name=self.key_name, security_groups=[sgroup_name])
-        if len(reservation.instances) == 0:
-            raise Exception("Attempt to start instance failed")
-        self.instance = reservation.instances[0]
-        wait_for_ec2_instance_state(self.instance, self.log,
-            final_state='running', timeout=300)
-        self.instance.add_tag('Name', resource_tag)
-        self.wait_for_ec2_ssh_access(self.instance.public_dns_name,
-            self.key_file_object.name)
-        self.enable_root(self.instance.public_dns_name,
-            self.key_file_object.name, self.user, self.command_prefix)
+        with self.span('utility-launch', ami=self.utility_ami):
+            reservation = yield lifecycle.Call(self.conn.run_instances,
+                self.utility_ami, max_count=1, instance_type=instance_type,
+                key_name=self.key_name, security_groups=[sgroup_name],
+                placement=placement)
+            if len(reservation.instances) == 0:
+                raise Exception("Attempt to start instance failed")
+            self.instance = reservation.instances[0]
+            yield lifecycle.Call(self._created, 'instance', self.instance.id)
+            yield wait_for_ec2_instance_state_task(self.instance, self.log,
+                final_state='running', timeout=300, waiter=self.waiter)
+        yield lifecycle.Call(self.instance.add_tag, 'Name', resource_tag)
+        with self.span('ssh-access', instance=self.instance.id):
+            yield self.wait_for_ec2_ssh_access_task(
+                self.instance.public_dns_name, self.key_file_object.name)
+        with self.span('enable-root', instance=self.instance.id):
+            yield self.enable_root_task(self.instance.public_dns_name,
+                self.key_file_object.name, self.user, self.command_prefix)
 
     def terminate_ami(self):
+        lifecycle.run(self.terminate_ami_task())
+
+    def terminate_ami_task(self):
+        """
+        Lifecycle task version of terminate_ami().
+        """
         # Terminate the AMI and delete all local and remote artifacts
         # Try very hard to do whatever is possible here and warn loudly if
         # something may have been left behind
-        # Remove local copy of the key
-        self.key_file_object.close()
+        # Shut down the ssh masters while the key is still around
+        yield lifecycle.Call(self.close_sessions)
+
+        # Remove local copy of the key, if start_ami() got that far
+        if self.key_file_object:
+            self.key_file_object.close()
+            # Temporary files are gone by now, but keys from
+            # start_ami(key_dir) are not
+            if os.path.exists(self.key_file_object.name):
+                os.unlink(self.key_file_object.name)
 
         # Remove remote copy of the key
         if self.key_name:
-            safe_call(self.conn.delete_key_pair, (self.key_name,), self.log)
+            yield lifecycle.Call(self._release, self.conn.delete_key_pair,
+                self.key_name, (self.key_name,))
 
         # Terminate the instance
-        if self.instance:
-            retval = safe_call(self.instance.terminate, (), self.log, die=True)
-            timeout = 60
-            interval = 5
-            for i in range(timeout):
-                safe_call(self.instance.update, (), self.log, die=True)
-                if self.instance.state == "terminated" :
-                    break
-                elif i < timeout :
-                    self.log.debug(
-                        "Instance is not terminated [%s of %s seconds]" %
-                        (i * interval, timeout * interval))
-                    sleep(interval)
-
-        # If we do have an instance it must be terminated before this can happen
-        # That is why we put it last
-        # Try even if we get an exception while doing the termination above
-        if self.security_group:
-            safe_call(self.security_group.delete, (), self.log)
-
-    def file_to_snapshot(self, filename, compress=True):
+        try:
+            if self.instance:
+                retval = yield lifecycle.Call(self._release,
+                    self.instance.terminate, self.instance.id, die=True)
+                yield lifecycle.Wait(self.waiter, self.instance, 'terminated',
+                    300)
+        finally:
+            # If we do have an instance it must be terminated before this can
+            # happen
+            # That is why we put it last
+            # Try even if we get an exception while doing the termination
+            # above
+            if self.security_group:
+                yield lifecycle.Call(self._release,
+                    self.security_group.delete, self.security_group.id)
+
+    def session(self, guestaddr=None, sshprivkey=None, user='root'):
+        """
+        Return the multiplexed ssh session to guestaddr (the utility instance
+        by default) as user, starting one if needed. terminate_ami closes
+        them all.
+        """
+        if not guestaddr:
+            guestaddr = self.instance.public_dns_name
+        if not sshprivkey:
+            sshprivkey = self.key_file_object.name
+        key = (guestaddr, sshprivkey, user)
+        if key not in self.sessions:
+            self.sessions[key] = self.session_class(guestaddr, sshprivkey,
+                user)
+        return self.sessions[key]
+
+    def close_sessions(self):
+        for session in self.sessions.values():
+            safe_call(session.close, (), self.log)
+        self.sessions = {}
+
+    def _connect_task(self, session):
+        """
+        Lifecycle task that starts session's master connection and sends
+        whether it worked.
+        """
+        output, retcode = yield lifecycle.Command(session.master_args(),
+            check=False)
+        if retcode:
+            self.log.debug("No ssh access to %s yet" % session.guestaddr)
+        raise lifecycle.Return(retcode == 0)
+
+    def _execute_task(self, command, guestaddr=None, sshprivkey=None,
+                      user='root', prefix=None, check=True):
+        """
+        Lifecycle task version of session(...).execute(command), sending
+        (output, retcode).
+        """
+        session = self.session(guestaddr, sshprivkey, user)
+        # The master may have timed out (see process_utils.CONTROL_PERSIST)
+        # or died, leaving its socket behind
+        output, retcode = yield lifecycle.Command(
+            session.control_args('check'), check=False)
+        if retcode:
+            connected = yield self._connect_task(session)
+            if not connected and check:
+                raise Exception("Unable to open an ssh connection to %s@%s" %
+                    (user, session.guestaddr))
+        result = yield lifecycle.Command(session.execute_args(command,
+            prefix=prefix), pty=(prefix == 'sudo'), check=check)
+        raise lifecycle.Return(result)
+
+    def _ssh_pipe(self, remote_command, multiplex=True):
+        """
+        Return a shell fragment that runs remote_command as root on the
+        utility instance, reading from our stdin.
+        """
+        ssh = self.session().command(multiplex)
+        return ' '.join(ssh + [ pipes.quote(remote_command) ])
+
+    def _stream_command(self, device, codec):
+        # This is big and hairy - it also works, and avoids temporary storage
+        # on the local and remote side of this activity
+        remote = 'dd of=%s bs=4k' % device
+        if codec.decompress:
+            remote = codec.decompress + ' | ' + remote
+        command = self._ssh_pipe(remote)
+        if codec.compress:
+            command = codec.compress + ' | ' + command
+
+        self.log.debug("Command will be:\n%s\n" % command)
+        return command
+
+    def _upload_stream(self, filename, device, codec, meter):
+        # We feed the pipeline ourselves, so the meter sees what goes in
+        command = self._stream_command(device, codec)
+        meter.total = os.path.getsize(filename)
+        self.log.debug("Running.  This may take some time.")
+        return process_utils.subprocess_feed(lambda out:
+            upload_utils.write_file(filename,
+                process_utils.CountingWriter(out, meter)),
+            [ command ], shell=True, meter=meter)
+
+    def _upload_extents(self, filename, device, codec, sparse=True,
+                        workers=1, extents=None, meter=None):
+        if extents is None:
+            # Only ship the parts of the image that hold data. The volume is
+            # fresh, so everything we skip already reads back as zeros.
+            extents = upload_utils.data_extents(filename, sparse=sparse)
+        data = sum([length for offset, length in extents])
+        self.log.debug("Sending %d bytes in %d extents (%d byte image)" %
+            (data, len(extents), os.path.getsize(filename)))
+        if meter:
+            meter.total = data
+        writer = upload_utils.SPARSE_WRITER % {
+            'device': device, 'bs': upload_utils.BLOCK_SIZE }
+        # Parallel streams each get a connection of their own, otherwise
+        # they would all share the master's single cipher stream
+        multiplex = workers <= 1
+        if codec.decompress:
+            writer = codec.decompress + ' | ' + writer
+        command = self._ssh_pipe(writer, multiplex)
+        if codec.compress:
+            command = codec.compress + ' | ' + command
+
+        self.log.debug("Command will be:\n%s\n" % command)
+        self.log.debug("Running over %d stream(s).  This may take some time." %
+            workers)
+        return upload_utils.upload_extents(filename, extents, command,
+            workers, wrap=codec.wrap, meter=meter)
+
+    def _remote_tools_task(self, tools):
+        """
+        Return the set of tools installed on the utility instance.
+        """
+        output, retcode = yield self._execute_task(
+            compress_utils.tools_probe(tools), check=False)
+        raise lifecycle.Return(set(output.split()))
+
+    def _codec_task(self, name, filename, sparse):
+        """
+        Return the compress_utils codec called name, or for auto the one
+        expected to upload filename fastest. Codecs missing from either end
+        fall back to gzip.
+        """
+        if name == 'auto':
+            codecs = [ compress_utils.get_codec(n)
+                       for n in compress_utils.AUTO_CANDIDATES ]
+        else:
+            codecs = [ compress_utils.get_codec(name) ]
+        # Every utility image has gzip, the upload has always relied on it
+        remote = set([ 'gzip' ])
+        tools = set([ t for c in codecs for t in c.tools ]) - remote
+        if tools:
+            found = yield self._remote_tools_task(sorted(tools))
+            remote |= found
+        usable = [ c for c in codecs
+                   if c.available() and not set(c.tools) - remote ]
+        if name != 'auto':
+            if usable:
+                raise lifecycle.Return(usable[0])
+            self.log.warning("Codec %s is not installed on both ends, "
+                "using gzip" % name)
+            raise lifecycle.Return(compress_utils.get_codec('gzip'))
+
+        extents = yield lifecycle.Call(upload_utils.data_extents, filename,
+            sparse=sparse)
+        sample = yield lifecycle.Call(compress_utils.sample_image, filename,
+            extents)
+        link_speed = yield lifecycle.Call(compress_utils.measure_link,
+            self._ssh_pipe('cat >/dev/null'))
+        self.log.debug("Link to the utility instance moves %.1f MiB/s" %
+            (link_speed / 1024.0 ** 2))
+        codec = yield lifecycle.Call(compress_utils.choose_codec, usable,
+            sample, link_speed, self.log)
+        self.log.debug("Compressing with %s" % codec.name)
+        raise lifecycle.Return(codec)
+
+    def _find_parent(self, parent, filesize):
+        """
+        Return the id and manifest of the snapshot to base an upload of a
+        filesize byte image on, or (None, None) to upload all of it. parent
+        is a snapshot id, or latest for the newest of ours with a manifest
+        of an image the same size.
+        """
+        region = self.region.name
+        if parent == 'latest':
+            candidates = manifest_utils.find_manifests(region, filesize,
+                self.manifest_dir)
+        else:
+            candidates = [ parent ]
+        if not candidates:
+            self.log.debug("No earlier upload to base this one on")
+            return None, None
+        existing = [ s.id for s in self.get_our_snapshots()
+                     if s.status == 'completed' ]
+        for snapshot_id in candidates:
+            if snapshot_id not in existing:
+                if parent != 'latest':
+                    raise Exception("Parent snapshot (%s) not found" %
+                        snapshot_id)
+                # Deleted since, so its manifest is no use to anyone
+                manifest_utils.forget_manifest(region, snapshot_id,
+                    self.manifest_dir)
+                continue
+            manifest = manifest_utils.load_manifest(region, snapshot_id,
+                self.manifest_dir)
+            if not manifest:
+                raise Exception("No manifest of snapshot (%s)" % snapshot_id)
+            if manifest['size'] != filesize:
+                raise Exception("Snapshot (%s) is of a %d byte image, not "
+                    "%d" % (snapshot_id, manifest['size'], filesize))
+            return str(snapshot_id), manifest
+        self.log.debug("No earlier upload to base this one on")
+        return None, None
+
+    def file_to_snapshot(self, filename, compress=True, sparse=True,
+                         workers=1, codec=None, parent=None, volume=None):
+        return lifecycle.run(self.file_to_snapshot_task(filename, compress,
+            sparse, workers, codec, parent, volume))
+
+    def file_to_snapshot_task(self, filename, compress=True, sparse=True,
+                              workers=1, codec=None, parent=None,
+                              volume=None):
+        """
+        Lifecycle task version of file_to_snapshot(). codec names one of the
+        compress_utils codecs, or auto; without one compress picks between
+        gzip and none. With a parent snapshot (see _find_parent) only the
+        blocks that differ from it are sent. volume is an empty one made
+        by create_volume_task() to upload into, rather than a new one.
+        """
         if not self.instance:
             raise Exception("You must start the utility instance first!")
         if not os.path.isfile(filename):
             raise Exception("Filename (%s) is not a file" % filename)
+        if volume and parent:
+            raise Exception("An upload with a parent needs a volume of its own")
+        if volume and volume.size < volume_size(os.path.getsize(filename)):
+            raise Exception("Volume (%s) is too small for %s" % (volume.id,
+                filename))
+        if codec is None:
+            codec = compress and 'gzip' or 'none'
+        with self.span('file_to_snapshot', image_size=os.path.getsize(filename),
+                       codec=codec, sparse=sparse, workers=workers,
+                       parent=parent):
+            snapshot_id = yield self._file_to_snapshot_task(filename, codec,
+                sparse, workers, parent, volume)
+        raise lifecycle.Return(snapshot_id)
+
+    def _manifest_task(self, filename, parent):
+        """
+        Return the manifest of filename, the snapshot to base its upload on
+        (see _find_parent) and the extents that changed since then.
+        """
         filesize = os.path.getsize(filename)
-        # Gigabytes, rounded up
-        volume_size = int( (filesize/(1024 ** 3)) + 1 )
+        with self.span('manifest') as span:
+            manifest = yield lifecycle.Call(manifest_utils.build_manifest,
+                filename)
+            extents = None
+            if parent:
+                parent, parent_manifest = yield lifecycle.Call(
+                    self._find_parent, parent, filesize)
+            if parent:
+                # The upload starts out from the parent, so blocks that
+                # are now zero have to be sent as well
+                extents = manifest_utils.changed_extents(parent_manifest,
+                    manifest)
+                self.log.debug("%d bytes changed since snapshot (%s)" %
+                    (sum([ l for o, l in extents ]), parent))
+                span.set(parent=parent)
+        raise lifecycle.Return((manifest, parent, extents))
+
+    def create_volume_task(self, size, zone, snapshot=None):
+        """
+        Create a size GiB volume in zone, from snapshot if given, and
+        return it once it is available.
+        """
         self.log.debug("Creating %d GiB volume in (%s) to hold new image" %
-            (volume_size, self.instance.placement))
-        volume = self.conn.create_volume(volume_size, self.instance.placement) 
+            (size, zone))
+        with self.span('volume-create', size=size, parent=snapshot):
+            volume = yield lifecycle.Call(self.conn.create_volume, size, zone,
+                snapshot)
+            self.new_volume = volume
+            yield lifecycle.Call(self._created, 'volume', volume.id)
 
-        # Volumes can sometimes take a very long time to create
-        # Wait up to 10 minutes for now (plus the time taken for the upload
-        # above)
-        self.log.debug(
-            "Waiting up to 600 seconds for volume (%s) to become available" %
-            volume.id)
-        for i in range(60):
-            safe_call(volume.update, (), self.log, die=True)
-            if volume.status == "available":
-                volume.add_tag('Name', resource_tag)
-                break
+            # Volumes can sometimes take a very long time to create
+            # Wait up to 10 minutes for now (plus the time taken for the
+            # upload above)
             self.log.debug(
-                "Volume status (%s) - waiting for 'available': %d/600" %
-                (volume.status, i*10))
-            sleep(10)
+                "Waiting up to 600 seconds for volume (%s) to become available" %
+                volume.id)
+            yield lifecycle.Wait(self.waiter, volume, 'available', 600,
+                failure=('error',), state=lambda v: v.status)
+        yield lifecycle.Call(volume.add_tag, 'Name', resource_tag)
+        raise lifecycle.Return(volume)
+
+    def _file_to_snapshot_task(self, filename, codec, sparse, workers,
+                               parent, volume=None):
+        filesize = os.path.getsize(filename)
+        manifest, parent, extents = yield self._manifest_task(filename,
+            parent)
+        if parent and not extents:
+            self.log.debug("Image unchanged since snapshot (%s)" % parent)
+            raise lifecycle.Return(parent)
+        with self.span('choose-codec', codec=codec) as span:
+            codec = yield self._codec_task(codec, filename, sparse)
+            span.set(chosen=codec.name)
+        if not volume:
+            volume = yield self.create_volume_task(volume_size(filesize),
+                self.instance.placement, parent)
 
         # Volume is now available, attach it
-        safe_call(self.conn.attach_volume,
-            (volume.id, self.instance.id, "/dev/sdh"), self.log, die=True)
-        self.log.debug(
-            "Waiting up to 120 seconds for volume (%s) to become in-use" %
-            volume.id)
-        for i in range(12):
-            safe_call(volume.update, (), self.log, die=True)
-            vs = volume.attachment_state()
-            if vs == "attached":
-                break
+        with self.span('volume-attach', volume=volume.id):
+            yield lifecycle.Call(safe_call, self.conn.attach_volume,
+                (volume.id, self.instance.id, "/dev/sdh"), self.log, die=True)
             self.log.debug(
-                "Volume status (%s) - waiting for 'attached': %d/120" %
-                (vs, i*10))
-            sleep(10)
+                "Waiting up to 120 seconds for volume (%s) to become in-use" %
+                volume.id)
+            yield lifecycle.Wait(self.waiter, volume, 'attached', 120,
+                state=lambda v: v.attachment_state())
 
-        # TODO: This may not be necessary but it helped with some funnies
-        # observed during testing. At some point run a bunch of builds without
-        # the delay to see if it breaks anything.
-        self.log.debug("Waiting 20 seconds for EBS attachment to stabilize")
-        sleep(20)
+            # EC2 can report the attachment before the guest kernel has
+            # created the device node, so wait for that rather than a fixed
+            # delay.
+            self.log.debug("Waiting for /dev/xvdh to appear on the instance")
+            yield self.waiter.until_task(
+                lambda: self._remote_succeeds_task('test -b /dev/xvdh'),
+                120, '/dev/xvdh to appear')
 
         # Decompress image into new EBS volume
         self.log.debug("Copying file into volume")
+        with self.span('upload', volume=volume.id, image_size=filesize,
+                       codec=codec.name, workers=workers) as span:
+            # Logs and traces progress, and kills the upload if it stalls
+            meter = process_utils.ProgressMeter(log=self.log,
+                what='Upload to %s' % volume.id, report=span.progress)
+            # Either way the stream is fed from Python, so the upload needs
+            # a thread of its own
+            try:
+                if sparse or workers > 1 or codec.in_process or parent:
+                    sent = yield lifecycle.Call(self._upload_extents, filename,
+                        '/dev/xvdh', codec, sparse, workers, extents, meter)
+                else:
+                    sent = yield lifecycle.Call(self._upload_stream, filename,
+                        '/dev/xvdh', codec, meter)
+            finally:
+                codec.close()
+            meter.show()
+            span.set(bytes=sent, rate=meter.rate())
 
-        # This is big and hairy - it also works, and avoids temporary storage
-        # on the local and remote side of this activity
-        command = 'gzip -c %s | ' % filename
-        command += 'ssh -i %s -F /dev/null  -o ServerAliveInterval=30 -o StrictHostKeyChecking=no ' % self.key_file_object.name
-        command += '-o ConnectTimeout=30 -o UserKnownHostsFile=/dev/null -o PasswordAuthentication=no '
-        command += 'root@%s "gzip -d -c | dd of=/dev/xvdh bs=4k"' % self.instance.public_dns_name
-
-        self.log.debug("Command will be:\n%s\n" % command)
-        self.log.debug("Running.  This may take some time.")
-        process_utils.subprocess_check_output([ command ], shell=True)
-
-        # Sync before snapshot
-        process_utils.ssh_execute_command(self.instance.public_dns_name,
-            self.key_file_object.name, "sync")
+            # Sync before snapshot
+            yield self._execute_task("sync")
 
         # Snapshot EBS volume
         self.log.debug("Taking snapshot of volume (%s)" % volume.id)
-        snapshot = self.conn.create_snapshot(volume.id,
-            'EBSHelper snapshot of file "%s"' % filename)
+        with self.span('snapshot', volume=volume.id) as span:
+            snapshot = yield lifecycle.Call(self.conn.create_snapshot,
+                volume.id, 'EBSHelper snapshot of file "%s"' % filename)
+            yield lifecycle.Call(self._created, 'snapshot', snapshot.id)
+            span.set(snapshot=snapshot.id)
 
-        # This can take a _long_ time - wait up to 20 minutes
-        self.log.debug(
-            "Waiting up to 1200 seconds for snapshot (%s) to become completed" %
-            snapshot.id)
-        for i in range(120):
-            safe_call(snapshot.update, (), self.log, die=True)
-            if snapshot.status == "completed":
-                snapshot.add_tag('Name', resource_tag)
-                break
+            # This can take a _long_ time - wait up to 20 minutes
             self.log.debug(
-                "Snapshot progress(%s) - status (%s) is not 'completed': %d/1200" %
-                (str(snapshot.progress), snapshot.status, i*10))
-            sleep(10)
+                "Waiting up to 1200 seconds for snapshot (%s) to become completed" %
+                snapshot.id)
+            yield lifecycle.Wait(self.waiter, snapshot, 'completed', 1200,
+                failure=('error',), state=lambda s: s.status,
+                detail=lambda s: 'progress (%s)' % s.progress)
+        yield lifecycle.Call(snapshot.add_tag, 'Name', resource_tag)
         self.log.debug("Successful creation of snapshot (%s)" % snapshot.id)
+        yield lifecycle.Call(manifest_utils.save_manifest, self.region.name,
+            snapshot.id, manifest, self.manifest_dir)
+        yield lifecycle.Call(self._keep, [ snapshot.id ])
         self.log.debug("Detaching volume (%s)" % volume.id)
-        safe_call(volume.detach, (), self.log)
+        with self.span('volume-cleanup', volume=volume.id):
+            yield lifecycle.Call(safe_call, volume.detach, (), self.log)
 
-        self.log.debug(
-            "Waiting up to 120 seconds for %s to become detached (available)" %
-            volume.id)
-        for i in range(12):
-            safe_call(volume.update, (), self.log, die=True)
-            if volume.status == "available":
-                break
-            self.log.debug("Volume status (%s) - is not 'available': %d/120" %
-                (volume.status, i*10))
-            sleep(10)
-        self.log.debug("Deleting volume")
-        safe_call(volume.delete, (), self.log, die=True)
-        return snapshot.id
+            self.log.debug(
+                "Waiting up to 120 seconds for %s to become detached (available)" %
+                volume.id)
+            yield lifecycle.Wait(self.waiter, volume, 'available', 120,
+                state=lambda v: v.status)
+            self.log.debug("Deleting volume")
+            yield lifecycle.Call(self._release, volume.delete, volume.id,
+                die=True)
+        raise lifecycle.Return(snapshot.id)
+
+    def direct(self):
+        """
+        Return the connection to the EBS direct APIs.
+        """
+        if not self.direct_conn:
+            self.direct_conn = ebs_direct.EBSDirectConnection(self.region.name)
+        return self.direct_conn
+
+    def direct_to_snapshot(self, filename, threads=ebs_direct.THREADS,
+                           parent=None):
+        """
+        Write filename straight into a new snapshot with the EBS direct APIs,
+        no utility instance needed. parent is as for file_to_snapshot().
+        """
+        return lifecycle.run(self.direct_to_snapshot_task(filename, threads,
+            parent))
+
+    def direct_to_snapshot_task(self, filename, threads=ebs_direct.THREADS,
+                                parent=None):
+        """
+        Lifecycle task version of direct_to_snapshot().
+        """
+        if not os.path.isfile(filename):
+            raise Exception("Filename (%s) is not a file" % filename)
+        with self.span('direct_to_snapshot',
+                       image_size=os.path.getsize(filename), threads=threads,
+                       parent=parent):
+            snapshot_id = yield self._direct_to_snapshot_task(filename,
+                threads, parent)
+        raise lifecycle.Return(snapshot_id)
+
+    def _direct_to_snapshot_task(self, filename, threads, parent):
+        filesize = os.path.getsize(filename)
+        manifest, parent, extents = yield self._manifest_task(filename,
+            parent)
+        if parent and not extents:
+            self.log.debug("Image unchanged since snapshot (%s)" % parent)
+            raise lifecycle.Return(parent)
+        indexes = None
+        if parent:
+            # Only the blocks that changed are written over the parent's
+            indexes = ebs_direct.extent_blocks(extents)
+        uploader = ebs_direct.DirectUploader(self.direct(), threads)
+        with self.span('direct-upload', image_size=filesize, threads=threads,
+                       parent=parent) as span:
+            meter = process_utils.ProgressMeter(log=self.log,
+                what='Upload of %s' % filename, report=span.progress)
+            snapshot_id, sent = yield lifecycle.Call(uploader.upload,
+                filename, volume_size(filesize),
+                'EBSHelper snapshot of file "%s"' % filename,
+                { 'Name': resource_tag }, parent, indexes, meter,
+                lambda snapshot_id: self._created('snapshot', snapshot_id))
+            meter.show()
+            span.set(snapshot=snapshot_id, bytes=sent, rate=meter.rate())
+
+        with self.span('snapshot', snapshot=snapshot_id):
+            snapshots = yield lifecycle.Call(self.conn.get_all_snapshots,
+                [ snapshot_id ])
+            self.log.debug(
+                "Waiting up to 1200 seconds for snapshot (%s) to become completed" %
+                snapshot_id)
+            yield lifecycle.Wait(self.waiter, snapshots[0], 'completed', 1200,
+                failure=('error',), state=lambda s: s.status,
+                detail=lambda s: 'progress (%s)' % s.progress)
+        self.log.debug("Successful creation of snapshot (%s)" % snapshot_id)
+        yield lifecycle.Call(manifest_utils.save_manifest, self.region.name,
+            snapshot_id, manifest, self.manifest_dir)
+        yield lifecycle.Call(self._keep, [ snapshot_id ])
+        raise lifecycle.Return(snapshot_id)
+
+    def _remote_succeeds(self, command, user='root'):
+        try:
+            self.session(user=user).execute(command)
+        except Exception:
+            return False
+        return True
+
+    def _remote_succeeds_task(self, command, user='root'):
+        output, retcode = yield self._execute_task(command, user=user,
+            check=False)
+        raise lifecycle.Return(retcode == 0)
 
     def wait_for_ec2_ssh_access(self, guestaddr, sshprivkey):
+        lifecycle.run(self.wait_for_ec2_ssh_access_task(guestaddr, sshprivkey))
+
+    def wait_for_ec2_ssh_access_task(self, guestaddr, sshprivkey):
         self.log.debug("Waiting for SSH access to EC2 instance (User: %s)" %
             self.user)
-        for i in range(300):
-            if i % 10 == 0:
-                self.log.debug("Waiting for EC2 ssh access: %d/300" % (i))
-            try:
-                process_utils.ssh_execute_command(guestaddr, sshprivkey,
-                    "/bin/true", user=self.user)
-                self.log.debug('reached the instance as %s using %s' %
-                    (self.user, sshprivkey))
-                sleep(5)
-                break
-            except:
-                pass
-            sleep(1)
-        if i == 299:
-            raise Exception(
-                "Unable to gain ssh access after 300 seconds - aborting")
+        # Brings up the master connection later commands will share
+        session = self.session(guestaddr, sshprivkey, self.user)
+        yield self.waiter.until_task(lambda: self._connect_task(session),
+            300, 'ssh access to %s' % guestaddr)
+        self.log.debug('reached the instance as %s using %s' %
+            (self.user, sshprivkey))
 
     def wait_for_ec2_instance_start(self, instance):
         self.log.debug("Waiting for EC2 instance to become active")
-        for i in range(300):
-            if i % 10 == 0:
-                self.log.debug("Waiting for EC2 instance to start: %d/300" % i)
-                retval = safe_call(instance.update, [], self.log)
-                if type(retval) == Exception:
-                    safe_call(self.instance.terminate, [], self.log)
-                    break
-            if instance.state == u'running':
-                break
-            sleep(1)
-
-        if instance.state != u'running':
-            self.status="FAILED"
-            safe_call(self.instance.terminate, [], self.log)
-            raise RuntimeException(
-                "Instance failed to start after 300 seconds - stopping")
+        wait_for_ec2_instance_state(instance, self.log, 'running', 300,
+            waiter=self.waiter)
 
     def enable_root(self,guestaddr, sshprivkey, user, prefix):
+        lifecycle.run(self.enable_root_task(guestaddr, sshprivkey, user,
+            prefix))
+
+    def enable_root_task(self, guestaddr, sshprivkey, user, prefix):
         for cmd in ('mkdir -p /root/.ssh',
                     'chmod 600 /root/.ssh',
                     'cp -f /home/%s/.ssh/authorized_keys /root/.ssh' % user,
                     'chmod 600 /root/.ssh/authorized_keys'):
-            process_utils.ssh_execute_command(
-                guestaddr, sshprivkey, cmd, user=user, prefix=prefix)
-        stdout, stderr, retcode = process_utils.ssh_execute_command(
-            guestaddr, sshprivkey, '/bin/id')
+            yield self._execute_task(cmd, guestaddr, sshprivkey, user, prefix)
+        stdout, retcode = yield self._execute_task('/bin/id', guestaddr,
+            sshprivkey, 'root')
         if not re.search('uid=0', stdout):
             raise Exception('Running /bin/id on %s as root: %s' %
                 (guestaddr, stdout))
+
+class UtilityPool(object):
+    """
+    Keep up to size utility instances running in a region (and optionally a
+    single availability zone), already keyed and root enabled, so uploads
+    can lease one instead of booting their own. Keys are kept in directory
+    and instances are tagged, so a pool left behind by a crashed run can be
+    picked up again with recover(). Instances idle for longer than
+    idle_timeout seconds are terminated by reap(), which only runs as part
+    of lease() and recover(); nothing reaps them in the background.
+    """
+
+    def __init__(self, ec2_region, size=1, idle_timeout=1800, zone=None,
+                 directory=POOL_DIR, **helper_args):
+        self.log = logging.getLogger('%s.%s' %
+            (__name__, self.__class__.__name__))
+        self.region = ec2_region
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.zone = zone
+        self.directory = directory
+        self.helper_args = helper_args
+        self.lock = threading.Lock()
+        # (idle since, EBSHelper) for every instance not leased out
+        self.idle = []
+        self.leased = 0
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+
+    def _new_helper(self):
+        return EBSHelper(self.region, **self.helper_args)
+
+    def _held_elsewhere(self, instance):
+        """
+        True if instance belongs to the pool of a process that is still
+        running, this one included. Those on other hosts are taken to be,
+        as there is no telling.
+        """
+        owner = instance.tags.get(POOL_OWNER_TAG)
+        if not owner:
+            return False
+        host, sep, pid = owner.rpartition(':')
+        if host != socket.gethostname():
+            return True
+        return pid.isdigit() and journal_utils.pid_alive(int(pid))
+
+    def _start(self):
+        helper = self._new_helper()
+        try:
+            helper.start_ami(key_dir=self.directory, placement=self.zone)
+            helper.instance.add_tag(POOL_TAG, helper.key_name)
+            helper.instance.add_tag(POOL_OWNER_TAG, self.owner)
+            # Outlives this run, to be recovered by later ones
+            helper.journal.hand_over(helper.region.name, [ helper.instance.id,
+                helper.security_group.id, helper.key_name ])
+        except:
+            safe_call(helper.terminate_ami, (), self.log)
+            raise
+        self.log.debug("Started pooled utility instance %s" %
+            helper.instance.id)
+        return helper
+
+    def _retire(self, helper):
+        self.log.debug("Retiring pooled utility instance %s" %
+            helper.instance.id)
+        safe_call(helper.terminate_ami, (), self.log)
+
+    def fill(self):
+        """
+        Start instances until the pool holds size of them.
+        """
+        self.lock.acquire()
+        try:
+            missing = self.size - len(self.idle) - self.leased
+        finally:
+            self.lock.release()
+        threads = [ threading.Thread(target=self._fill_one)
+                    for i in range(missing) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def _fill_one(self):
+        try:
+            self._put(self._start())
+        except Exception, e:
+            self.log.warning("Failed to start a pooled instance: %s" % e)
+
+    def _put(self, helper):
+        # Idle instances keep no ssh masters; the next lease starts its own
+        helper.close_sessions()
+        helper.instance.add_tag(POOL_IDLE_TAG, str(int(time())))
+        self.lock.acquire()
+        try:
+            self.idle.append((time(), helper))
+        finally:
+            self.lock.release()
+
+    def lease(self):
+        """
+        Return an EBSHelper with a running utility instance, taken from the
+        pool if one is idle and healthy, otherwise newly started.
+        """
+        self.reap()
+        while True:
+            self.lock.acquire()
+            try:
+                if not self.idle:
+                    self.leased += 1
+                    break
+                # Most recently used first, to let the others idle out
+                since, helper = self.idle.pop()
+                self.leased += 1
+            finally:
+                self.lock.release()
+            if helper._remote_succeeds('/bin/true'):
+                self.log.debug("Leased pooled utility instance %s" %
+                    helper.instance.id)
+                return helper
+            self._release_slot()
+            self._retire(helper)
+        try:
+            return self._start()
+        except:
+            self._release_slot()
+            raise
+
+    def _release_slot(self):
+        self.lock.acquire()
+        try:
+            self.leased -= 1
+        finally:
+            self.lock.release()
+
+    def release(self, helper, healthy=True):
+        """
+        Hand a leased helper back. Unhealthy ones, and any beyond size, are
+        terminated.
+        """
+        self._release_slot()
+        self.lock.acquire()
+        try:
+            keep = healthy and len(self.idle) + self.leased < self.size
+        finally:
+            self.lock.release()
+        if keep:
+            self._put(helper)
+        else:
+            self._retire(helper)
+
+    @contextmanager
+    def leased_helper(self):
+        """
+        Lease a helper for the duration of a with block. It goes back in the
+        pool unless the block raised.
+        """
+        helper = self.lease()
+        try:
+            yield helper
+        except:
+            self.release(helper, healthy=False)
+            raise
+        self.release(helper)
+
+    def reap(self):
+        """
+        Terminate instances that have been idle for longer than idle_timeout.
+        """
+        now = time()
+        self.lock.acquire()
+        try:
+            expired = [ h for since, h in self.idle
+                        if now - since > self.idle_timeout ]
+            self.idle = [ (since, h) for since, h in self.idle
+                          if now - since <= self.idle_timeout ]
+        finally:
+            self.lock.release()
+        for helper in expired:
+            self._retire(helper)
+
+    def recover(self):
+        """
+        Adopt running pool instances left behind by earlier runs whose keys
+        we still have, up to size of them, and terminate the rest along with
+        those we can no longer reach. Instances held by the pool of a live
+        process are left to it.
+        """
+        helper = self._new_helper()
+        filters = { 'tag-key': POOL_TAG, 'instance-state-name': 'running' }
+        if self.zone:
+            filters['availability-zone'] = self.zone
+        reservations = safe_call(lambda: helper.conn.get_all_instances(
+            filters=filters), (), self.log)
+        if reservations == 'ERROR':
+            return
+        for instance in [ i for r in reservations for i in r.instances ]:
+            if self._held_elsewhere(instance):
+                self.log.debug("Pooled utility instance %s is held by %s" %
+                    (instance.id, instance.tags[POOL_OWNER_TAG]))
+                continue
+            key_name = instance.tags[POOL_TAG]
+            key_path = os.path.join(self.directory, '%s.pem' % key_name)
+            adopted = self._new_helper()
+            adopted.instance = instance
+            adopted.key_name = key_name
+            groups = safe_call(lambda: adopted.conn.get_all_security_groups(
+                group_ids=[ g.id for g in instance.groups ]), (), self.log)
+            if groups != 'ERROR' and groups:
+                adopted.security_group = groups[0]
+            if os.path.exists(key_path):
+                adopted.key_file_object = open(key_path)
+                if adopted._remote_succeeds('/bin/true'):
+                    since = float(instance.tags.get(POOL_IDLE_TAG, time()))
+                    self.lock.acquire()
+                    try:
+                        room = len(self.idle) + self.leased < self.size
+                        if room:
+                            self.idle.append((since, adopted))
+                    finally:
+                        self.lock.release()
+                    if room:
+                        adopted.close_sessions()
+                        instance.add_tag(POOL_OWNER_TAG, self.owner)
+                        self.log.debug(
+                            "Recovered pooled utility instance %s" %
+                            instance.id)
+                        continue
+            else:
+                adopted.key_file_object = NamedTemporaryFile()
+            self._retire(adopted)
+        self.reap()
+
+    def close(self):
+        """
+        Terminate every idle instance in the pool.
+        """
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = []
+        finally:
+            self.lock.release()
+        for since, helper in idle:
+            self._retire(helper)
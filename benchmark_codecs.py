@@ -0,0 +1,147 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from optparse import OptionParser
+import filecmp
+import logging
+import os
+import pipes
+import re
+import sys
+from tempfile import NamedTemporaryFile
+from time import time
+
+import compress_utils
+import upload_utils
+
+def get_opts():
+    usage = """%prog [options] [image_file]
+
+Push a disk image through each compression codec over a loopback pipe into
+dd, the way ami_from_disk_image.py uploads it, and report how fast each one
+is and how much it sends. Without an image file a synthetic one is used."""
+    parser = OptionParser(usage=usage)
+    parser.add_option('-c', '--codecs',
+        default=','.join(compress_utils.AUTO_CANDIDATES),
+        help='comma separated codecs to try (%default)')
+    parser.add_option('-i', '--image-size', default=256, type='int',
+        metavar='MiB', help='size of the synthetic image (256)')
+    parser.add_option('-w', '--workers', default=1, type='int',
+        help='number of parallel streams (1)')
+    parser.add_option('-l', '--link', default=None, type='float',
+        metavar='MiB/s', help='also estimate upload times over a link this '
+        'fast, and show what auto would pick for it')
+    parser.add_option('--verify', default=False, action='store_true',
+        help='check that what comes out matches the image')
+    opts, args = parser.parse_args()
+    if len(args) > 1:
+        parser.error('Only one image file, please')
+    if args and not os.path.isfile(args[0]):
+        parser.error('Could not find %s' % args[0])
+    codecs = []
+    for name in opts.codecs.split(','):
+        try:
+            codec = compress_utils.get_codec(name)
+        except Exception, e:
+            parser.error(str(e))
+        if codec.available():
+            codecs.append(codec)
+        else:
+            print >> sys.stderr, 'Skipping %s, it is not installed' % name
+    return opts, codecs, args and args[0] or None
+
+def make_image(size_mib):
+    """
+    Return a sparse image file of size_mib where every fourth MiB holds
+    data, alternately random and text-like.
+    """
+    image = NamedTemporaryFile(prefix='benchmark-', suffix='.raw')
+    image.truncate(size_mib * 1024 * 1024)
+    text = open(__file__).read()
+    text = (text * (1024 * 1024 // len(text) + 1))[:1024 * 1024]
+    for offset in range(0, size_mib, 4):
+        image.seek(offset * 1024 * 1024)
+        if offset % 8:
+            image.write(text)
+        else:
+            image.write(os.urandom(1024 * 1024))
+    image.flush()
+    return image
+
+def run_codec(codec, filename, extents, workers, verify):
+    """
+    Upload extents of filename through codec into a scratch file and return
+    (seconds, bytes of data, bytes on the wire).
+    """
+    target = NamedTemporaryFile(prefix='benchmark-', suffix='.out')
+    stats = NamedTemporaryFile(prefix='benchmark-', suffix='.dd')
+    try:
+        target.truncate(os.path.getsize(filename))
+        command = 'dd bs=64k 2>>%s' % pipes.quote(stats.name)
+        if codec.compress:
+            command = codec.compress + ' | ' + command
+        if codec.decompress:
+            command += ' | ' + codec.decompress
+        command += ' | ' + upload_utils.SPARSE_WRITER % {
+            'device': pipes.quote(target.name), 'bs': upload_utils.BLOCK_SIZE }
+        started = time()
+        try:
+            sent = upload_utils.upload_extents(filename, extents, command,
+                workers, wrap=codec.wrap)
+        finally:
+            codec.close()
+        elapsed = time() - started
+        # Every stream appends its dd summary
+        wire = sum([ int(n) for n in
+                     re.findall(r'^(\d+) bytes', open(stats.name).read(),
+                                re.MULTILINE) ])
+        if verify and not filecmp.cmp(filename, target.name, shallow=False):
+            raise Exception('%s did not reproduce the image' % codec.name)
+    finally:
+        target.close()
+        stats.close()
+    return elapsed, sent, wire
+
+if __name__ == '__main__':
+    opts, codecs, image_file = get_opts()
+    logging.basicConfig(level=logging.ERROR, format='%(message)s')
+    image = None
+    if not image_file:
+        image = make_image(opts.image_size)
+        image_file = image.name
+    try:
+        extents = upload_utils.data_extents(image_file)
+        print '%-8s %8s %8s %10s %7s' % ('codec', 'wall (s)', 'MiB/s',
+            'wire MiB', 'ratio') + (opts.link and ' %9s' % 'link (s)' or '')
+        for codec in codecs:
+            elapsed, sent, wire = run_codec(codec, image_file, extents,
+                opts.workers, opts.verify)
+            line = '%-8s %8.1f %8.1f %10.1f %7.2f' % (codec.name, elapsed,
+                sent / 1024.0 ** 2 / max(elapsed, 0.001), wire / 1024.0 ** 2,
+                float(wire) / max(sent, 1))
+            if opts.link:
+                # Whichever of compressing and sending is slower sets the pace
+                line += ' %9.1f' % max(elapsed,
+                    wire / (opts.link * 1024.0 ** 2))
+            print line
+        if opts.link:
+            sample = compress_utils.sample_image(image_file, extents)
+            chosen = compress_utils.choose_codec(codecs, sample,
+                opts.link * 1024.0 ** 2)
+            print
+            print 'auto would pick %s' % chosen.name
+    finally:
+        if image:
+            image.close()
@@ -0,0 +1,244 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from optparse import OptionParser
+import logging
+import os
+import shutil
+import sys
+import threading
+from tempfile import NamedTemporaryFile, mkdtemp
+from time import sleep, time
+
+import aws_utils
+from aws_utils import EBSHelper, AMIHelper, UTILITY_AMIS
+from fake_ec2 import FakeEC2, FakeSSHSession
+import journal_utils
+import lifecycle
+from scheduler import TestScheduler
+import trace_utils
+
+def get_opts():
+    usage = """%prog [options]
+
+Run the seed image upload and a batch of installs against an in-process fake
+of EC2 and report wall time, API calls and thread usage for each stage."""
+    parser = OptionParser(usage=usage)
+    parser.add_option('-n', '--installs', default=10, type='int',
+        help='number of installs to run at once (10)')
+    parser.add_option('-m', '--mode', default='threads',
+        type='choice', choices=('threads', 'engine'),
+        help='run installs on a thread each, or as lifecycle tasks (threads)')
+    parser.add_option('-j', '--jobs', default=None, type='int',
+        help='scheduler threads, or engine pool threads (one per install, 4)')
+    parser.add_option('-s', '--scale', default=0.01, type='float',
+        help='multiply the simulated latencies by this (0.01)')
+    parser.add_option('--scale-polling', default=False, action='store_true',
+        help='scale the waiter and poller intervals the same way')
+    parser.add_option('-t', '--throttle', default=0, type='float',
+        help='requests per second before EC2 starts refusing them (no limit)')
+    parser.add_option('-b', '--burst', default=50, type='int',
+        help='requests allowed in a burst above the throttle (50)')
+    parser.add_option('-i', '--image-size', default=256, type='int',
+        metavar='MiB', help='size of the sparse seed image (256)')
+    parser.add_option('-w', '--workers', default=1, type='int',
+        help='number of parallel upload streams (1)')
+    parser.add_option('-d', '--direct', default=False, action='store_true',
+        help='upload the seed image with the EBS direct APIs')
+    parser.add_option('--build', default=0, type='float', metavar='SECONDS',
+        help='simulated seconds it takes to build the seed image (0)')
+    parser.add_option('-p', '--pipelined', default=False,
+        action='store_true', help='boot the utility instance and create its '
+        'volume while the seed image is built')
+    parser.add_option('-r', '--region', default='us-east-1',
+        help='region to pretend to be in (us-east-1)')
+    parser.add_option('--trace', default=None, metavar='FILE',
+        help='append per-phase timings to FILE (see trace_summary.py)')
+    parser.add_option('-v', '--verbose', default=False, action='store_true',
+        help='show the helpers\' debug output')
+    opts = parser.parse_args()[0] # no positional arguments
+    if opts.jobs is None:
+        opts.jobs = opts.installs if opts.mode == 'threads' else 4
+    if opts.pipelined and opts.direct:
+        parser.error('--direct does not use a utility instance')
+    return opts
+
+class ThreadMonitor(threading.Thread):
+    """
+    Sample the number of live threads until stopped.
+    """
+
+    def __init__(self, interval=0.05):
+        threading.Thread.__init__(self, name='thread-monitor')
+        self.daemon = True
+        self.interval = interval
+        self.peak = 0
+        self.running = True
+
+    def reset(self):
+        self.peak = threading.active_count() - 1
+
+    def run(self):
+        while self.running:
+            # Not counting ourselves
+            self.peak = max(self.peak, threading.active_count() - 1)
+            sleep(self.interval)
+
+def make_image(size_mib):
+    """
+    Return a sparse image file of size_mib with a MiB of data every 16.
+    """
+    image = NamedTemporaryFile(prefix='benchmark-', suffix='.raw')
+    image.truncate(size_mib * 1024 * 1024)
+    for offset in range(0, size_mib, 16):
+        image.seek(offset * 1024 * 1024)
+        image.write(os.urandom(1024 * 1024))
+    image.flush()
+    return image
+
+def make_helper(cls, cloud, opts):
+    # None of what the fake makes is real, so it stays out of the user's
+    # own journal and manifests
+    helper = cls(opts.region, conn=cloud.connect(opts.region),
+        journal=opts.journal)
+    if isinstance(helper, EBSHelper):
+        helper.manifest_dir = opts.manifest_dir
+    if opts.scale_polling:
+        helper.waiter.initial *= opts.scale
+        helper.waiter.max_interval *= opts.scale
+        helper.waiter.poller.min_interval = min(
+            helper.waiter.poller.min_interval, 1.0 * opts.scale)
+    return helper
+
+def stage(name, cloud, monitor, func, *args):
+    """
+    Run func(*args) and return a report on it.
+    """
+    monitor.reset()
+    calls = cloud.total_calls()
+    throttled = cloud.throttled
+    started = time()
+    result = func(*args)
+    return result, { 'stage': name, 'wall': time() - started,
+                     'calls': cloud.total_calls() - calls,
+                     'throttled': cloud.throttled - throttled,
+                     'threads': monitor.peak }
+
+def build(opts):
+    """
+    Stand in for building the seed image.
+    """
+    sleep(opts.build * opts.scale)
+    return make_image(opts.image_size)
+
+def build_task(opts, images):
+    image = yield lifecycle.Call(build, opts)
+    images.append(image)
+    raise lifecycle.Return(image.name)
+
+def seed(cloud, opts):
+    ebs_helper = make_helper(EBSHelper, cloud, opts)
+    images = []
+    try:
+        if opts.pipelined:
+            snapshot = lifecycle.run(ebs_helper.pipelined_upload_task(
+                build_task(opts, images), opts.image_size * 1024 * 1024,
+                workers=opts.workers), threads=4)
+        else:
+            images.append(build(opts))
+            if opts.direct:
+                ebs_helper.direct_conn = cloud.connect_direct(opts.region)
+                snapshot = ebs_helper.direct_to_snapshot(images[0].name)
+            else:
+                snapshot = ebs_helper.safe_upload_and_shutdown(
+                    images[0].name, workers=opts.workers)
+    finally:
+        for image in images:
+            image.close()
+    ami_helper = make_helper(AMIHelper, cloud, opts)
+    return ami_helper.register_ebs_ami(snapshot), 0
+
+def install(cloud, opts, ami):
+    return make_helper(AMIHelper, cloud, opts).launch_wait_snapshot(ami,
+        'ks=http://example.com/test.ks')
+
+def installs_threads(cloud, opts, ami):
+    scheduler = TestScheduler(workers=opts.jobs)
+    for i in range(opts.installs):
+        scheduler.submit('install-%d' % i, install, (cloud, opts, ami))
+    jobs = scheduler.run()
+    return [ j.result for j in jobs ], len([ j for j in jobs if j.error ])
+
+def installs_engine(cloud, opts, ami):
+    engine = lifecycle.LifecycleEngine(threads=opts.jobs)
+    try:
+        tasks = engine.run_all([ make_helper(AMIHelper, cloud, opts)
+            .launch_wait_snapshot_task(ami, 'ks=http://example.com/test.ks')
+            for i in range(opts.installs) ])
+    finally:
+        engine.close()
+    for task in tasks:
+        if task.error:
+            logging.getLogger('benchmark').error('Install failed: %s' %
+                task.error)
+    return [ t.result for t in tasks ], len([ t for t in tasks if t.error ])
+
+def print_report(reports, cloud):
+    print '%-10s %8s %8s %10s %8s %8s' % ('stage', 'wall (s)', 'calls',
+        'throttled', 'threads', 'failed')
+    for report in reports:
+        print '%-10s %8.1f %8d %10d %8d %8d' % (report['stage'],
+            report['wall'], report['calls'], report['throttled'],
+            report['threads'], report['failed'])
+    print
+    print 'API calls by action:'
+    for action, count in sorted(cloud.calls.items(), key=lambda a: -a[1]):
+        print '  %-32s %6d' % (action, count)
+
+if __name__ == '__main__':
+    opts = get_opts()
+    logging.basicConfig(level=opts.verbose and logging.DEBUG or logging.ERROR,
+        format='%(message)s')
+    if opts.trace:
+        trace_utils.enable(opts.trace)
+    cloud = FakeEC2(scale=opts.scale, throttle=opts.throttle or None,
+        burst=opts.burst, max_instances=opts.installs + 5)
+    cloud.add_image(opts.region, UTILITY_AMIS[opts.region][0])
+    EBSHelper.session_class = FakeSSHSession
+    scratch = mkdtemp(prefix='benchmark-')
+    try:
+        opts.journal = journal_utils.Journal(os.path.join(scratch,
+            'journal.sqlite'))
+        opts.manifest_dir = os.path.join(scratch, 'manifests')
+        monitor = ThreadMonitor()
+        monitor.start()
+
+        reports = []
+        (ami, failed), report = stage('seed', cloud, monitor, seed, cloud,
+            opts)
+        report['failed'] = failed
+        reports.append(report)
+        run_installs = { 'threads': installs_threads,
+                         'engine': installs_engine }[opts.mode]
+        (amis, failed), report = stage('installs', cloud, monitor,
+            run_installs, cloud, opts, ami)
+        report['failed'] = failed
+        reports.append(report)
+        monitor.running = False
+        monitor.join()
+        print_report(reports, cloud)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    sys.exit(failed and 1 or 0)
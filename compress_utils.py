@@ -0,0 +1,260 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Compression codecs for the upload pipeline. A codec is a local compress
+# stage and a remote decompress stage of a shell pipeline, or compresses in
+# Python on the way into the pipe (parallel gzip):
+#
+#     none        no compression
+#     gzip[-N]    gzip at level N (6)
+#     pgzip[-N]   gzip members compressed on a pool of threads, which any
+#                 gzip -d reads as one stream
+#     zstd[-N]    zstd on all cores at level N (3), if both ends have it
+#     lz4         lz4, if both ends have it
+#     auto        the best of the above for this image and link, see
+#                 choose_codec()
+
+import multiprocessing
+import pipes
+import subprocess
+import zlib
+from collections import deque
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+from time import time
+
+import process_utils
+
+# Input handed to each pgzip worker at a time
+PGZIP_CHUNK = 4 * 1024 * 1024
+
+# How much of an image choose_codec() looks at
+SAMPLE_COUNT = 16
+SAMPLE_SIZE = 1024 * 1024
+
+def _gzip_member(args):
+    """
+    Compress data into a complete gzip member. Runs in the pool; zlib lets
+    go of the GIL while it works, so the threads do use all the cores.
+    """
+    data, level = args
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+class ParallelGzipWriter(object):
+    """
+    A file-like object that gzips what is written to it on a thread pool
+    and writes the members to out in order. At most depth chunks are in
+    flight. close() flushes everything but leaves out open.
+    """
+
+    def __init__(self, out, pool, level=6, chunk_size=PGZIP_CHUNK, depth=4):
+        self.out = out
+        self.pool = pool
+        self.level = level
+        self.chunk_size = chunk_size
+        self.depth = depth
+        self.buf = []
+        self.buffered = 0
+        self.pending = deque()
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.chunk_size:
+            self._submit()
+
+    def _submit(self):
+        data = ''.join(self.buf)
+        self.buf = []
+        self.buffered = 0
+        self.pending.append(self.pool.apply_async(_gzip_member,
+            ((data, self.level),)))
+        while len(self.pending) > self.depth:
+            self.out.write(self.pending.popleft().get())
+
+    def close(self):
+        if self.buffered:
+            self._submit()
+        while self.pending:
+            self.out.write(self.pending.popleft().get())
+
+class Codec(object):
+    """
+    compress and decompress are shell pipeline stages (None for none);
+    tools must be installed on both ends for the codec to work. Codecs that
+    compress in_process need the upload stream to be written from Python.
+    """
+
+    in_process = False
+
+    def __init__(self, name, compress=None, decompress=None, tools=()):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+        self.tools = tools
+
+    def available(self):
+        """
+        Whether the local end has what it needs.
+        """
+        return not [ t for t in self.tools if not find_executable(t) ]
+
+    def wrap(self, out):
+        """
+        Return what the upload stream should be written to instead of the
+        pipe out, if anything.
+        """
+        return None
+
+    def close(self):
+        pass
+
+class ParallelGzipCodec(Codec):
+    """
+    gzip on a pool of threads in this process. The pool is shared between
+    all the streams of a parallel upload. (A process pool would hand the
+    upload pipes it inherits to its workers, and the remote end would never
+    see the stream end.)
+    """
+
+    in_process = True
+
+    def __init__(self, name, level=6, threads=None):
+        Codec.__init__(self, name, None, 'gzip -d -c', ('gzip',))
+        self.level = level
+        self.threads = threads or multiprocessing.cpu_count()
+        self.pool = None
+
+    def wrap(self, out):
+        if not self.pool:
+            self.pool = ThreadPool(self.threads)
+        return ParallelGzipWriter(out, self.pool, self.level,
+            depth=2 * self.threads)
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+def get_codec(name):
+    """
+    Return the Codec called name (see the top of this file).
+    """
+    kind, dash, level = name.partition('-')
+    try:
+        level = level and int(level)
+    except ValueError:
+        raise Exception('Unknown compression level in %s' % name)
+    if kind == 'none' and not level:
+        return Codec(name)
+    if kind == 'gzip':
+        return Codec(name, 'gzip -c -%d' % (level or 6), 'gzip -d -c',
+            ('gzip',))
+    if kind == 'pgzip':
+        return ParallelGzipCodec(name, level or 6)
+    if kind == 'zstd':
+        return Codec(name, 'zstd -q -c -T0 -%d' % (level or 3),
+            'zstd -q -d -c', ('zstd',))
+    if kind == 'lz4' and not level:
+        return Codec(name, 'lz4 -q -c', 'lz4 -q -d -c', ('lz4',))
+    raise Exception('Unknown compression codec %s' % name)
+
+# What auto chooses between, when they are available
+AUTO_CANDIDATES = ('none', 'lz4', 'zstd-1', 'zstd-3', 'gzip-1', 'gzip-6',
+                   'pgzip-1', 'pgzip-6')
+
+def tools_probe(tools):
+    """
+    Return a shell command that prints which of tools are installed.
+    """
+    return ' '.join([ 'for tool in'] + [ pipes.quote(t) for t in tools ] +
+        [ '; do command -v "$tool" >/dev/null && echo "$tool"; done; true' ])
+
+def sample_image(filename, extents, count=SAMPLE_COUNT, size=SAMPLE_SIZE):
+    """
+    Return count pieces of size bytes spread evenly over the data in extents
+    of filename, joined together.
+    """
+    total = sum([ length for offset, length in extents ])
+    step = max(total // count, size)
+    pieces = []
+    src = open(filename, 'rb')
+    try:
+        position = 0
+        wanted = 0
+        for offset, length in extents:
+            while wanted < position + length and len(pieces) < count:
+                src.seek(offset + wanted - position)
+                pieces.append(src.read(min(size, position + length - wanted)))
+                wanted += step
+            position += length
+    finally:
+        src.close()
+    return ''.join(pieces)
+
+def measure_codec(codec, sample):
+    """
+    Compress sample with codec and return (ratio, bytes of input per
+    second), where ratio is compressed size over original size.
+    """
+    if not sample:
+        return 1.0, float('inf')
+    started = time()
+    if isinstance(codec, ParallelGzipCodec):
+        # One member on one thread, scaled up to the whole pool
+        compressed = _gzip_member((sample, codec.level))
+        speed = len(sample) / max(time() - started, 1e-6) * codec.threads
+        return float(len(compressed)) / len(sample), speed
+    if not codec.compress:
+        return 1.0, float('inf')
+    process = subprocess.Popen(codec.compress, shell=True,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    compressed = process.communicate(sample)[0]
+    if process.returncode:
+        raise Exception("'%s' failed(%d)" % (codec.compress,
+            process.returncode))
+    speed = len(sample) / max(time() - started, 1e-6)
+    return float(len(compressed)) / len(sample), speed
+
+def choose_codec(codecs, sample, link_speed, log=None):
+    """
+    Return the codec in codecs expected to move an image like sample fastest
+    over a link carrying link_speed bytes per second: whichever of
+    compressing and sending is slower limits each codec.
+    """
+    best = None
+    for codec in codecs:
+        ratio, speed = measure_codec(codec, sample)
+        rate = min(speed, link_speed / max(ratio, 1e-6))
+        if log:
+            log.debug('%s: ratio %.2f, %.1f MiB/s compressing, %.1f MiB/s '
+                'expected' % (codec.name, ratio, speed / 1024.0 ** 2,
+                rate / 1024.0 ** 2))
+        if not best or rate > best[0]:
+            best = (rate, codec)
+    return best[1]
+
+def measure_link(command, size=8*1024*1024):
+    """
+    Return how many bytes per second of incompressible data the shell
+    pipeline command (which should discard its input) takes.
+    """
+    data = open('/dev/urandom', 'rb').read(size)
+    started = time()
+    process_utils.subprocess_feed(lambda out: out.write(data), [ command ],
+        shell=True)
+    return size / max(time() - started, 1e-6)
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Following an install through the instance's console output. EC2 hands back
+# the most recent stretch of the serial console (64 KiB at most), so each
+# poll works out what is new since the last one and turns the lines that
+# match the Anaconda markers below into events: progress through the
+# install, a failure, or the start of the final poweroff. EC2 only refreshes
+# the console now and then, so events arrive in bursts.
+
+import logging
+import re
+from time import time
+
+# Kinds of event. Only failures end an install early; warnings are things
+# Anaconda may well get past, such as a mirror that needs another try or a
+# traceback printed by a %post script.
+PROGRESS = 'progress'
+WARNING = 'warning'
+FAILURE = 'failure'
+POWEROFF = 'poweroff'
+
+# (kind, name, pattern), checked in order against each line; the first match
+# wins. The names of the progress markers are the install phases, in the
+# order they come in, bar complete which ends the last of them.
+MARKERS = [
+    # Anaconda's own fatal error dialogs and banners
+    (FAILURE, 'exception', r'An unknown error has occurred|has encountered '
+        r'an (unknown|unrecoverable) error'),
+    (FAILURE, 'kickstart', r'The following (error was found while parsing|'
+        r'problem occurred on line \d+ of) the kickstart'),
+    (FAILURE, 'repository', r'Error populating transaction(?!, retrying)|'
+        r'[Ii]nstallation cannot continue'),
+    (FAILURE, 'panic', r'Kernel panic'),
+    (WARNING, 'traceback', r'Traceback \(most recent call last\)'),
+    (WARNING, 'repository', r'Error (downloading|setting up|populating '
+        r'transaction)|[Uu]nable to (read package metadata|retrieve|'
+        r'download)|Cannot retrieve repository|[Mm]issing (repo|package)'),
+    (PROGRESS, 'setup', r'Starting installer|anaconda .* for .* started|'
+        r'Setting up the installation environment|Running pre-installation '
+        r'(scripts|tasks)'),
+    (PROGRESS, 'storage', r'Creating .* on /dev/|Configuring storage|'
+        r'Creating disklabel|Formatting'),
+    (PROGRESS, 'download', r'Downloading (packages|\d+ RPMs)|Retrieving '
+        r'packages'),
+    (PROGRESS, 'bootloader', r'Installing boot ?loader'),
+    (PROGRESS, 'packages', r'Starting package installation|Installing '
+        r'software|Preparing transaction|Installing (\S+) \((\d+)/(\d+)\)'),
+    (PROGRESS, 'configure', r'Performing post-installation setup tasks|'
+        r'Configuring installed system'),
+    (PROGRESS, 'post', r'Running post-install(ation)? scripts'),
+    (PROGRESS, 'complete', r'Installation complete|Configuration complete'),
+    (POWEROFF, 'poweroff', r'reboot: Power down|System halted|Powering off|'
+        r'Power down\.|Halting system'),
+]
+
+_MARKERS = [ (kind, name, re.compile(pattern))
+             for kind, name, pattern in MARKERS ]
+
+# Characters of the previous output used to find where the new output picks
+# up. Enough that ordinary repeated lines do not match by accident.
+OVERLAP = 256
+
+class ConsoleEvent(object):
+    """
+    A line of console output that matched one of the MARKERS, seen at the
+    given time. For lines about a single package, count and total are the
+    n/m the installer prints.
+    """
+
+    def __init__(self, kind, name, line, seen=None):
+        self.kind = kind
+        self.name = name
+        self.line = line
+        self.seen = seen or time()
+        self.count = None
+        self.total = None
+
+    def __repr__(self):
+        return '<ConsoleEvent %s %s: %s>' % (self.kind, self.name, self.line)
+
+def parse_line(line, seen=None):
+    """
+    Return the ConsoleEvent for line, or None if it is of no interest.
+    """
+    for kind, name, pattern in _MARKERS:
+        match = pattern.search(line)
+        if not match:
+            continue
+        event = ConsoleEvent(kind, name, line.strip(), seen)
+        if name == 'packages' and match.group(3):
+            event.count, event.total = int(match.group(2)), \
+                int(match.group(3))
+        return event
+    return None
+
+def new_output(previous, current):
+    """
+    Return the part of current, a console snapshot, that follows previous.
+    The console is a rolling window, so the start of previous may have
+    scrolled out of current, and current may have restarted altogether.
+    """
+    if not previous:
+        return current
+    if current.startswith(previous):
+        return current[len(previous):]
+    tail = previous[-OVERLAP:]
+    at = current.rfind(tail)
+    if at >= 0:
+        return current[at + len(tail):]
+    # Too much went by between polls to line the two up
+    return current
+
+class ConsoleMonitor(object):
+    """
+    Follow the console of instance_id over conn. Every poll() returns the
+    events since the last one; failure, poweroff, phase and package hold
+    what has been seen so far, and warnings every warning.
+    """
+
+    def __init__(self, conn, instance_id):
+        self.log = logging.getLogger('%s.%s' %
+            (__name__, self.__class__.__name__))
+        self.conn = conn
+        self.instance_id = instance_id
+        self.output = ''
+        self.partial = ''
+        self.events = []
+        self.failure = None
+        self.warnings = []
+        self.poweroff = None
+        self.phase = None
+        self.package = None
+
+    def fetch(self):
+        """
+        Return the console output EC2 has for the instance right now, which
+        is empty until it has something to show.
+        """
+        console = self.conn.get_console_output(self.instance_id)
+        return console and console.output or ''
+
+    def feed(self, output):
+        """
+        Take in a console snapshot and return the new events in it.
+        """
+        text = new_output(self.output, output)
+        self.output = output
+        if not text:
+            return []
+        # The last line may still be on its way
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        events = []
+        for line in lines:
+            event = parse_line(line.rstrip('\r'))
+            if not event:
+                continue
+            events.append(event)
+            if event.kind == FAILURE and not self.failure:
+                self.failure = event
+            elif event.kind == WARNING:
+                self.warnings.append(event)
+            elif event.kind == POWEROFF and not self.poweroff:
+                self.poweroff = event
+            elif event.kind == PROGRESS:
+                self.phase = event.name
+                if event.total:
+                    self.package = event
+        self.events.extend(events)
+        return events
+
+    def poll(self):
+        """
+        Fetch the console and return the new events. Errors fetching it
+        are logged and come back as no events; the next poll tries again.
+        """
+        try:
+            output = self.fetch()
+        except Exception, e:
+            self.log.debug("Could not get the console of %s: %s" %
+                (self.instance_id, e))
+            return []
+        return self.feed(output)
+
+    def done(self):
+        """
+        True once the install has failed or started powering off.
+        """
+        return bool(self.failure or self.poweroff)
@@ -18,37 +18,51 @@
 import guestfs
 from optparse import OptionParser
 import os
-import pycurl
+import download_utils
 import shutil
 from tempfile import mkdtemp
 
-def _create_ext2_image(image_file, image_size=(1024*1024*200)):
+# Install tree paths fetched into the seed image, all at once. Add others
+# (such as images/updates.img) here.
+BOOT_CONTENT = ('images/pxeboot/vmlinuz', 'images/pxeboot/initrd.img')
+
+def _create_ext2_image(image_file, contentdir, image_size=(1024*1024*200)):
     """
-    Create a 200M (default) disk image named image_file.
+    Create a 200M (default) disk image named image_file holding the files in
+    contentdir, using a single libguestfs appliance.
     """
     raw_fs_image=open(image_file,"w")
     raw_fs_image.truncate(image_size)
     raw_fs_image.close()
     g = guestfs.GuestFS()
-    g.add_drive(image_file)
-    g.launch()
-    g.part_disk("/dev/sda","msdos")
-    g.part_set_mbr_id("/dev/sda",1,0x83)
-    g.mkfs("ext2", "/dev/sda1")
-    g.part_set_bootable("/dev/sda", 1, 1)
-    g.sync()
-    #g.shutdown() needed?
+    try:
+        g.add_drive_opts(image_file, format='raw')
+        g.launch()
+        g.part_disk("/dev/sda","msdos")
+        g.part_set_mbr_id("/dev/sda",1,0x83)
+        g.mkfs("ext2", "/dev/sda1")
+        g.part_set_bootable("/dev/sda", 1, 1)
+        g.mount_options ("", "/dev/sda1", "/")
+        g.mkdir_p("/boot/grub")
+        for filename in os.listdir(contentdir):
+            g.upload(os.path.join(contentdir,filename),"/boot/grub/" + filename)
+        g.umount_all()
+        g.sync()
+        g.shutdown()
+    finally:
+        g.close()
 
 def _generate_boot_content(url, dest_dir, cmdline):
     """
     Insert kernel, ramdisk and syslinux.cfg file in dest_dir
     source from url
     """
-    for content in ('vmlinuz', 'initrd.img'):
-        destination = os.path.join(dest_dir, content)
-        source = url + "images/pxeboot/%s" % content
+    downloads = []
+    for content in BOOT_CONTENT:
         print 'Downloading %s' % content
-        http_download_file(source, destination)
+        downloads.append((url + content, os.path.join(dest_dir,
+            os.path.basename(content))))
+    http_download_files(downloads)
 
     pvgrub_conf="""# This file is for use with pv-grub;
 # legacy grub is not installed in this image
@@ -63,49 +77,20 @@ title Anaconda install inside of EC2
     f.write(pvgrub_conf)
     f.close()
 
-def http_download_file(url, filename):
-    fd = os.open(filename,os.O_CREAT | os.O_WRONLY | os.O_TRUNC)
-    try:
-        _http_download_file(url, fd, True)
-    finally:
-        os.close(fd)
-
-def _http_download_file(url, fd, show_progress):
+def http_download_file(url, filename, cache=None):
     """
-    Function to download a file from url to file descriptor fd.
+    Download url to filename by way of the local download cache.
     """
-    class Progress(object):
-        def __init__(self):
-            self.last_k = -1
-
-    def _data(buf):
-        """
-        Function that is called back from the pycurl perform() method to
-        actually write data to disk.
-        """
-        os.write(fd, buf)
+    http_download_files([ (url, filename) ], cache)
 
-    progress = Progress()
-    c = pycurl.Curl()
-    c.setopt(c.URL, url)
-    c.setopt(c.CONNECTTIMEOUT, 5)
-    c.setopt(c.WRITEFUNCTION, _data)
-    c.setopt(c.FOLLOWLOCATION, 1)
-    c.perform()
-    c.close()
-
-def _copy_content_to_image(contentdir, target_image):
+def http_download_files(downloads, cache=None):
     """
-    Copy all files in contentdir to the target image using guestfs.
+    Download a list of (url, filename) pairs concurrently by way of the
+    local download cache.
     """
-    g = guestfs.GuestFS()
-    g.add_drive(target_image)
-    g.launch()
-    g.mount_options ("", "/dev/sda1", "/")
-    g.mkdir_p("/boot/grub")
-    for filename in os.listdir(contentdir):
-        g.upload(os.path.join(contentdir,filename),"/boot/grub/" + filename)
-    g.sync()
+    if not cache:
+        cache = download_utils.ContentCache()
+    cache.fetch_many(downloads)
 
 def generate_install_image(tree_url, image_filename, parameters):
     """
@@ -115,11 +100,11 @@ def generate_install_image(tree_url, image_filename, parameters):
         generate some required configuration in the image (like menu.lst)
         copy in the anaconda bits from the install tree
     """
-    _create_ext2_image(image_filename, image_size=(1024*1024*200))
     tmp_content_dir = mkdtemp()
     try:
         _generate_boot_content(tree_url, tmp_content_dir, parameters)
-        _copy_content_to_image(tmp_content_dir, image_filename)
+        _create_ext2_image(image_filename, tmp_content_dir,
+            image_size=(1024*1024*200))
     finally:
         shutil.rmtree(tmp_content_dir)
 
@@ -16,37 +16,133 @@
 #   limitations under the License.
 
 import guestfs
+import hashlib
 import os
-import pycurl
+import download_utils
 from tempfile import mkdtemp
 
-def _create_ext2_image(image_file, image_size=(1024*1024*200)):
+# Install tree paths fetched into the seed image, all at once. Add others
+# (such as images/updates.img) here.
+BOOT_CONTENT = ('images/pxeboot/vmlinuz', 'images/pxeboot/initrd.img')
+
+# Size of the seed images ImageBuilder makes
+IMAGE_SIZE = 1024*1024*200
+
+def _populate_image(g, device, partition, contentdir):
+    """
+    Partition device, make an ext2 filesystem and copy everything in
+    contentdir into /boot/grub on it.
+    """
+    g.part_disk(device, "msdos")
+    g.part_set_mbr_id(device, 1, 0x83)
+    g.mkfs("ext2", partition)
+    g.part_set_bootable(device, 1, 1)
+    g.mount_options("", partition, "/")
+    g.mkdir_p("/boot/grub")
+    for filename in os.listdir(contentdir):
+        if filename == 'anaconda-seed.raw':
+            continue
+        g.upload(os.path.join(contentdir,filename),"/boot/grub/" + filename)
+    g.umount_all()
+
+def _drive_label(index):
+    # libguestfs drive labels may only contain letters
+    label = ''
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        label = chr(ord('a') + rem) + label
+    return 'seed' + label
+
+class ImageBuilder(object):
     """
-    Create a 200M (default) disk image named image_file.
+    Build seed images with a single libguestfs appliance. Images added before
+    the first build() are attached when the appliance boots; after that they
+    are hot-plugged into the running appliance, so a batch of builds only
+    pays for one boot. Call close() when finished.
     """
-    raw_fs_image=open(image_file,"w")
-    raw_fs_image.truncate(image_size)
-    raw_fs_image.close()
-    g = guestfs.GuestFS()
-    g.add_drive(image_file)
-    g.launch()
-    g.part_disk("/dev/sda","msdos")
-    g.part_set_mbr_id("/dev/sda",1,0x83)
-    g.mkfs("ext2", "/dev/sda1")
-    g.part_set_bootable("/dev/sda", 1, 1)
-    g.sync()
-    #g.shutdown() needed?
+
+    def __init__(self, image_size=IMAGE_SIZE):
+        self.image_size = image_size
+        self.g = None
+        self.launched = False
+        self.count = 0
+        self.pending = []
+
+    def add(self, contentdir):
+        """
+        Create an empty image in contentdir and queue it to be built from the
+        content there. Returns the image name.
+        """
+        name = os.path.join(contentdir, 'anaconda-seed.raw')
+        raw_fs_image=open(name,"w")
+        raw_fs_image.truncate(self.image_size)
+        raw_fs_image.close()
+        if not self.g:
+            self.g = guestfs.GuestFS()
+        label = _drive_label(self.count)
+        try:
+            self.g.add_drive_opts(name, format='raw', label=label)
+        except RuntimeError:
+            if not self.launched:
+                raise
+            # This libguestfs cannot hot-plug; start a fresh appliance
+            self._finish()
+            self.g = guestfs.GuestFS()
+            self.g.add_drive_opts(name, format='raw', label=label)
+        self.count += 1
+        self.pending.append((label, contentdir))
+        return name
+
+    def build(self):
+        """
+        Populate every image added since the last build.
+        """
+        if not self.launched:
+            self.g.launch()
+            self.launched = True
+        for label, contentdir in self.pending:
+            device = '/dev/disk/guestfs/%s' % label
+            _populate_image(self.g, device, device + '1', contentdir)
+        built = [ label for label, contentdir in self.pending ]
+        self.pending = []
+        self.g.sync()
+        # The images are written; do not keep them attached for the rest of
+        # the batch
+        for label in built:
+            try:
+                self.g.remove_drive(label)
+            except (AttributeError, RuntimeError):
+                # This libguestfs cannot hot-unplug; close() lets go of them
+                pass
+
+    def _finish(self):
+        if self.pending:
+            self.build()
+        if self.launched:
+            self.g.shutdown()
+        self.g.close()
+        self.g = None
+        self.launched = False
+
+    def close(self):
+        """
+        Build anything still queued and shut the appliance down.
+        """
+        if self.g:
+            self._finish()
 
 def _generate_boot_content(url, dest_dir, cmdline):
     """
     Insert kernel, ramdisk and syslinux.cfg file in dest_dir
     source from url
     """
-    for content in ('vmlinuz', 'initrd.img'):
-        destination = os.path.join(dest_dir, content)
-        source = url + "images/pxeboot/%s" % content
+    downloads = []
+    for content in BOOT_CONTENT:
         print 'Downloading %s' % content
-        http_download_file(source, destination)
+        downloads.append((url + content, os.path.join(dest_dir,
+            os.path.basename(content))))
+    http_download_files(downloads)
 
     pvgrub_conf="""# This file is for use with pv-grub;
 # legacy grub is not installed in this image
@@ -61,51 +157,66 @@ title Anaconda install inside of EC2
     f.write(pvgrub_conf)
     f.close()
 
-def http_download_file(url, filename):
-    fd = os.open(filename,os.O_CREAT | os.O_WRONLY | os.O_TRUNC)
-    try:
-        _http_download_file(url, fd, True)
-    finally:
-        os.close(fd)
-
-def _http_download_file(url, fd, show_progress):
+def http_download_file(url, filename, cache=None):
     """
-    Function to download a file from url to file descriptor fd.
+    Download url to filename by way of the local download cache.
     """
-    class Progress(object):
-        def __init__(self):
-            self.last_k = -1
+    http_download_files([ (url, filename) ], cache)
 
-    def _data(buf):
-        """
-        Function that is called back from the pycurl perform() method to
-        actually write data to disk.
-        """
-        os.write(fd, buf)
+def http_download_files(downloads, cache=None):
+    """
+    Download a list of (url, filename) pairs concurrently by way of the
+    local download cache.
+    """
+    if not cache:
+        cache = download_utils.ContentCache()
+    cache.fetch_many(downloads)
 
-    progress = Progress()
-    c = pycurl.Curl()
-    c.setopt(c.URL, url)
-    c.setopt(c.CONNECTTIMEOUT, 5)
-    c.setopt(c.WRITEFUNCTION, _data)
-    c.setopt(c.FOLLOWLOCATION, 1)
-    c.perform()
-    c.close()
+def prepare_boot_content(tree_url, parameters):
+    """
+    Download the kernel and ramdisk and write menu.lst into a new temporary
+    directory, which is returned.
+    """
+    tmp_content_dir = mkdtemp()
+    _generate_boot_content(tree_url, tmp_content_dir, parameters)
+    return tmp_content_dir
 
-def _copy_content_to_image(contentdir, target_image):
+def seed_digest(contentdir, region, arch='x86_64'):
     """
-    Copy all files in contentdir to the target image using guestfs.
+    Return a digest of everything that ends up in a seed image built from
+    contentdir, plus where it will be registered. The kernel command line
+    (and so any updates= URL) is covered by menu.lst.
     """
-    g = guestfs.GuestFS()
-    g.add_drive(target_image)
-    g.launch()
-    g.mount_options ("", "/dev/sda1", "/")
-    g.mkdir_p("/boot/grub")
-    for filename in os.listdir(contentdir):
+    digest = hashlib.sha256()
+    for filename in sorted(os.listdir(contentdir)):
         if filename == 'anaconda-seed.raw':
             continue
-        g.upload(os.path.join(contentdir,filename),"/boot/grub/" + filename)
-    g.sync()
+        digest.update(filename + '\0')
+        f = open(os.path.join(contentdir, filename), 'rb')
+        try:
+            for buf in iter(lambda: f.read(1024*1024), ''):
+                digest.update(buf)
+        finally:
+            f.close()
+    digest.update('%s\0%s' % (region, arch))
+    return digest.hexdigest()
+
+def build_image(contentdir, builder=None):
+    """
+    Build the seed image from content made by prepare_boot_content and
+    return its name. Pass an ImageBuilder to reuse its appliance.
+    """
+    if builder:
+        name = builder.add(contentdir)
+        builder.build()
+        return name
+    builder = ImageBuilder()
+    try:
+        name = builder.add(contentdir)
+        builder.build()
+    finally:
+        builder.close()
+    return name
 
 def construct_image(tree_url, parameters):
     """
@@ -115,9 +226,4 @@ def construct_image(tree_url, parameters):
         generate some required configuration in the image (like menu.lst)
         copy in the anaconda bits from the install tree
     """
-    tmp_content_dir = mkdtemp()
-    name = os.path.join(tmp_content_dir, 'anaconda-seed.raw')
-    _create_ext2_image(name, image_size=(1024*1024*200))
-    _generate_boot_content(tree_url, tmp_content_dir, parameters)
-    _copy_content_to_image(tmp_content_dir, name)
-    return name
+    return build_image(prepare_boot_content(tree_url, parameters))
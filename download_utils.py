@@ -0,0 +1,366 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Downloading of install tree artifacts, with a local cache so repeated
+# image builds against the same tree only revalidate what they already have.
+
+import hashlib
+import json
+import logging
+import os
+import pycurl
+import shutil
+from tempfile import mkstemp
+from time import time
+
+CACHE_DIR = os.environ.get('ANACONDA_EC2_CACHE',
+    os.path.expanduser('~/.cache/anaconda-ec2/downloads'))
+
+# A couple of trees' worth of kernels and initrds
+MAX_CACHE_SIZE = 2 * 1024 ** 3
+
+# Files at least twice this size are fetched as parallel Range requests
+SEGMENT_SIZE = 8 * 1024 * 1024
+
+# Most connections opened to the mirror for a single file
+MAX_SEGMENTS = 4
+
+class _Download(object):
+    """
+    State for one URL being fetched into a temporary file.
+    """
+
+    def __init__(self, url, filename, headers=()):
+        self.url = url
+        self.filename = filename
+        self.headers = list(headers)
+        self.tmp = None
+        self.size = None
+        self.ranges = False
+        self.segmented = False
+        self.code = None
+        self.response = {}
+
+class _Transfer(object):
+    """
+    One curl handle fetching a byte range (or all) of a download into its
+    temporary file. Each transfer has its own descriptor positioned at its
+    offset, which gives us pwrite semantics without os.pwrite.
+    """
+
+    def __init__(self, download, offset=0, length=None, headers=(),
+                 nobody=False):
+        self.download = download
+        self.length = length
+        self.written = 0
+        self.code = None
+        self.headers = {}
+        self.fd = None
+        c = self.curl = pycurl.Curl()
+        c.setopt(c.URL, download.url)
+        c.setopt(c.CONNECTTIMEOUT, 5)
+        c.setopt(c.FOLLOWLOCATION, 1)
+        c.setopt(c.FAILONERROR, 1)
+        c.setopt(c.HEADERFUNCTION, self._header)
+        if headers:
+            c.setopt(c.HTTPHEADER, list(headers))
+        if nobody:
+            c.setopt(c.NOBODY, 1)
+        else:
+            self.fd = os.open(download.tmp, os.O_WRONLY)
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            c.setopt(c.WRITEFUNCTION, self._data)
+            if length is not None:
+                c.setopt(c.RANGE, '%d-%d' % (offset, offset + length - 1))
+
+    def _header(self, line):
+        if line.startswith('HTTP/'):
+            # Each redirect starts a new set of headers
+            self.headers = {}
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            self.headers[name.strip().lower()] = value.strip()
+
+    def _data(self, buf):
+        """
+        Function that is called back from pycurl to actually write data to
+        disk.
+        """
+        if self.length is not None and self.written + len(buf) > self.length:
+            # The server ignored our Range header; abort this transfer
+            return 0
+        os.write(self.fd, buf)
+        self.written += len(buf)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.curl.close()
+
+def _perform(transfers):
+    """
+    Run transfers concurrently on one CurlMulti. Returns a dict mapping each
+    failed transfer to its error message.
+    """
+    errors = {}
+    multi = pycurl.CurlMulti()
+    by_handle = {}
+    for transfer in transfers:
+        multi.add_handle(transfer.curl)
+        by_handle[transfer.curl] = transfer
+    try:
+        active = len(transfers)
+        while active:
+            while True:
+                ret, active = multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            while True:
+                queued, ok_list, err_list = multi.info_read()
+                for c in ok_list:
+                    by_handle[c].code = c.getinfo(c.RESPONSE_CODE)
+                for c, errno, errmsg in err_list:
+                    by_handle[c].code = c.getinfo(c.RESPONSE_CODE)
+                    errors[by_handle[c]] = errmsg
+                if not queued:
+                    break
+            if active:
+                multi.select(1.0)
+    finally:
+        for transfer in transfers:
+            multi.remove_handle(transfer.curl)
+            transfer.close()
+        multi.close()
+    return errors
+
+def _segments(download):
+    """
+    Return the transfers needed to fetch download, split into Range requests
+    when the server supports them and the file is big enough to benefit.
+    """
+    size = download.size
+    if not download.ranges or size is None or size < 2 * SEGMENT_SIZE:
+        download.segmented = False
+        return [ _Transfer(download) ]
+    download.segmented = True
+    f = open(download.tmp, 'w')
+    f.truncate(size)
+    f.close()
+    count = min(MAX_SEGMENTS, size // SEGMENT_SIZE)
+    length = (size + count - 1) // count
+    return [ _Transfer(download, offset, min(length, size - offset))
+             for offset in range(0, size, length) ]
+
+def download_files(downloads):
+    """
+    Fetch every download at once and return them. Each needs a tmp file to
+    write into; anything a HEAD request answered with 304 Not Modified is
+    left alone and has its code set to 304.
+    """
+    probes = [ _Transfer(d, headers=d.headers, nobody=True)
+               for d in downloads ]
+    errors = _perform(probes)
+    fetch = []
+    for probe in probes:
+        download = probe.download
+        download.code = probe.code
+        if probe in errors:
+            # Some servers refuse HEAD; just stream the body
+            download.code = None
+        elif probe.code == 304:
+            continue
+        else:
+            download.response = probe.headers
+            if 'content-length' in probe.headers:
+                download.size = int(probe.headers['content-length'])
+            download.ranges = 'bytes' in probe.headers.get(
+                'accept-ranges', '').lower()
+        fetch.append(download)
+
+    transfers = []
+    for download in fetch:
+        transfers.extend(_segments(download))
+    errors = _perform(transfers)
+
+    # Fall back to a single stream for anything whose segments failed
+    failed = []
+    for transfer in transfers:
+        if transfer in errors and transfer.download not in failed:
+            failed.append(transfer.download)
+    retry = []
+    for download in failed:
+        if not download.segmented:
+            raise Exception('Failed to download %s: %s' % (download.url,
+                [ e for t, e in errors.items() if t.download is download ][0]))
+        open(download.tmp, 'w').close()
+        download.ranges = False
+        retry.extend(_segments(download))
+    errors = _perform(retry)
+    for transfer, error in errors.items():
+        raise Exception('Failed to download %s: %s' %
+            (transfer.download.url, error))
+    for transfer in transfers + retry:
+        # The GET headers are better than HEAD's if we have them
+        if transfer.headers.get('etag') or transfer.headers.get('last-modified'):
+            transfer.download.response = transfer.headers
+    return downloads
+
+def _write_atomic(filename, data):
+    """
+    Replace filename with data so readers only ever see a complete file.
+    """
+    fd, tmp = mkstemp(dir=os.path.dirname(filename), prefix='.tmp-')
+    try:
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp, filename)
+    except:
+        os.unlink(tmp)
+        raise
+
+class ContentCache(object):
+    """
+    An on-disk cache of downloads keyed by URL. Entries are revalidated with
+    If-None-Match/If-Modified-Since on every use, so a hit costs one request
+    and no transfer, and the least recently used entries are evicted once the
+    cache grows past max_size.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_size=MAX_CACHE_SIZE):
+        self.log = logging.getLogger('%s.%s' %
+            (__name__, self.__class__.__name__))
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _paths(self, url):
+        key = hashlib.sha1(url).hexdigest()
+        data = os.path.join(self.directory, key)
+        return data, data + '.json'
+
+    def _load_meta(self, meta_file):
+        try:
+            return json.load(open(meta_file))
+        except (IOError, ValueError):
+            return None
+
+    def fetch(self, url, filename):
+        """
+        Put the content at url in filename, downloading it only if the cached
+        copy is missing or out of date.
+        """
+        return self.fetch_many([ (url, filename) ])[0]
+
+    def fetch_many(self, downloads):
+        """
+        Like fetch() for a list of (url, filename) pairs, revalidating and
+        downloading them all concurrently. Returns the filenames.
+        """
+        pending = []
+        for url, filename in downloads:
+            data_file, meta_file = self._paths(url)
+            meta = self._load_meta(meta_file)
+            headers = []
+            if meta and os.path.exists(data_file):
+                # json hands back unicode, which pycurl will not take
+                if meta.get('etag'):
+                    headers.append('If-None-Match: %s' % str(meta['etag']))
+                if meta.get('last_modified'):
+                    headers.append('If-Modified-Since: %s' %
+                        str(meta['last_modified']))
+            else:
+                meta = None
+            download = _Download(url, filename, headers)
+            download.meta = meta
+            fd, download.tmp = mkstemp(dir=self.directory, prefix='.tmp-')
+            os.close(fd)
+            pending.append(download)
+
+        try:
+            download_files(pending)
+            for download in pending:
+                data_file, meta_file = self._paths(download.url)
+                if download.code == 304 and download.meta:
+                    self.log.debug('Cached copy of %s is current' %
+                        download.url)
+                    os.unlink(download.tmp)
+                    meta = download.meta
+                else:
+                    self.log.debug('Downloaded %s into the cache' %
+                        download.url)
+                    fd = os.open(download.tmp, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                    os.rename(download.tmp, data_file)
+                    meta = { 'url': download.url,
+                             'etag': download.response.get('etag'),
+                             'last_modified':
+                                download.response.get('last-modified') }
+                meta['last_used'] = time()
+                _write_atomic(meta_file, json.dumps(meta))
+                self._copy_out(data_file, download.filename)
+        finally:
+            for download in pending:
+                if os.path.exists(download.tmp):
+                    os.unlink(download.tmp)
+        self.evict(keep=[ self._paths(url)[0] for url, f in downloads ])
+        return [ filename for url, filename in downloads ]
+
+    def _copy_out(self, data_file, filename):
+        # Entries are only ever replaced by rename, so sharing the inode
+        # with the destination is safe
+        if os.path.exists(filename):
+            os.unlink(filename)
+        try:
+            os.link(data_file, filename)
+        except OSError:
+            shutil.copyfile(data_file, filename)
+
+    def evict(self, keep=()):
+        """
+        Remove least recently used entries until the cache fits in max_size.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            meta_file = os.path.join(self.directory, name)
+            data_file = meta_file[:-len('.json')]
+            meta = self._load_meta(meta_file)
+            if not meta or not os.path.exists(data_file):
+                continue
+            size = os.path.getsize(data_file)
+            total += size
+            entries.append((meta.get('last_used', 0), size, data_file,
+                meta_file))
+        entries.sort()
+        for last_used, size, data_file, meta_file in entries:
+            if total <= self.max_size:
+                break
+            if data_file in keep:
+                continue
+            self.log.debug('Evicting %s from the download cache' % data_file)
+            for path in (meta_file, data_file):
+                if os.path.exists(path):
+                    os.unlink(path)
+            total -= size
@@ -0,0 +1,291 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Writing images straight into EBS snapshots with the EBS direct APIs
+# (StartSnapshot, PutSnapshotBlock and CompleteSnapshot), so an upload needs
+# no utility instance, volume or ssh at all. boto does not know these calls,
+# so EBSDirectConnection signs its own requests; fake_ec2 has a stand-in.
+
+import base64
+import hashlib
+import json
+import logging
+import random
+import threading
+import uuid
+from Queue import Queue, Empty, Full
+from boto.connection import AWSAuthConnection
+from boto.exception import BotoServerError
+from time import sleep
+
+import upload_utils
+
+# The only block size the APIs support
+BLOCK_SIZE = 512 * 1024
+
+# Concurrent PutSnapshotBlock requests
+THREADS = 8
+
+# Blocks read ahead of the uploads, on top of one per thread, which bounds
+# memory use at (THREADS + MAX_IN_FLIGHT) * BLOCK_SIZE
+MAX_IN_FLIGHT = 32
+
+# Attempts at each request before giving up on the upload
+RETRIES = 5
+
+class EBSDirectConnection(AWSAuthConnection):
+    """
+    Just enough of the EBS direct APIs to write a snapshot.
+    """
+
+    def __init__(self, region_name='us-east-1', **kwargs):
+        self.region_name = region_name
+        AWSAuthConnection.__init__(self, 'ebs.%s.amazonaws.com' % region_name,
+            **kwargs)
+
+    def _required_auth_capability(self):
+        return [ 'hmac-v4' ]
+
+    def _request(self, verb, path, body='', headers=None):
+        response = self.make_request(verb, path, headers=headers or {},
+            data=body)
+        body = response.read()
+        if response.status >= 300:
+            raise BotoServerError(response.status, response.reason, body)
+        return body and json.loads(body) or {}
+
+    def start_snapshot(self, volume_size, description=None, tags=None,
+                       parent_snapshot_id=None, timeout=60,
+                       client_token=None):
+        """
+        Start a snapshot of a volume_size GiB volume, made up of the blocks
+        of parent_snapshot_id if given. Returns the response, which includes
+        its SnapshotId. An unfinished snapshot fails after timeout minutes.
+        Retries with the same client_token start the same snapshot.
+        """
+        params = { 'VolumeSize': volume_size, 'Timeout': timeout,
+                   'ClientToken': client_token or str(uuid.uuid4()) }
+        if description:
+            params['Description'] = description
+        if tags:
+            params['Tags'] = [ { 'Key': k, 'Value': v }
+                               for k, v in sorted(tags.items()) ]
+        if parent_snapshot_id:
+            params['ParentSnapshotId'] = parent_snapshot_id
+        return self._request('POST', '/snapshots', json.dumps(params),
+            { 'Content-Type': 'application/json' })
+
+    def put_snapshot_block(self, snapshot_id, block_index, data, checksum):
+        """
+        Write data to block block_index of snapshot_id. checksum is the
+        base64 SHA256 of data.
+        """
+        return self._request('PUT', '/snapshots/%s/blocks/%d' %
+            (snapshot_id, block_index), data,
+            { 'Content-Type': 'application/octet-stream',
+              'x-amz-Data-Length': str(len(data)),
+              'x-amz-Checksum': checksum,
+              'x-amz-Checksum-Algorithm': 'SHA256' })
+
+    def complete_snapshot(self, snapshot_id, changed_blocks, checksum=None):
+        """
+        Seal snapshot_id after changed_blocks blocks were written. checksum,
+        if given, is the aggregate_checksum() of their checksums.
+        """
+        headers = { 'x-amz-ChangedBlocksCount': str(changed_blocks) }
+        if checksum:
+            headers.update({ 'x-amz-Checksum': checksum,
+                             'x-amz-Checksum-Algorithm': 'SHA256',
+                             'x-amz-Checksum-Aggregation-Method': 'LINEAR' })
+        return self._request('POST', '/snapshots/completion/%s' % snapshot_id,
+            '', headers)
+
+def block_checksum(data):
+    return base64.b64encode(hashlib.sha256(data).digest())
+
+def aggregate_checksum(checksums):
+    """
+    Return the LINEAR aggregate of a {block index: checksum} dict: the
+    checksum of all the block checksums in block order.
+    """
+    return base64.b64encode(hashlib.sha256(''.join([
+        base64.b64decode(checksums[i]) for i in sorted(checksums) ])).digest())
+
+def extent_blocks(extents, block_size=BLOCK_SIZE):
+    """
+    Return the sorted indexes of the blocks that extents touch.
+    """
+    indexes = set()
+    for offset, length in extents:
+        indexes.update(range(offset // block_size,
+            (offset + length + block_size - 1) // block_size))
+    return sorted(indexes)
+
+def _retryable(error):
+    return error.status >= 500 or error.status == 429 or \
+        'Throttl' in str(error.body) or 'LimitExceeded' in str(error.body)
+
+class DirectUploader(object):
+    """
+    Writes an image into a new snapshot over threads concurrent requests,
+    reading no more than max_in_flight blocks ahead of them.
+    """
+
+    def __init__(self, conn, threads=THREADS, max_in_flight=MAX_IN_FLIGHT):
+        self.log = logging.getLogger('%s.%s' %
+            (__name__, self.__class__.__name__))
+        self.conn = conn
+        self.threads = threads
+        self.max_in_flight = max_in_flight
+
+    def _blocks(self, filename, indexes, skip_zero):
+        """
+        Yield (index, data) for the given blocks of filename, leaving out
+        those that are all zeros if skip_zero is set.
+        """
+        zero = '\0' * BLOCK_SIZE
+        src = open(filename, 'rb')
+        try:
+            for index in indexes:
+                src.seek(index * BLOCK_SIZE)
+                # The last block of the image is padded out
+                data = src.read(BLOCK_SIZE)
+                data += zero[len(data):]
+                if skip_zero and data == zero:
+                    continue
+                yield index, data
+        finally:
+            src.close()
+
+    def _retry(self, what, call, *args):
+        """
+        Return call(*args), retrying with backoff while it is throttled or
+        the service has trouble.
+        """
+        for attempt in range(RETRIES):
+            try:
+                return call(*args)
+            except BotoServerError, e:
+                if attempt == RETRIES - 1 or not _retryable(e):
+                    raise
+                self.log.debug("Retrying %s: %s" % (what, e.status))
+                sleep(min(random.random() * (2 ** attempt), 20))
+
+    def _put(self, snapshot_id, index, data):
+        checksum = block_checksum(data)
+        self._retry('block %d of %s' % (index, snapshot_id),
+            self.conn.put_snapshot_block, snapshot_id, index, data, checksum)
+        return checksum
+
+    def upload(self, filename, volume_size, description=None, tags=None,
+               parent=None, indexes=None, meter=None, started=None):
+        """
+        Write filename into a new snapshot of a volume_size GiB volume and
+        return (snapshot id, bytes sent). With a parent snapshot, only the
+        blocks in indexes are written over it. The snapshot is sealed, but
+        still has to become completed. A process_utils.ProgressMeter reports
+        on the upload, and has it abandoned if it stalls. started, if given,
+        is called with the snapshot id as soon as there is one.
+        """
+        skip_zero = indexes is None
+        if skip_zero:
+            indexes = extent_blocks(upload_utils.data_extents(filename,
+                BLOCK_SIZE))
+        if meter:
+            meter.total = len(indexes) * BLOCK_SIZE
+        response = self._retry('starting a snapshot',
+            self.conn.start_snapshot, volume_size, description, tags, parent,
+            60, str(uuid.uuid4()))
+        snapshot_id = str(response['SnapshotId'])
+        if started:
+            started(snapshot_id)
+        self.log.debug("Writing %s into snapshot (%s) over %d threads" %
+            (filename, snapshot_id, self.threads))
+
+        work = Queue(self.max_in_flight)
+        abort = threading.Event()
+        checksums = {}
+        sent = []
+        errors = []
+        lock = threading.Lock()
+
+        def _worker():
+            while not abort.is_set():
+                try:
+                    item = work.get(timeout=1)
+                except Empty:
+                    continue
+                if item is None:
+                    return
+                index, data = item
+                try:
+                    checksum = self._put(snapshot_id, index, data)
+                except Exception, e:
+                    errors.append(e)
+                    abort.set()
+                    return
+                lock.acquire()
+                try:
+                    checksums[index] = checksum
+                    sent.append(len(data))
+                finally:
+                    lock.release()
+                if meter:
+                    meter.add(len(data))
+
+        def _queue(item):
+            # Blocks while the threads are busy, unless they have given up
+            while not abort.is_set():
+                if meter:
+                    meter.tick()
+                    if meter.stalled():
+                        errors.append(Exception("Stalled, nothing moved for "
+                            "%d seconds" % meter.stall_timeout))
+                        abort.set()
+                        break
+                try:
+                    work.put(item, timeout=1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        threads = [ threading.Thread(target=_worker, name='direct-%d' % i)
+                    for i in range(self.threads) ]
+        for t in threads:
+            t.start()
+        try:
+            for item in self._blocks(filename, indexes, skip_zero):
+                if not _queue(item):
+                    break
+            for t in threads:
+                _queue(None)
+        except:
+            # Reading the image failed, or we are being interrupted
+            abort.set()
+            raise
+        finally:
+            for t in threads:
+                t.join()
+        if errors:
+            raise Exception("Upload into snapshot (%s) failed: %s" %
+                (snapshot_id, errors[0]))
+
+        self.log.debug("Sealing snapshot (%s) after %d blocks" %
+            (snapshot_id, len(checksums)))
+        self._retry('sealing %s' % snapshot_id, self.conn.complete_snapshot,
+            snapshot_id, len(checksums),
+            checksums and aggregate_checksum(checksums) or None)
+        return snapshot_id, sum(sent)
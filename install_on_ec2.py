@@ -18,6 +18,8 @@ import logging
 from optparse import OptionParser
 import os.path
 from aws_utils import EBSHelper, AMIHelper
+import profile_utils
+import trace_utils
 
 def get_opts():
     usage="""
@@ -32,6 +34,14 @@ pre-existing AMI."""
         help='Set the EC2 region we are working in')
     parser.add_option('-s', '--disk-size', default=10, type='int',
         help='Set the size in G of the disk Anaconda will install to')
+    parser.add_option('--trace', default=None, metavar='FILE',
+        help='append per-phase timings to FILE (see trace_summary.py)')
+    parser.add_option('--log-command', default=None, metavar='COMMAND',
+        help='shell command that prints the installer\'s logs, with %(host)s '
+        'for the instance address, to time the install phases by')
+    parser.add_option('--profile', default=None, metavar='NAME',
+        help='save the install phase timings as those of test NAME (see '
+        'install_profiles.py)')
     options, args = parser.parse_args()
     if len(args) != 2:
         parser.error('You must provide an AMI and a kickstart file')
@@ -43,8 +53,20 @@ logging.basicConfig(level=logging.DEBUG, format='%(message)s')
 
 if __name__ == '__main__':
     opts, install_ami, kickstart = get_opts()
+    if opts.trace:
+        trace_utils.enable(opts.trace)
     ami_helper = AMIHelper(opts.region)
     user_data = open(kickstart).read()
-    install_ami = ami_helper.launch_wait_snapshot(
-        install_ami, user_data, int(opts.disk_size), opts.inst_type)
+    try:
+        install_ami = ami_helper.launch_wait_snapshot(
+            install_ami, user_data, int(opts.disk_size), opts.inst_type,
+            log_command=opts.log_command)
+    finally:
+        profile = ami_helper.install_profile
+        if profile and opts.profile:
+            profile_utils.save_profile(opts.profile, profile,
+                ami=install_ami, kickstart=os.path.basename(kickstart))
+    for phase in profile['phases']:
+        print "%-12s %s" % (phase['phase'], phase['duration'] is None and '?'
+            or '%.0fs' % phase['duration'])
     print "Got AMI: %s" % install_ami
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from optparse import OptionParser
+import sys
+from time import localtime, strftime
+
+import profile_utils
+from trace_summary import percentile
+
+def get_opts():
+    usage = """%prog [options] [test ...]
+
+Show how long the recent installs of each test (all of them by default)
+spent in each Anaconda phase, as saved by launch_tests.py and
+install_on_ec2.py --profile, and how the latest compares with the median of
+the ones before it."""
+    parser = OptionParser(usage=usage)
+    parser.add_option('-n', '--last', default=5, type='int',
+        help='show this many of the latest installs of each test (5)')
+    parser.add_option('-d', '--directory', default=profile_utils.PROFILE_DIR,
+        help='where the profiles are kept (%default)')
+    parser.add_option('-e', '--errors', default=False, action='store_true',
+        help='include installs that failed')
+    opts, args = parser.parse_args()
+    if opts.last < 1:
+        parser.error('Show at least one install')
+    return opts, args
+
+def _cell(seconds):
+    if seconds is None:
+        return '-'
+    return '%.0f' % seconds
+
+def _change(latest, earlier):
+    """
+    Return how latest compares with the median of earlier, as a percentage.
+    """
+    earlier = sorted([ e for e in earlier if e is not None ])
+    if latest is None or not earlier:
+        return '-'
+    median = percentile(earlier, 50)
+    # Changes to phases that take no time to speak of are only noise
+    if median < 1:
+        return '-'
+    return '%+.0f%%' % ((latest - median) * 100.0 / median)
+
+def show(test, profiles, last):
+    phases = [ p for p in profile_utils.PHASES
+               if [ r for r in profiles if p in r['durations'] ] ]
+    header = [ 'when', 'from' ] + phases + [ 'total', 'tree' ]
+    rows = []
+    for record in profiles[-last:]:
+        rows.append([ strftime('%Y-%m-%d %H:%M',
+                               localtime(record['created'])),
+                      record['source'] ] +
+                    [ _cell(record['durations'].get(p)) for p in phases ] +
+                    [ _cell(record['total']), record.get('tree') or '-' ])
+    if len(profiles) > 1:
+        latest, earlier = profiles[-1], profiles[:-1]
+        rows.append([ 'change', '' ] +
+            [ _change(latest['durations'].get(p),
+                      [ r['durations'].get(p) for r in earlier ])
+              for p in phases ] +
+            [ _change(latest['total'], [ r['total'] for r in earlier ]), '' ])
+
+    widths = [ max([ len(r[i]) for r in [ header ] + rows ])
+               for i in range(len(header)) ]
+    print test
+    for row in [ header ] + rows:
+        print '  ' + '  '.join([ row[0].ljust(widths[0]),
+            row[1].ljust(widths[1]) ] +
+            [ cell.rjust(width) for cell, width in
+              zip(row[2:-1], widths[2:-1]) ] + [ row[-1] ])
+
+if __name__ == '__main__':
+    opts, tests = get_opts()
+    if not tests:
+        tests = profile_utils.profiled_tests(opts.directory)
+    found = False
+    for test in tests:
+        profiles = [ p for p in
+                     profile_utils.load_profiles(test, opts.directory)
+                     if opts.errors or not p.get('failure') ]
+        if not profiles:
+            continue
+        if found:
+            print
+        found = True
+        show(test, profiles, opts.last)
+    if not found:
+        print >> sys.stderr, 'No install profiles found'
+        sys.exit(1)
+    print
+    print 'Durations are in seconds'
@@ -0,0 +1,179 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# A local journal of every EC2 resource the helpers create, so finding and
+# cleaning up our own resources takes a lookup of their IDs rather than a
+# tag scan of the whole region. Each row records the run that created the
+# resource and that run's process, which tells the resources of a crashed
+# run apart from those of one still going. Writes are synced to disk before
+# they return, so a crash right after a create call still leaves it on
+# record. Several processes can share the journal.
+
+import errno
+import os
+import sqlite3
+import threading
+from time import time
+
+JOURNAL_FILE = os.path.expanduser('~/.cache/anaconda-ec2/journal.sqlite')
+
+# Resource states; anything gone is only kept for the record
+LIVE = 'live'
+GONE = 'gone'
+
+# Resources that belong to no run, such as pooled utility instances, are
+# handed over to this one. It is never orphaned.
+SHARED_RUN = 'shared'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS resources (
+    region TEXT NOT NULL,
+    id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    pid INTEGER,
+    state TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (region, id));
+CREATE INDEX IF NOT EXISTS resources_by_kind
+    ON resources (region, kind, state);
+CREATE INDEX IF NOT EXISTS resources_by_run
+    ON resources (run_id, state);
+"""
+
+def pid_alive(pid):
+    """
+    True if process pid (on this host) is still running.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+class Journal(object):
+    """
+    The resources created from this host, by region and ID.
+    """
+
+    def __init__(self, filename=JOURNAL_FILE):
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        self.filename = filename
+        self.lock = threading.Lock()
+        # One connection for all the threads of a process, behind the lock;
+        # other processes wait on sqlite's own locking
+        self.db = sqlite3.connect(filename, timeout=60,
+            check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # Sync every commit, not just checkpoints
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.executescript(SCHEMA)
+
+    def _execute(self, sql, args=()):
+        self.lock.acquire()
+        try:
+            return self.db.execute(sql, args).fetchall()
+        finally:
+            self.lock.release()
+
+    def _executemany(self, sql, rows):
+        self.lock.acquire()
+        try:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.executemany(sql, rows)
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+        finally:
+            self.lock.release()
+
+    def record(self, region, kind, resource_id, run_id, pid=None):
+        """
+        Note that run_id (in process pid, this one by default) has just
+        created resource_id.
+        """
+        now = time()
+        self._execute('INSERT OR REPLACE INTO resources VALUES '
+            '(?, ?, ?, ?, ?, ?, ?, ?)', (region, resource_id, kind, run_id,
+            pid or os.getpid(), LIVE, now, now))
+
+    def set_state(self, region, resource_ids, state, before=None):
+        """
+        Move resource_ids to state, usually GONE. With before, only those
+        created before that time move.
+        """
+        now = time()
+        if before is None:
+            before = now
+        self._executemany('UPDATE resources SET state = ?, updated = ? '
+            'WHERE region = ? AND id = ? AND created <= ?',
+            [ (state, now, region, r, before) for r in resource_ids ])
+
+    def hand_over(self, region, resource_ids, run_id=SHARED_RUN):
+        """
+        Make resource_ids belong to run_id, which has no process of its own.
+        """
+        now = time()
+        self._executemany('UPDATE resources SET run_id = ?, pid = NULL, '
+            'updated = ? WHERE region = ? AND id = ?',
+            [ (run_id, now, region, r) for r in resource_ids ])
+
+    def find(self, region, kind, runs=None, state=LIVE):
+        """
+        Return the IDs of the resources of kind in region in state, oldest
+        first, only those of the given runs if any.
+        """
+        sql = 'SELECT id FROM resources WHERE region = ? AND kind = ? AND ' \
+            'state = ?'
+        args = [ region, kind, state ]
+        if runs is not None:
+            if not runs:
+                return []
+            sql += ' AND run_id IN (%s)' % ', '.join([ '?' ] * len(runs))
+            args += list(runs)
+        return [ str(row[0]) for row in
+                 self._execute(sql + ' ORDER BY created', args) ]
+
+    def orphaned_runs(self, region=None):
+        """
+        Return the runs with live resources whose process has gone.
+        """
+        sql = 'SELECT DISTINCT run_id, pid FROM resources WHERE state = ? ' \
+            'AND pid IS NOT NULL'
+        args = [ LIVE ]
+        if region:
+            sql += ' AND region = ?'
+            args.append(region)
+        return [ str(run_id) for run_id, pid in self._execute(sql, args)
+                 if not pid_alive(pid) ]
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+def get_journal(filename=JOURNAL_FILE):
+    """
+    Return the Journal in filename shared by every helper in the process.
+    """
+    _journals_lock.acquire()
+    try:
+        if filename not in _journals:
+            _journals[filename] = Journal(filename)
+        return _journals[filename]
+    finally:
+        _journals_lock.release()
@@ -0,0 +1,276 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Expanding base kickstarts across axes (release tree, partitioning, package
+# set, instance type and so on) into concrete tests, and telling which of
+# those would run exactly the same install. A matrix is a JSON file:
+#
+#     { "bases": { "f18-jeos": "fedora-18-jeos.ks" },
+#       "axes": [ { "name": "packages",
+#                   "values": { "core": {},
+#                               "minimal": { "packages": [ "@core" ] } } },
+#                 { "name": "instance",
+#                   "values": { "small": { "instance_type": "m1.small" },
+#                               "medium": { "instance_type": "m1.medium" } } }
+#               ] }
+#
+# Base kickstarts are found relative to the matrix. Every test takes one
+# value from each axis, and is named after its base and those values. A
+# value can replace all the lines of kickstart commands ("commands", with a
+# list of argument strings per command, or null to drop it), the body of
+# %packages ("packages") and set the instance_type, disk_size or priority
+# of the test.
+
+from optparse import OptionParser
+import hashlib
+import itertools
+import json
+import os
+import pipes
+import shlex
+import sys
+
+MATRIX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'examples', 'matrix.json')
+
+# What a test gets unless its axes say otherwise
+DEFAULT_INSTANCE_TYPE = 'm1.small'
+DEFAULT_DISK_SIZE = 10
+
+# Lines starting with % that are commands rather than section headers
+NOT_SECTIONS = ('%include', '%ksappend')
+
+class Kickstart(object):
+    """
+    A kickstart as a list of its command lines and sections (%packages,
+    %pre, %post and so on) in order, each section a (header, body lines)
+    tuple.
+    """
+
+    def __init__(self, text):
+        self.items = []
+        section = None
+        for line in text.splitlines():
+            stripped = line.strip()
+            if section is not None:
+                if stripped == '%end':
+                    section = None
+                else:
+                    section[1].append(line)
+            elif stripped.startswith('%') and \
+                 not stripped.startswith(NOT_SECTIONS):
+                section = (stripped, [])
+                self.items.append(section)
+            else:
+                self.items.append(line)
+
+    def commands(self):
+        return [ i for i in self.items if not isinstance(i, tuple) ]
+
+    def sections(self):
+        return [ i for i in self.items if isinstance(i, tuple) ]
+
+    def set_command(self, keyword, args):
+        """
+        Replace every line of command keyword with one per entry of args,
+        where the first of them was (or after the last command). None or []
+        drops the command.
+        """
+        lines = [ ('%s %s' % (keyword, a)).strip() for a in args or () ]
+        kept = []
+        at = None
+        for item in self.items:
+            if not isinstance(item, tuple) and _keyword(item) == keyword:
+                if at is None:
+                    at = len(kept)
+                continue
+            kept.append(item)
+        if at is None:
+            # After the last command before the sections
+            at = 0
+            for index, item in enumerate(kept):
+                if isinstance(item, tuple):
+                    break
+                if _keyword(item):
+                    at = index + 1
+        self.items = kept[:at] + lines + kept[at:]
+
+    def set_packages(self, packages):
+        """
+        Replace the body of %packages, keeping its options.
+        """
+        for index, item in enumerate(self.items):
+            if isinstance(item, tuple) and item[0].split()[0] == '%packages':
+                self.items[index] = (item[0], list(packages))
+                return
+        self.items.append(('%packages', list(packages)))
+
+    def text(self):
+        lines = []
+        for item in self.items:
+            if isinstance(item, tuple):
+                lines += [ item[0] ] + item[1] + [ '%end' ]
+            else:
+                lines.append(item)
+        return '\n'.join(lines) + '\n'
+
+    def canonical(self):
+        """
+        Return the kickstart in a form that leaves out everything that makes
+        no difference to the install: comments, blank lines, quoting and
+        spacing of command lines, repeated command lines, the order of
+        different commands and the order of packages. Lines of the same
+        command (part and logvol, say) keep their order, as do scripts.
+        """
+        commands = []
+        for line in self.commands():
+            try:
+                words = shlex.split(line, comments=True)
+            except ValueError:
+                # Unbalanced quotes; leave it be
+                words = line.split()
+            if not words:
+                continue
+            line = ' '.join([ pipes.quote(w) for w in words ])
+            if line not in commands:
+                commands.append(line)
+        # Sorting is stable, so lines of one command stay in order
+        commands.sort(key=_keyword)
+        sections = []
+        for header, body in self.sections():
+            header = ' '.join(header.split())
+            if header.split()[0] == '%packages':
+                body = sorted(set([ ' '.join(l.split()) for l in body
+                                    if l.strip() and
+                                    not l.strip().startswith('#') ]))
+            else:
+                body = [ l.rstrip() for l in body if l.strip() ]
+            sections.append('\n'.join([ header ] + body + [ '%end' ]))
+        return '\n'.join(commands + sections) + '\n'
+
+def _keyword(line):
+    words = line.split()
+    if not words or words[0].startswith('#'):
+        return None
+    return words[0]
+
+def install_key(ks, inst_type, disk_size):
+    """
+    Return a digest that two installs share if they would turn out the same:
+    kickstarts with the same canonical form, on the same instance type and
+    disk size. Installs are always of the seed AMI of their region, so the
+    region stands in for the AMI.
+    """
+    digest = hashlib.sha1(Kickstart(ks).canonical())
+    digest.update('\0%s\0%s' % (inst_type, disk_size))
+    return digest.hexdigest()
+
+def _encode(value):
+    """
+    Turn the unicode strings json gives back into the plain ones the rest
+    of the kickstart is made of.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [ _encode(v) for v in value ]
+    if isinstance(value, dict):
+        return dict([ (_encode(k), _encode(v)) for k, v in value.items() ])
+    return value
+
+def load_matrix(filename=MATRIX_FILE):
+    """
+    Return the matrix in filename, with the bases read in.
+    """
+    try:
+        matrix = _encode(json.load(open(filename)))
+    except ValueError, e:
+        raise Exception("Could not parse matrix %s: %s" % (filename, e))
+    directory = os.path.dirname(os.path.abspath(filename))
+    bases = {}
+    for name, path in matrix.get('bases', {}).items():
+        bases[name] = open(os.path.join(directory, path)).read()
+    matrix['bases'] = bases
+    matrix.setdefault('axes', [])
+    return matrix
+
+def expand(matrix, tree=None):
+    """
+    Yield (name, kickstart, settings) for every test in matrix, where
+    settings has the instance_type, disk_size and priority of the test and
+    the value it took from each axis. With tree, tests whose axes do not
+    pick an install tree (a url command) install from that one.
+    """
+    axes = [ (axis['name'], sorted(axis['values'].items()))
+             for axis in matrix['axes'] ]
+    for base in sorted(matrix['bases']):
+        for values in itertools.product(*[ v for n, v in axes ]):
+            ks = Kickstart(matrix['bases'][base])
+            settings = { 'instance_type': DEFAULT_INSTANCE_TYPE,
+                         'disk_size': DEFAULT_DISK_SIZE, 'priority': 0,
+                         'axes': {} }
+            tree_set = False
+            for (axis, choices), (value, spec) in zip(axes, values):
+                settings['axes'][axis] = value
+                for keyword, args in sorted(spec.get('commands', {}).items()):
+                    ks.set_command(keyword, args)
+                    tree_set = tree_set or keyword == 'url'
+                if 'packages' in spec:
+                    ks.set_packages(spec['packages'])
+                for key in ('instance_type', 'disk_size', 'priority'):
+                    if key in spec:
+                        settings[key] = spec[key]
+            if tree and not tree_set:
+                ks.set_command('url', [ '--url=%s' % tree ])
+            name = '-'.join([ base ] + [ value for value, spec in values ])
+            yield name, ks.text(), settings
+
+def get_opts():
+    usage = """%prog [options] [matrix_file]
+
+List the tests a kickstart matrix expands to, grouped by the install they
+share; tests in a group only cost one install. The matrix defaults to
+examples/matrix.json."""
+    parser = OptionParser(usage=usage)
+    parser.add_option('-t', '--tree', default=None, metavar='TreeURL',
+        help='install from this tree unless the matrix picks one')
+    parser.add_option('-w', '--write', default=None, metavar='DIR',
+        help='write the kickstart of every test into DIR')
+    opts, args = parser.parse_args()
+    if len(args) > 1:
+        parser.error('Only one matrix, please')
+    if args and not os.path.isfile(args[0]):
+        parser.error('Could not find %s' % args[0])
+    return opts, args and args[0] or MATRIX_FILE
+
+if __name__ == '__main__':
+    opts, matrix_file = get_opts()
+    groups = {}
+    order = []
+    for name, ks, settings in expand(load_matrix(matrix_file), opts.tree):
+        key = install_key(ks, settings['instance_type'],
+            settings['disk_size'])
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(name)
+        if opts.write:
+            if not os.path.isdir(opts.write):
+                os.makedirs(opts.write)
+            open(os.path.join(opts.write, '%s.ks' % name), 'w').write(ks)
+    for key in order:
+        print '%s  %s' % (key[:12], ' '.join(groups[key]))
+    print >> sys.stderr, '%d tests, %d installs' % (
+        sum([ len(g) for g in groups.values() ]), len(groups))
@@ -17,10 +17,15 @@
 from optparse import OptionParser, OptionGroup
 import os.path
 import logging
-import threading
+import sys
 
-from aws_utils import EBSHelper, AMIHelper
+from aws_utils import EBSHelper, AMIHelper, SEED_DIGEST_TAG, PVGRUB_AKIS
 import disk_utils
+import ks_matrix
+import lifecycle
+import profile_utils
+from scheduler import TestScheduler
+import trace_utils
 import anaconda_test
 
 branch_release = 19
@@ -53,13 +58,33 @@ This script tests Anaconda in EC2."""
     parser.add_option_group(instgroup)
     parser.add_option('-e', '--ec2-region', default='us-east-1',
         help='set an EC2 region (us-east-1)')
+    parser.add_option('--regions', default='', metavar='REGION,...',
+        help='also run the tests in these regions, with the seed AMI copied '
+        'over from the first one')
     parser.add_option('-c', '--test-case', default='all',
         help='Select a specific test by name to run')
+    parser.add_option('-m', '--matrix', default=ks_matrix.MATRIX_FILE,
+        metavar='FILE', help='expand the tests from this kickstart matrix '
+        '(examples/matrix.json, see ks_matrix.py)')
     parser.add_option('-p', '--parameters', default='',
         help='Set the kernel parameters to be passed to Anaconda. Use a quoted string to pass multiple parameters.')
     parser.add_option('-u', '--updates', default=None,
         help='Specify a URL to an updates.img and include it')
+    parser.add_option('-j', '--jobs', default=4, type='int',
+        help='Run at most this many tests at once (4)')
+    parser.add_option('--trace', default=None, metavar='FILE',
+        help='append per-phase timings to FILE (see trace_summary.py)')
+    parser.add_option('--log-command', default=None, metavar='COMMAND',
+        help='shell command that prints the installer\'s logs, with %(host)s '
+        'for the instance address, to time the install phases by')
     opts = parser.parse_args()[0] # no positional arguments
+    opts.regions = [ opts.ec2_region ] + [ r for r in opts.regions.split(',')
+                                           if r and r != opts.ec2_region ]
+    if not os.path.isfile(opts.matrix):
+        parser.error('Could not find %s' % opts.matrix)
+    for region in opts.regions:
+        if region not in PVGRUB_AKIS:
+            parser.error('No pvgrub AKI known for region %s' % region)
     if opts.updates:
         opts.parameters += ' updates=%s' % opts.updates
     if opts.anaconda_nightly:
@@ -80,39 +105,144 @@ This script tests Anaconda in EC2."""
         parser.error('You must specify -N, -R or -T for an installation tree')
     return opts
 
-results = {}
-result_lock = threading.Lock()
+logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+log = logging.getLogger('launch_tests')
 
-def run_test(helper, ami, test):
-    testresult = helper.launch_wait_snapshot(ami, test.ks, test.resources)
-    result_lock.acquire()
-    results[test.name] = testresult
-    result_lock.release()
+def build_task(helper, content):
+    with helper.span('build-image'):
+        image = yield lifecycle.Call(disk_utils.build_image, content)
+    raise lifecycle.Return(image)
 
-def review_results():
+def seed_task(opts, helper, content, seed_amis, seed_tags):
+    """
+    Return the seed AMI for every region, given those that already exist.
+    The image is only built and uploaded if the first region has none, and
+    the utility instance boots while it is built.
+    """
+    wanted = [ r for r in opts.regions if r not in seed_amis ]
+    amis = dict(seed_amis)
+    if opts.ec2_region in wanted:
+        ebs_helper = EBSHelper(opts.ec2_region)
+        snapshot = yield ebs_helper.pipelined_upload_task(
+            build_task(helper, content), disk_utils.IMAGE_SIZE)
+    elif wanted:
+        snapshot = yield lifecycle.Call(helper.ami_snapshot,
+            seed_amis[opts.ec2_region])
+    if wanted:
+        # "stage 1" AMIs, copied to the other regions rather than uploaded
+        # again
+        amis.update((yield lifecycle.Call(helper.replicate_ebs_ami, snapshot,
+            wanted, region_tags=seed_tags)))
+    raise lifecycle.Return(amis)
+
+def setup_task(opts, helper, content, seed_amis, seed_tags, test_helpers):
+    """
+    Return the seed AMIs from seed_task(), getting the security groups of
+    the first opts.jobs of test_helpers ready while it runs. The rest make
+    theirs as their tests start, and every test deletes its own when done,
+    so there are never many more groups than jobs (a VPC only allows so
+    many).
+    """
+    results = yield lifecycle.All([ seed_task(opts, helper, content,
+        seed_amis, seed_tags) ] +
+        [ h.prepare_launch_task() for h in test_helpers[:opts.jobs] ])
+    raise lifecycle.Return(results[0])
+
+def run_test(helper, ami, test, names, opts):
+    """
+    Run the install of test once for all the tests in names, which share
+    it, and save its phase timings under each of their names whether it
+    worked or not (see install_profiles.py).
+    """
+    try:
+        with helper.span('test', test=test.name, shared=len(names)):
+            return helper.launch_wait_snapshot(ami, test.ks, test.resources,
+                test.inst_type, log_command=opts.log_command)
+    finally:
+        if helper.install_profile:
+            for name in names:
+                profile_utils.save_profile(name, helper.install_profile,
+                    ami=ami, region=helper.region.name, tree=opts.inst_tree,
+                    anaconda=opts.anaconda_tree)
+
+def review_results(jobs, shared):
+    """
+    Report on every test, fanning the result of each job out to all the
+    tests in shared[job.name], and exit with the number that failed.
+    """
     fails = 0
-    for test, result in results.items():
-        log.info(result)
-        if result['status'] == 'error':
-            fails += 1
+    for job in jobs:
+        for name in shared[job.name]:
+            if job.error:
+                log.info('%s: error: %s' % (name, job.error))
+                fails += 1
+            else:
+                log.info('%s: %s' % (name, job.result))
     sys.exit(fails)
 
 if __name__ == '__main__':
     opts = get_opts()
-    image = disk_utils.construct_image(opts.anaconda_tree, opts.parameters)
-    ebs_helper = EBSHelper(opts.ec2_region)
-    ami_helper = AMIHelper(opts.ec2_region)
-    snapshot = ebs_helper.safe_upload_and_shutdown(image)   # upload it
-    seed_ami = ami_helper.register_ebs_ami(snapshot) # "stage 1" AMI
-    threads = []
-    tests = anaconda_test.get_test(opts.test_case) # 'all' means get all of them
-    for test in tests:
-        threads.append(threading.Thread(
-            target=run_test,
-            args=(ami_helper, seed_ami, test),
-            name=test.name))
-    for t in threads:
-        t.start()
-    for t in threads:
-        t.join()
-    review_results(results)
+    if opts.trace:
+        trace_utils.enable(opts.trace)
+    helpers = dict([ (r, AMIHelper(r)) for r in opts.regions ])
+    ami_helper = helpers[opts.ec2_region]
+    seed_amis = {}
+    seed_tags = {}
+    content = None
+    if opts.ami:
+        seed_amis[opts.ec2_region] = opts.ami
+    else:
+        content = disk_utils.prepare_boot_content(opts.anaconda_tree,
+            opts.parameters)
+        for region in opts.regions:
+            digest = disk_utils.seed_digest(content, region)
+            seed_tags[region] = { SEED_DIGEST_TAG: digest }
+            # Identical boot content was uploaded before - skip straight to it
+            seed_ami = helpers[region].find_seed_ami(digest)
+            if seed_ami:
+                seed_amis[region] = seed_ami
+    # 'all' means get all of them
+    tests = anaconda_test.get_test(opts.test_case, opts.matrix,
+        opts.inst_tree)
+    # Tests that would run exactly the same install in a region (they all
+    # start from its seed AMI) share one. Each install gets a helper of its
+    # own; they track their own instance and security group.
+    jobs = []
+    installs = {}
+    # A shared install goes as early as the most urgent of its tests
+    priorities = {}
+    for region in opts.regions:
+        for test in tests:
+            name = test.name
+            if len(opts.regions) > 1:
+                name = '%s-%s' % (test.name, region)
+            key = (region, test.install_key())
+            if key not in installs:
+                installs[key] = (region, test, AMIHelper(region), [])
+                jobs.append(installs[key])
+            installs[key][3].append(name)
+            priorities[key] = max(priorities.get(key, test.priority),
+                test.priority)
+    log.info('%d tests need %d installs' %
+        (len(tests) * len(opts.regions), len(jobs)))
+    # The scheduler starts the most urgent installs first
+    first = sorted(jobs,
+        key=lambda job: -priorities[(job[0], job[1].install_key())])
+    try:
+        seed_amis = lifecycle.run(setup_task(opts, ami_helper, content,
+            seed_amis, seed_tags, [ h for r, t, h, n in first ]), threads=8)
+    except:
+        for region, test, helper, names in jobs:
+            helper.destroy_sgroups(runs=[ helper.run_id ])
+        raise
+    scheduler = TestScheduler(workers=opts.jobs,
+        # Never ask for more instances than the account has room for
+        region_caps=dict([ (r, max(helpers[r].instance_capacity(), 1))
+                           for r in opts.regions ]))
+    shared = {}
+    for region, test, helper, names in jobs:
+        shared[names[0]] = names
+        scheduler.submit(names[0], run_test,
+            (helper, seed_amis[region], test, names, opts),
+            priority=priorities[(region, test.install_key())], region=region)
+    review_results(scheduler.run(), shared)
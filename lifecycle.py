@@ -0,0 +1,418 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# A small engine for driving many EC2 build lifecycles from one thread.
+#
+# A lifecycle is written as a generator that yields the operations below and
+# is sent their results, in the style of Tornado's gen module:
+#
+#     def task(helper):
+#         reservation = yield Call(helper.conn.run_instances, ami)
+#         instance = reservation.instances[0]
+#         yield Wait(helper.waiter, instance, 'running')
+#         raise Return(instance.id)
+#
+# API calls run on a small thread pool, waits are refreshed in batches
+# through the helpers' describe pollers and child processes are polled, so
+# hundreds of lifecycles need only a handful of threads. Yielding another
+# such generator runs it as a sub-task and hands back its result; yielding
+# All runs several of them side by side.
+
+import logging
+import os
+import random
+import signal
+import subprocess
+import types
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty
+from tempfile import TemporaryFile
+from time import time
+
+class Return(Exception):
+    """
+    Raise to finish a task with a value; Python 2 generators cannot return
+    one.
+    """
+
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+class Call(object):
+    """
+    Run func(*args, **kwargs) on the engine's thread pool. The task is sent
+    the return value, or has the exception thrown into it.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+class Sleep(object):
+    """
+    Resume the task after seconds have passed.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+class Wait(object):
+    """
+    Resume the task once state(resource) is target (a state or a tuple of
+    them), refreshing through waiter with the same backoff as Waiter.wait.
+    Failure states and running out of time throw an exception into the task.
+    """
+
+    def __init__(self, waiter, resource, target, timeout=300, failure=(),
+                 state=lambda r: r.state, detail=None, what=None):
+        if not isinstance(target, tuple):
+            target = (target,)
+        self.waiter = waiter
+        self.resource = resource
+        self.target = target
+        self.timeout = timeout
+        self.failure = failure
+        self.state = state
+        self.detail = detail
+        self.what = what or '%s to become %s' % (resource.id, '/'.join(target))
+
+class Command(object):
+    """
+    Run a child process without tying up a thread. The task is sent
+    (output, retcode); with check set a non-zero exit raises instead. pty
+    gives the command a pseudo terminal on stdin, as sudo wants. A command
+    still going after timeout seconds is killed, along with anything it
+    started, and counts as a non-zero exit.
+    """
+
+    def __init__(self, args, shell=False, pty=False, check=True,
+                 timeout=None):
+        self.args = args
+        self.shell = shell
+        self.pty = pty
+        self.check = check
+        self.timeout = timeout
+
+class All(object):
+    """
+    Run tasks concurrently and resume with the list of their results once
+    they are all done. If any failed, the first of their errors is thrown
+    into the task instead, still only once they are all done.
+    """
+
+    def __init__(self, gens):
+        self.gens = list(gens)
+
+class Task(object):
+    """
+    A running lifecycle. When done, result or error is set, and on_done (if
+    set) is called with the task.
+    """
+
+    def __init__(self, gen, name=None):
+        self.stack = [ gen ]
+        self.name = name or getattr(gen, '__name__', 'task')
+        self.done = False
+        self.result = None
+        self.error = None
+        self.on_done = None
+
+class _WaitState(object):
+
+    def __init__(self, task, op, waiter):
+        self.task = task
+        self.op = op
+        self.started = time()
+        self.next_check = self.started
+        self.interval = waiter.initial
+        self.refreshing = False
+
+class LifecycleEngine(object):
+    """
+    Drive lifecycle tasks to completion from the calling thread.
+    """
+
+    def __init__(self, threads=4, tick=0.5):
+        self.log = logging.getLogger('%s.%s' %
+            (__name__, self.__class__.__name__))
+        self.pool = ThreadPool(threads)
+        self.tick = tick
+        self.events = Queue()
+        self.sleepers = []
+        self.waits = []
+        self.processes = []
+
+    def run(self, gen):
+        """
+        Run one task and return its result, raising if it failed.
+        """
+        task = self.run_all([ gen ])[0]
+        if task.error:
+            raise task.error
+        return task.result
+
+    def run_all(self, gens):
+        """
+        Run tasks concurrently until they are all done, and return them.
+        """
+        tasks = [ Task(gen) for gen in gens ]
+        for task in tasks:
+            self._step(task)
+        while [ t for t in tasks if not t.done ]:
+            self._loop_once()
+        return tasks
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def _loop_once(self):
+        timeout = self.tick
+        if self.sleepers:
+            timeout = max(0, min(timeout, min(self.sleepers)[0] - time()))
+        try:
+            event = self.events.get(timeout=timeout)
+            while True:
+                self._handle(event)
+                event = self.events.get_nowait()
+        except Empty:
+            pass
+        now = time()
+        due = [ s for s in self.sleepers if s[0] <= now ]
+        self.sleepers = [ s for s in self.sleepers if s[0] > now ]
+        for wake, task in due:
+            self._step(task)
+        self._poll_processes()
+        self._refresh_waits(now)
+
+    def _handle(self, event):
+        task, value, error = event
+        if task is None:
+            # Work handed back to the engine thread
+            value()
+        else:
+            self._step(task, value, error)
+
+    def _step(self, task, value=None, error=None):
+        """
+        Resume task with value (or error) until it yields something we have
+        to wait for, or finishes.
+        """
+        while True:
+            gen = task.stack[-1]
+            try:
+                if error:
+                    op = gen.throw(error)
+                else:
+                    op = gen.send(value)
+            except (StopIteration, Return), e:
+                value = getattr(e, 'value', None)
+                error = None
+            except Exception, e:
+                value = None
+                error = e
+            else:
+                if isinstance(op, types.GeneratorType):
+                    task.stack.append(op)
+                    value = error = None
+                    continue
+                self._start(task, op)
+                return
+            task.stack.pop()
+            if not task.stack:
+                task.done = True
+                task.result = value
+                task.error = error
+                if task.on_done:
+                    task.on_done(task)
+                return
+
+    def _start(self, task, op):
+        if isinstance(op, Call):
+            def _call():
+                try:
+                    self.events.put((task, op.func(*op.args, **op.kwargs),
+                        None))
+                except Exception, e:
+                    self.events.put((task, None, e))
+            self.pool.apply_async(_call)
+        elif isinstance(op, Sleep):
+            self.sleepers.append((time() + op.seconds, task))
+        elif isinstance(op, Wait):
+            self.waits.append(_WaitState(task, op, op.waiter))
+        elif isinstance(op, Command):
+            self._spawn(task, op)
+        elif isinstance(op, All):
+            self._join(task, op)
+        else:
+            self.events.put((task, None,
+                Exception("Cannot wait on %r" % (op,))))
+
+    def _join(self, task, op):
+        children = [ Task(gen) for gen in op.gens ]
+        left = [ len(children) ]
+
+        def _done(child):
+            left[0] -= 1
+            if left[0]:
+                return
+            errors = [ c.error for c in children if c.error ]
+            if errors:
+                self._step(task, None, errors[0])
+            else:
+                self._step(task, [ c.result for c in children ])
+
+        if not children:
+            self.events.put((task, [], None))
+            return
+        for child in children:
+            child.on_done = _done
+        for child in children:
+            self._step(child)
+
+    def _spawn(self, task, op):
+        output = TemporaryFile()
+        stdin = master = None
+        try:
+            if op.pty:
+                master, stdin = os.openpty()
+            else:
+                stdin = open(os.devnull)
+            # A group of its own, so a timeout can kill all of it
+            process = subprocess.Popen(op.args, shell=op.shell, stdin=stdin,
+                stdout=output, stderr=subprocess.STDOUT,
+                preexec_fn=op.timeout and os.setsid or None)
+        except Exception, e:
+            output.close()
+            self.events.put((task, None, e))
+            process = None
+        if op.pty:
+            os.close(stdin)
+        elif stdin:
+            stdin.close()
+        if process:
+            deadline = None
+            if op.timeout:
+                deadline = time() + op.timeout
+            self.processes.append((process, output, master, task, op,
+                deadline))
+        elif master:
+            os.close(master)
+
+    def _poll_processes(self):
+        running = []
+        for entry in self.processes:
+            process, output, master, task, op, deadline = entry
+            retcode = process.poll()
+            timed_out = False
+            if retcode is None:
+                if deadline is None or time() < deadline:
+                    running.append(entry)
+                    continue
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                retcode = process.wait()
+                timed_out = True
+            if master:
+                os.close(master)
+            output.seek(0)
+            stdout = output.read()
+            output.close()
+            cmd = op.args if op.shell else ' '.join(op.args)
+            if op.check and timed_out:
+                self._step(task, None, Exception("'%s' timed out after %d "
+                    "seconds: %s" % (cmd, op.timeout, stdout)))
+            elif op.check and retcode:
+                self._step(task, None, Exception("'%s' failed(%d): %s" %
+                    (cmd, retcode, stdout)))
+            else:
+                self._step(task, (stdout, retcode))
+        self.processes = running
+
+    def _refresh_waits(self, now):
+        """
+        Refresh every wait whose backoff has run out. Waiters sharing a
+        DescribePoller are batched together, so each helper having a waiter
+        of its own costs nothing extra.
+        """
+        batches = {}
+        for state in self.waits:
+            if not state.refreshing and state.next_check <= now:
+                state.refreshing = True
+                waiter = state.op.waiter
+                batches.setdefault(getattr(waiter, 'poller', waiter),
+                    []).append(state)
+        for refresher, states in batches.items():
+            self.pool.apply_async(self._refresh, (refresher, states))
+
+    def _refresh(self, refresher, states):
+        # Runs on the pool; the results are checked back on the engine thread
+        try:
+            refresher.refresh_many([ s.op.resource for s in states ])
+        except Exception, e:
+            self.log.warning("Refresh failed: %s" % e)
+        self.events.put((None, lambda: self._check_waits(states), None))
+
+    def _check_waits(self, states):
+        now = time()
+        for state in states:
+            state.refreshing = False
+            op = state.op
+            waiter = op.waiter
+            error = None
+            try:
+                current = op.state(op.resource)
+            except Exception, e:
+                current = None
+                error = e
+            if current in op.failure:
+                error = Exception(
+                    "%s entered state (%s) while waiting for %s" %
+                    (op.resource.id, current, '/'.join(op.target)))
+            elif current in op.target:
+                self.waits.remove(state)
+                self._step(state.task, current)
+                continue
+            elif now - state.started > op.timeout:
+                error = Exception("Timed out after %d seconds waiting for %s" %
+                    (op.timeout, op.what))
+            if error:
+                self.waits.remove(state)
+                self._step(state.task, None, error)
+                continue
+            extra = ''
+            if op.detail:
+                extra = ' - %s' % op.detail(op.resource)
+            self.log.debug("Waiting for %s: state (%s)%s [%d of %d seconds]" %
+                (op.what, current, extra, now - state.started, op.timeout))
+            delay = min(state.interval, waiter.max_interval)
+            delay *= random.uniform(1 - waiter.jitter, 1 + waiter.jitter)
+            state.next_check = now + delay
+            state.interval *= waiter.factor
+
+def run(gen, threads=2):
+    """
+    Run a single lifecycle task to completion on a private engine. This is
+    what the blocking helper methods use.
+    """
+    engine = LifecycleEngine(threads)
+    try:
+        return engine.run(gen)
+    finally:
+        engine.close()
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Block hash manifests of uploaded images, kept locally by snapshot id, so a
+# rebuilt image can be uploaded as the blocks that changed since one of its
+# earlier snapshots. A manifest records the hash of every block of the image
+# that is not all zeros; blocks it leaves out are zero.
+
+import hashlib
+import json
+import os
+from tempfile import mkstemp
+from time import time
+
+import upload_utils
+
+MANIFEST_DIR = os.path.expanduser('~/.cache/anaconda-ec2/manifests')
+
+# Granularity of the comparison. Small enough that a changed initrd does not
+# drag much of its neighbourhood along.
+MANIFEST_BLOCK = 64 * 1024
+
+def build_manifest(filename, block_size=MANIFEST_BLOCK):
+    """
+    Return the manifest of the image in filename.
+    """
+    zero = '\0' * block_size
+    blocks = {}
+    src = open(filename, 'rb')
+    try:
+        for offset, length in upload_utils.data_extents(filename, block_size):
+            src.seek(offset)
+            for index in range(offset // block_size,
+                               (offset + length) // block_size):
+                buf = src.read(block_size)
+                if buf and buf != zero[:len(buf)]:
+                    blocks[str(index)] = hashlib.sha1(buf).hexdigest()
+    finally:
+        src.close()
+    return { 'size': os.path.getsize(filename), 'block_size': block_size,
+             'blocks': blocks }
+
+def changed_extents(parent, manifest):
+    """
+    Return the (offset, length) extents of the image described by manifest
+    that differ from the one described by parent, including blocks that
+    have become zero. The two must be of images of the same size.
+    """
+    if parent['size'] != manifest['size'] or \
+       parent['block_size'] != manifest['block_size']:
+        raise Exception('Manifests of different images cannot be compared')
+    block_size = manifest['block_size']
+    old = parent['blocks']
+    new = manifest['blocks']
+    changed = sorted([ int(i) for i in set(old) | set(new)
+                       if old.get(i) != new.get(i) ])
+    extents = []
+    for index in changed:
+        offset = index * block_size
+        if extents and extents[-1][0] + extents[-1][1] == offset:
+            extents[-1] = (extents[-1][0], extents[-1][1] + block_size)
+        else:
+            extents.append((offset, block_size))
+    return extents
+
+def _path(region, snapshot_id, directory):
+    return os.path.join(directory, region, '%s.json' % snapshot_id)
+
+def save_manifest(region, snapshot_id, manifest, directory=MANIFEST_DIR):
+    """
+    Store manifest as that of snapshot_id.
+    """
+    filename = _path(region, snapshot_id, directory)
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    record = dict(manifest, snapshot=snapshot_id, region=region,
+                  created=time())
+    # Write and rename so an interrupted run never leaves half a manifest
+    fd, tmp = mkstemp(dir=os.path.dirname(filename), prefix='.tmp-')
+    try:
+        try:
+            os.write(fd, json.dumps(record))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp, filename)
+    except:
+        os.unlink(tmp)
+        raise
+
+def load_manifest(region, snapshot_id, directory=MANIFEST_DIR):
+    """
+    Return the manifest stored for snapshot_id, or None.
+    """
+    try:
+        return json.load(open(_path(region, snapshot_id, directory)))
+    except (IOError, ValueError):
+        return None
+
+def find_manifests(region, size, directory=MANIFEST_DIR):
+    """
+    Return the ids of the snapshots in region with manifests of images of
+    size bytes, newest first.
+    """
+    found = []
+    try:
+        names = os.listdir(os.path.join(directory, region))
+    except OSError:
+        return []
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        manifest = load_manifest(region, name[:-len('.json')], directory)
+        if manifest and manifest.get('size') == size:
+            found.append((manifest.get('created', 0), manifest['snapshot']))
+    return [ snapshot_id for created, snapshot_id in sorted(found,
+             reverse=True) ]
+
+def forget_manifest(region, snapshot_id, directory=MANIFEST_DIR):
+    """
+    Drop the manifest of a snapshot that no longer exists.
+    """
+    try:
+        os.unlink(_path(region, snapshot_id, directory))
+    except OSError:
+        pass
@@ -6,9 +6,29 @@
 # We want to allow people to import all of these
 # Add logging option
 
+import errno
 import os
 import re
+import shutil
+import signal
 import subprocess
+import threading
+from collections import deque
+from tempfile import mkdtemp
+from time import time
+
+# Output kept from a streamed command for its error message
+RING_SIZE = 64 * 1024
+
+# How often subprocess_stream() checks on its command
+WATCH_INTERVAL = 0.5
+
+# Seconds without progress before a metered transfer counts as stalled
+STALL_TIMEOUT = 300
+
+# Seconds an SSHSession master with no commands running stays up, so one
+# whose session is never closed does not outlive us by much
+CONTROL_PERSIST = 300
 
 def subprocess_check_output(*popenargs, **kwargs):
     if 'stdout' in kwargs:
@@ -37,11 +57,263 @@ def subprocess_check_output_pty(*popenargs, **kwargs):
         raise Exception("'%s' failed(%d), stderr: %s" % (cmd, retcode, stderr))
     return (stdout, stderr, retcode)
 
-def ssh_execute_command(guestaddr, sshprivkey, command, timeout=10, user='root', prefix=None):
+class RingBuffer(object):
     """
-    Function to execute a command on the guest using SSH and return the output.
-    Modified version of function from ozutil to allow us to deal with non-root
-    authorized users on ec2
+    Keeps the last size bytes written to it, or a little more.
+    """
+
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self.chunks = deque()
+        self.length = 0
+        self.dropped = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.length += len(data)
+        while self.length - len(self.chunks[0]) >= self.size:
+            chunk = self.chunks.popleft()
+            self.length -= len(chunk)
+            self.dropped += len(chunk)
+
+    def getvalue(self):
+        data = ''.join(self.chunks)
+        if self.dropped:
+            return '[%d bytes dropped]...%s' % (self.dropped, data)
+        return data
+
+class ProgressMeter(object):
+    """
+    Counts the bytes passing through a stage of a transfer (see
+    CountingWriter) and logs how fast they go and, given the total, when
+    they should all be through, every interval seconds. report, if given,
+    is called with the same numbers as keyword arguments. stalled() becomes
+    true once nothing has moved for stall_timeout seconds.
+    """
+
+    def __init__(self, total=None, log=None, what='transfer', interval=10,
+                 stall_timeout=STALL_TIMEOUT, report=None):
+        self.total = total
+        self.log = log
+        self.what = what
+        self.interval = interval
+        self.stall_timeout = stall_timeout
+        self.report = report
+        self.lock = threading.Lock()
+        self.count = 0
+        self.started = time()
+        self.moved = self.started
+        self.reported = self.started
+
+    def add(self, count):
+        self.lock.acquire()
+        try:
+            self.count += count
+            if count:
+                self.moved = time()
+        finally:
+            self.lock.release()
+
+    def rate(self):
+        return self.count / max(time() - self.started, 1e-6)
+
+    def eta(self):
+        """
+        Seconds left at the average rate so far, if that can be known.
+        """
+        rate = self.rate()
+        if not self.total or not rate:
+            return None
+        return max(self.total - self.count, 0) / rate
+
+    def stalled(self):
+        return bool(self.stall_timeout and
+            time() - self.moved > self.stall_timeout)
+
+    def tick(self):
+        """
+        Report if it is time to. Safe to call from every thread involved.
+        """
+        self.lock.acquire()
+        try:
+            now = time()
+            if now - self.reported < self.interval:
+                return
+            self.reported = now
+        finally:
+            self.lock.release()
+        self.show()
+
+    def show(self):
+        rate = self.rate()
+        eta = self.eta()
+        message = '%s: %.1f MiB' % (self.what, self.count / 1024.0 ** 2)
+        if self.total:
+            message += ' of %.1f MiB' % (self.total / 1024.0 ** 2)
+        message += ' at %.1f MiB/s' % (rate / 1024.0 ** 2)
+        if eta is not None:
+            message += ', about %d:%02d to go' % (eta // 60, eta % 60)
+        if self.log:
+            self.log.debug(message)
+        if self.report:
+            self.report(bytes=self.count, total=self.total, rate=rate,
+                eta=eta)
+
+class CountingWriter(object):
+    """
+    Passes writes on to out, counting them on meter.
+    """
+
+    def __init__(self, out, meter):
+        self.out = out
+        self.meter = meter
+
+    def write(self, data):
+        self.out.write(data)
+        self.meter.add(len(data))
+
+def _kill_group(process):
+    # The command and everything it started, such as the stages of a shell
+    # pipeline
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def subprocess_stream(args, writer=None, timeout=None, meter=None,
+                      ring_size=RING_SIZE, **kwargs):
+    """
+    Run a command, reading its output as it comes into a RingBuffer so only
+    the last ring_size bytes are ever kept, and handing its stdin to
+    writer() on a thread of its own. The command and its children are
+    killed if it runs for longer than timeout seconds, if meter reports a
+    stall or if writer() raises. Returns (what writer() returned, the tail
+    of the output); raises with the tail of the output if the command
+    fails.
+    """
+    for arg in ('stdin', 'stdout', 'stderr', 'preexec_fn'):
+        if arg in kwargs:
+            raise ValueError('%s argument not allowed.' % arg)
+    stdin = subprocess.PIPE
+    if not writer:
+        stdin = open(os.devnull)
+    try:
+        # A session of its own so the whole pipeline can be killed, and no
+        # inherited pipes so parallel commands cannot hold each other open
+        process = subprocess.Popen(args, stdin=stdin,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            preexec_fn=os.setsid, close_fds=True, **kwargs)
+    finally:
+        if not writer:
+            stdin.close()
+    ring = RingBuffer(ring_size)
+    result = {}
+
+    def _read():
+        fd = process.stdout.fileno()
+        while True:
+            data = os.read(fd, 65536)
+            if not data:
+                return
+            ring.write(data)
+
+    def _write():
+        try:
+            result['value'] = writer(process.stdin)
+        except IOError, e:
+            # The command went away early; report its output below
+            if e.errno != errno.EPIPE:
+                result['error'] = e
+            result['broken'] = True
+        except Exception, e:
+            result['error'] = e
+        finally:
+            try:
+                process.stdin.close()
+            except IOError:
+                pass
+
+    reader = threading.Thread(target=_read, name='stream-reader')
+    reader.daemon = True
+    reader.start()
+    feeder = None
+    if writer:
+        feeder = threading.Thread(target=_write, name='stream-writer')
+        feeder.daemon = True
+        feeder.start()
+
+    deadline = timeout and time() + timeout
+    killed = None
+    while process.poll() is None:
+        reader.join(WATCH_INTERVAL)
+        if meter:
+            meter.tick()
+        if 'error' in result:
+            killed = 'was killed after its input failed'
+        elif deadline and time() > deadline:
+            killed = 'timed out after %d seconds' % timeout
+        elif meter and meter.stalled():
+            killed = 'stalled, nothing moved for %d seconds' % \
+                meter.stall_timeout
+        if killed:
+            _kill_group(process)
+            process.wait()
+            break
+    retcode = process.wait()
+    if feeder:
+        feeder.join()
+    # Anything the command left running in the background may still hold
+    # its output open, so do not wait for that forever
+    reader.join(WATCH_INTERVAL)
+    process.stdout.close()
+
+    cmd = ' '.join(args) if not isinstance(args, basestring) else args
+    if 'error' in result:
+        raise result['error']
+    if killed:
+        raise Exception("'%s' %s: %s" % (cmd, killed, ring.getvalue()))
+    if retcode:
+        raise Exception("'%s' failed(%d): %s" % (cmd, retcode,
+            ring.getvalue()))
+    if result.get('broken'):
+        raise Exception("'%s' exited before reading all input" % cmd)
+    return result.get('value'), ring.getvalue()
+
+def subprocess_feed(writer, *popenargs, **kwargs):
+    """
+    Run a command and hand its stdin to writer() as a file object, see
+    subprocess_stream(). Returns whatever writer() returned.
+    """
+    if 'stdin' in kwargs or 'stdout' in kwargs:
+        raise ValueError('stdin and stdout arguments are not allowed.')
+    return subprocess_stream(writer=writer, *popenargs, **kwargs)[0]
+
+def _control_options(control_path):
+    # Use an existing master connection if there is one, but never become
+    # one; SSHSession starts the master itself
+    if not control_path:
+        return []
+    return ["-o", "ControlMaster=no", "-o", "ControlPath=" + control_path]
+
+def ssh_command(guestaddr, sshprivkey, timeout=30, user='root',
+                control_path=None, options=()):
+    """
+    Return the argument list for a non-interactive ssh to guestaddr, suitable
+    for the end of a pipeline. See ssh_execute_command for the options.
+    """
+    return (["ssh", "-i", sshprivkey,
+             "-F", "/dev/null",
+             "-o", "ServerAliveInterval=30",
+             "-o", "StrictHostKeyChecking=no",
+             "-o", "ConnectTimeout=" + str(timeout),
+             "-o", "UserKnownHostsFile=/dev/null",
+             "-o", "PasswordAuthentication=no"] +
+            _control_options(control_path) + list(options) +
+            ["%s@%s" % (user, guestaddr)])
+
+def ssh_execute_args(guestaddr, sshprivkey, command, timeout=10, user='root', prefix=None, control_path=None):
+    """
+    Return the argument list ssh_execute_command runs.
     """
     # ServerAliveInterval protects against NAT firewall timeouts
     # on long-running commands with no output
@@ -61,10 +333,123 @@ def ssh_execute_command(guestaddr, sshprivkey, command, timeout=10, user='root',
             "-o", "UserKnownHostsFile=/dev/null",
             "-t", "-t",
             "-o", "PasswordAuthentication=no"]
+    cmd.extend(_control_options(control_path))
     if prefix:
         command = prefix + " " + command
     cmd.extend(["%s@%s" % (user, guestaddr), command])
+    return cmd
+
+def ssh_execute_command(guestaddr, sshprivkey, command, timeout=10, user='root', prefix=None, control_path=None):
+    """
+    Function to execute a command on the guest using SSH and return the output.
+    Modified version of function from ozutil to allow us to deal with non-root
+    authorized users on ec2
+    """
+    cmd = ssh_execute_args(guestaddr, sshprivkey, command, timeout, user,
+        prefix, control_path)
     if(prefix == 'sudo'):
         return subprocess_check_output_pty(cmd)
     else:
         return subprocess_check_output(cmd)
+
+class SSHSession(object):
+    """
+    A ControlMaster connection to one host as one user with one key. Commands
+    run through the session share the master's connection, so only the first
+    pays for the TCP and ssh handshakes. Call close() to shut it down.
+    """
+
+    def __init__(self, guestaddr, sshprivkey, user='root', timeout=30):
+        self.guestaddr = guestaddr
+        self.sshprivkey = sshprivkey
+        self.user = user
+        self.timeout = timeout
+        # Keep this short, socket paths are limited to around 100 bytes
+        self.control_dir = mkdtemp(prefix='ssh-')
+        self.control_path = os.path.join(self.control_dir, 'master')
+
+    def control_args(self, operation):
+        """
+        Return the argument list that sends operation (check or exit) to
+        the master.
+        """
+        return ["ssh", "-F", "/dev/null", "-o", "ControlPath=" +
+            self.control_path, "-O", operation,
+            "%s@%s" % (self.user, self.guestaddr)]
+
+    def _control(self, operation):
+        devnull = open(os.devnull, 'r+')
+        try:
+            return subprocess.call(self.control_args(operation),
+                stdin=devnull, stdout=devnull, stderr=devnull)
+        finally:
+            devnull.close()
+
+    def connected(self):
+        return (os.path.exists(self.control_path) and
+            self._control("check") == 0)
+
+    def connect(self):
+        """
+        Start the master connection if it is not already up. Raises if the
+        host cannot be reached.
+        """
+        if self.connected():
+            return
+        # The master's output must not go to a pipe we read, or we would wait
+        # on it forever
+        cmd = self.master_args()
+        devnull = open(os.devnull, 'r+')
+        try:
+            retcode = subprocess.call(cmd, stdin=devnull, stdout=devnull,
+                stderr=devnull)
+        finally:
+            devnull.close()
+        if retcode:
+            raise Exception("Unable to open an ssh connection to %s@%s" %
+                (self.user, self.guestaddr))
+
+    def master_args(self):
+        """
+        Return the argument list that starts the master connection. -f puts
+        it in the background once it is authenticated, and it exits after
+        CONTROL_PERSIST seconds without a command.
+        """
+        return ssh_command(self.guestaddr, self.sshprivkey, self.timeout,
+            self.user, options=["-M", "-N", "-f",
+                "-o", "ControlPath=" + self.control_path,
+                "-o", "ControlPersist=%d" % CONTROL_PERSIST])
+
+    def execute_args(self, command, timeout=10, prefix=None):
+        """
+        Return the argument list execute() runs, for callers that run it
+        themselves. The master must already be up.
+        """
+        return ssh_execute_args(self.guestaddr, self.sshprivkey, command,
+            timeout, self.user, prefix, self.control_path)
+
+    def execute(self, command, timeout=10, prefix=None):
+        """
+        Like ssh_execute_command, over the session.
+        """
+        self.connect()
+        return ssh_execute_command(self.guestaddr, self.sshprivkey, command,
+            timeout, self.user, prefix, self.control_path)
+
+    def command(self, multiplex=True):
+        """
+        Return an ssh argument list for a pipeline, as ssh_command. Pass
+        multiplex=False for a connection of its own, such as one of several
+        parallel transfers that should not share a cipher stream.
+        """
+        if not multiplex:
+            return ssh_command(self.guestaddr, self.sshprivkey, self.timeout,
+                self.user)
+        self.connect()
+        return ssh_command(self.guestaddr, self.sshprivkey, self.timeout,
+            self.user, self.control_path)
+
+    def close(self):
+        if self.connected():
+            self._control("exit")
+        shutil.rmtree(self.control_dir, ignore_errors=True)
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# How long an install spends in each of Anaconda's phases, worked out from
+# the console markers of console_utils or, better, from the installer's own
+# logs, and kept locally per test so runs against different trees can be
+# compared. Console lines are only timed by when a poll saw them, and EC2
+# refreshes the console in bursts, so log lines (which carry their own
+# timestamps) are used instead whenever there are any.
+
+import json
+import os
+import pipes
+import re
+from time import time
+
+import console_utils
+
+PROFILE_DIR = os.path.expanduser('~/.cache/anaconda-ec2/profiles')
+
+# The install phases, in the order Anaconda goes through them
+PHASES = [ 'setup', 'storage', 'download', 'packages', 'configure',
+           'bootloader', 'post' ]
+
+# anaconda.log, packaging.log and friends start each line with the time
+LOG_STAMP = re.compile(r'^(\d\d):(\d\d):(\d\d)(?:[,.](\d+))?\s+')
+
+def log_events(text):
+    """
+    Return the events in the lines of an anaconda.log style log (or
+    several of them run together), timed by their own timestamps and in
+    time order.
+    """
+    events = []
+    last = None
+    offset = 0
+    for line in text.splitlines():
+        match = LOG_STAMP.match(line)
+        if not match:
+            continue
+        hours, minutes, seconds, fraction = match.groups()
+        stamp = int(hours) * 3600 + int(minutes) * 60 + int(seconds) + \
+            float('0.' + (fraction or '0')) + offset
+        # The log only has the time of day; a big jump back is midnight
+        if last is not None and stamp < last - 12 * 3600:
+            offset += 24 * 3600
+            stamp += 24 * 3600
+        last = stamp
+        event = console_utils.parse_line(line[match.end():], stamp)
+        if event:
+            events.append(event)
+    # Sorting is stable, so events stamped alike keep their order
+    events.sort(key=lambda e: e.seen)
+    return events
+
+def segment(events, end=None):
+    """
+    Split the install that events describe into [(phase, start, duration)],
+    start being seconds since the first event. Each phase runs until the
+    next one starts, and the last until the install completes, fails or
+    powers off, or else until end (on the clock of the events). Without any
+    of those its duration is None.
+    """
+    segments = []
+    finish = None
+    for event in events:
+        if event.kind == console_utils.WARNING:
+            continue
+        if event.kind != console_utils.PROGRESS or event.name == 'complete':
+            finish = event.seen
+            break
+        if segments and segments[-1][0] == event.name:
+            continue
+        segments.append([ event.name, event.seen, None ])
+    if not segments:
+        return []
+    if finish is None:
+        finish = end
+    for current, following in zip(segments, segments[1:] + [ None ]):
+        stop = finish
+        if following:
+            stop = following[1]
+        if stop is not None:
+            current[2] = max(stop - current[1], 0)
+    first = segments[0][1]
+    return [ (phase, start - first, duration)
+             for phase, start, duration in segments ]
+
+class InstallProfiler(object):
+    """
+    Collect the console events of an install and, with log_command, its
+    logs. log_command is a shell command that prints the logs, with
+    %(host)s for the address of the instance, for instance an ssh to the
+    installer (see sshpw in the kickstart docs) that cats /tmp/anaconda.log
+    and /tmp/packaging.log.
+    """
+
+    def __init__(self, log_command=None):
+        self.log_command = log_command
+        self.console = []
+        self.log = ''
+        self.fetched = 0
+
+    def add_console(self, events):
+        self.console.extend(events)
+
+    def add_log(self, text):
+        """
+        Take in the latest copy of the logs, which replaces any earlier one.
+        """
+        if text:
+            self.log = text
+        self.fetched = time()
+
+    def log_args(self, host):
+        # Not % formatting, the command may well have a % of its own
+        return self.log_command.replace('%(host)s', pipes.quote(host))
+
+    def profile(self, end=None):
+        """
+        Return the profile of the install so far as a dict: the phases in
+        order with their start and duration, the total time in each phase,
+        where the timings came from and the number of packages installed,
+        if known. end is when the install was last seen still going.
+        """
+        source = 'log'
+        events = log_events(self.log)
+        segments = segment(events)
+        if not segments:
+            source = 'console'
+            events = self.console
+            segments = segment(events, end)
+        durations = {}
+        for phase, start, duration in segments:
+            if duration is not None:
+                durations[phase] = durations.get(phase, 0) + duration
+        packages = [ e.total for e in events if e.total ]
+        failures = [ e.line for e in events
+                     if e.kind == console_utils.FAILURE ]
+        return { 'source': source,
+                 'phases': [ { 'phase': phase, 'start': start,
+                               'duration': duration }
+                             for phase, start, duration in segments ],
+                 'durations': durations,
+                 'total': sum(durations.values()),
+                 'packages': packages and packages[-1] or None,
+                 'failure': failures and failures[0] or None }
+
+def _path(test, directory):
+    return os.path.join(directory, '%s.jsonl' % test.replace(os.sep, '_'))
+
+def save_profile(test, profile, directory=PROFILE_DIR, **attrs):
+    """
+    Add profile to the record of test's installs, along with attrs such as
+    the tree it installed from.
+    """
+    filename = _path(test, directory)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    record = dict(profile, test=test, created=time(), **attrs)
+    # One line per install; a single append is never interleaved with
+    # another process's
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, json.dumps(record) + '\n')
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def load_profiles(test, directory=PROFILE_DIR):
+    """
+    Return the profiles saved for test, oldest first.
+    """
+    profiles = []
+    try:
+        lines = open(_path(test, directory)).readlines()
+    except IOError:
+        return []
+    for line in lines:
+        try:
+            profiles.append(json.loads(line))
+        except ValueError:
+            # Cut short by a crash
+            continue
+    return profiles
+
+def profiled_tests(directory=PROFILE_DIR):
+    """
+    Return the names of the tests with saved profiles.
+    """
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return sorted([ name[:-len('.jsonl')] for name in names
+                    if name.endswith('.jsonl') ])
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Run many test installs without starting more of them than the account can
+# hold at once.
+
+import heapq
+import itertools
+import logging
+import threading
+
+class Job(object):
+    """
+    A unit of work for the TestScheduler. Once run, exactly one of result
+    and error is set.
+    """
+
+    def __init__(self, name, func, args=(), priority=0, region=None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.region = region
+        self.result = None
+        self.error = None
+
+class TestScheduler(object):
+    """
+    Run jobs on a bounded pool of worker threads, highest priority first.
+    region_caps limits how many jobs for each region run at once (see
+    aws_utils.EC2Helper.instance_capacity); a job whose region is full waits
+    while jobs for other regions go ahead of it.
+    """
+
+    def __init__(self, workers=4, region_caps=None):
+        self.log = logging.getLogger('%s.%s' %
+            (__name__, self.__class__.__name__))
+        self.workers = workers
+        self.region_caps = region_caps or {}
+        self.cond = threading.Condition()
+        self.queue = []
+        self.counter = itertools.count()
+        self.running = {}
+        self.jobs = []
+
+    def submit(self, name, func, args=(), priority=0, region=None):
+        """
+        Queue func(*args) to run as name. Higher priorities run first.
+        """
+        job = Job(name, func, args, priority, region)
+        self.cond.acquire()
+        try:
+            # The counter keeps equal priorities in submission order
+            heapq.heappush(self.queue, (-priority, next(self.counter), job))
+            self.jobs.append(job)
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+        return job
+
+    def _has_room(self, region):
+        cap = self.region_caps.get(region)
+        return cap is None or self.running.get(region, 0) < cap
+
+    def _next(self):
+        """
+        Take the best job we are allowed to start, or None once the queue is
+        empty. Waits while everything left is over its region's cap.
+        """
+        self.cond.acquire()
+        try:
+            while self.queue:
+                for entry in sorted(self.queue):
+                    job = entry[2]
+                    if self._has_room(job.region):
+                        self.queue.remove(entry)
+                        heapq.heapify(self.queue)
+                        self.running[job.region] = \
+                            self.running.get(job.region, 0) + 1
+                        return job
+                self.cond.wait()
+            return None
+        finally:
+            self.cond.release()
+
+    def _done(self, job):
+        self.cond.acquire()
+        try:
+            self.running[job.region] -= 1
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def _worker(self):
+        while True:
+            job = self._next()
+            if not job:
+                return
+            self.log.debug("Starting %s" % job.name)
+            try:
+                job.result = job.func(*job.args)
+            except Exception, e:
+                self.log.error("%s failed: %s" % (job.name, e))
+                job.error = e
+            self._done(job)
+
+    def run(self):
+        """
+        Run everything submitted so far and return the jobs.
+        """
+        threads = [ threading.Thread(target=self._worker,
+                                     name='scheduler-%d' % i)
+                    for i in range(self.workers) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return self.jobs
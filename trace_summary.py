@@ -0,0 +1,123 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from optparse import OptionParser
+import json
+import sys
+
+def get_opts():
+    usage = """%prog [options] trace_file [trace_file ...]
+
+Summarize the per-phase timings in trace files written with
+ANACONDA_EC2_TRACE or --trace."""
+    parser = OptionParser(usage=usage)
+    parser.add_option('-p', '--percentiles', default='50,90,99',
+        help='comma separated percentiles to show (50,90,99)')
+    parser.add_option('-r', '--region', default=None,
+        help='only count spans from this EC2 region')
+    parser.add_option('-e', '--errors', default=False, action='store_true',
+        help='include spans that failed')
+    opts, args = parser.parse_args()
+    if not args:
+        parser.error('You must provide at least one trace file')
+    try:
+        opts.percentiles = [ float(p) for p in opts.percentiles.split(',') ]
+    except ValueError:
+        parser.error('Percentiles must be numbers')
+    return opts, args
+
+def percentile(values, pct):
+    """
+    Return the pct'th percentile of the sorted list values, interpolating
+    between the closest ranks.
+    """
+    if len(values) == 1:
+        return values[0]
+    rank = (len(values) - 1) * pct / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+def read_spans(filenames, region=None, errors=False):
+    """
+    Return the records in filenames grouped by span name, along with the
+    number of failed spans of each name. Lines that do not parse (say from
+    a run that was killed mid-write) and progress records are skipped.
+    """
+    spans = {}
+    failed = {}
+    for filename in filenames:
+        for line in open(filename):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if 'span' not in record:
+                continue
+            if region and record.get('region') != region:
+                continue
+            name = record['span']
+            if record.get('status') != 'ok':
+                failed[name] = failed.get(name, 0) + 1
+                if not errors:
+                    continue
+            spans.setdefault(name, []).append(record)
+    return spans, failed
+
+def summarize(spans, failed, percentiles):
+    header = [ 'span', 'count', 'failed' ] + \
+        [ 'p%g' % p for p in percentiles ] + \
+        [ 'max', 'total', 'api/run', 'MiB/s' ]
+    rows = []
+    # Most expensive phases first
+    for name, records in sorted(spans.items(),
+            key=lambda item: -sum([ r['duration'] for r in item[1] ])):
+        durations = sorted([ r['duration'] for r in records ])
+        row = [ name, str(len(records)), str(failed.get(name, 0)) ]
+        row += [ '%.1f' % percentile(durations, p) for p in percentiles ]
+        row += [ '%.1f' % durations[-1], '%.1f' % sum(durations) ]
+        calls = [ r['api_calls'] for r in records if 'api_calls' in r ]
+        if calls:
+            row.append('%.1f' % (float(sum(calls)) / len(calls)))
+        else:
+            row.append('-')
+        sized = [ r for r in records if r.get('bytes') ]
+        if sized:
+            moved = sum([ r['bytes'] for r in sized ])
+            took = sum([ r['duration'] for r in sized ])
+            row.append('%.1f' % (moved / (1024.0 ** 2) / max(took, 0.001)))
+        else:
+            row.append('-')
+        rows.append(row)
+    # Failures of spans that never succeeded are worth a line too
+    for name in sorted(failed):
+        if name not in spans:
+            rows.append([ name, '0', str(failed[name]) ] +
+                [ '-' ] * (len(header) - 3))
+
+    widths = [ max([ len(r[i]) for r in [ header ] + rows ])
+               for i in range(len(header)) ]
+    for row in [ header ] + rows:
+        print '  '.join([ row[0].ljust(widths[0]) ] +
+            [ cell.rjust(width) for cell, width in zip(row[1:], widths[1:]) ])
+
+if __name__ == '__main__':
+    opts, filenames = get_opts()
+    spans, failed = read_spans(filenames, opts.region, opts.errors)
+    if not spans and not failed:
+        print >> sys.stderr, 'No spans found'
+        sys.exit(1)
+    print 'Durations are in seconds'
+    summarize(spans, failed, opts.percentiles)
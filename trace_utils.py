@@ -0,0 +1,148 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Timing of the phases of a build as a JSON-lines trace, one record per
+# finished span. trace_summary.py turns a pile of these into percentiles.
+#
+# Tracing is off unless enable() is called or ANACONDA_EC2_TRACE names a
+# file to append to; spans still work (and cost next to nothing) when off.
+
+import json
+import os
+import random
+import socket
+import threading
+from time import time
+
+TRACE_ENV = 'ANACONDA_EC2_TRACE'
+
+_lock = threading.Lock()
+_trace_file = None
+
+def enable(filename):
+    """
+    Append every finished span to filename from now on.
+    """
+    global _trace_file
+    _lock.acquire()
+    try:
+        if _trace_file:
+            _trace_file.close()
+        _trace_file = open(filename, 'a')
+    finally:
+        _lock.release()
+
+def enabled():
+    return _trace_file is not None
+
+def emit(record):
+    """
+    Write one record to the trace, if there is one. Records from different
+    threads never interleave.
+    """
+    if not _trace_file:
+        return
+    line = json.dumps(record, sort_keys=True) + '\n'
+    _lock.acquire()
+    try:
+        _trace_file.write(line)
+        _trace_file.flush()
+    finally:
+        _lock.release()
+
+def new_run_id():
+    """
+    Return an ID that ties together the spans of one helper's work.
+    """
+    return '%s-%d-%08x' % (socket.gethostname(), os.getpid(),
+        random.randrange(2**32))
+
+class CallCounter(object):
+    """
+    Count the API requests made over one boto connection. Everything boto
+    sends goes through make_request, whichever thread it comes from.
+    """
+
+    def __init__(self, conn):
+        self.count = 0
+        self.lock = threading.Lock()
+        make_request = conn.make_request
+
+        def _counted(*args, **kwargs):
+            self.lock.acquire()
+            try:
+                self.count += 1
+            finally:
+                self.lock.release()
+            return make_request(*args, **kwargs)
+
+        conn.make_request = _counted
+
+class Span(object):
+    """
+    Time a phase of work in a with block. The record written on exit has the
+    name, start and duration, whether the block raised, the number of API
+    calls counted by counter while it ran and any attributes given here or
+    added with set(), such as bytes transferred.
+
+    Spans keep no per-thread state, so they can be held open across the
+    yields of a lifecycle task.
+    """
+
+    def __init__(self, name, run=None, counter=None, **attrs):
+        self.name = name
+        self.run = run
+        self.counter = counter
+        self.attrs = attrs
+        self.start = None
+        self.calls = 0
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def progress(self, **attrs):
+        """
+        Write a progress record for the span while it is still open, such as
+        bytes moved so far. These have a progress key instead of a span one.
+        """
+        record = dict(self.attrs)
+        record.update(attrs)
+        record.update({ 'progress': self.name, 'run': self.run,
+                        'time': time() })
+        emit(record)
+
+    def __enter__(self):
+        self.start = time()
+        if self.counter:
+            self.calls = self.counter.count
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        end = time()
+        record = dict(self.attrs)
+        record.update({ 'span': self.name, 'run': self.run,
+                        'start': self.start, 'duration': end - self.start,
+                        'status': 'ok' })
+        if self.counter:
+            record['api_calls'] = self.counter.count - self.calls
+        if exc_type:
+            record['status'] = 'error'
+            record['error'] = str(exc_value)
+        emit(record)
+        # Never swallow the exception
+        return False
+
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV])
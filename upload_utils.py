@@ -0,0 +1,266 @@
+#!/usr/bin/python
+#   Copyright (C) 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Helpers for pushing a local disk image onto a block device on a remote
+# host. Nothing in here knows about EC2; aws_utils glues it to ssh.
+
+import errno
+import os
+import threading
+from Queue import Queue, Empty
+
+import process_utils
+
+# Granularity of everything we send, and the dd block size on the far end
+BLOCK_SIZE = 4096
+
+# Not exposed by the os module until Python 3.3; these are the Linux values
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+# Unit of work handed to each upload stream in a parallel upload
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# Reads a stream made by write_extent_stream() and writes each extent at its
+# offset on the device. The last test fails the pipeline if the stream was
+# cut short before the "0 0" terminator arrived.
+SPARSE_WRITER = ('{ while read seek count; do '
+                 '[ "$count" = 0 ] && break; '
+                 'dd of=%(device)s bs=%(bs)d seek=$seek count=$count '
+                 'iflag=fullblock conv=notrunc 2>/dev/null || exit 1; '
+                 'done; [ "$count" = 0 ]; }')
+
+def _align(extents, blocksize):
+    """
+    Round extents out to blocksize boundaries.
+    """
+    aligned = []
+    for offset, length in extents:
+        start = offset - (offset % blocksize)
+        end = offset + length
+        if end % blocksize:
+            end += blocksize - (end % blocksize)
+        aligned.append((start, end - start))
+    return aligned
+
+def _merge(extents, gap):
+    """
+    Join extents separated by less than gap bytes. Shipping a few zero blocks
+    is cheaper than starting another dd on the far end.
+    """
+    merged = []
+    for offset, length in sorted(extents):
+        if merged and offset - (merged[-1][0] + merged[-1][1]) < gap:
+            last_offset, last_length = merged[-1]
+            end = max(last_offset + last_length, offset + length)
+            merged[-1] = (last_offset, end - last_offset)
+        else:
+            merged.append((offset, length))
+    return merged
+
+def _seek_extents(fd, size):
+    """
+    Use SEEK_DATA/SEEK_HOLE to list the allocated regions of fd. Raises
+    OSError if the filesystem does not support it.
+    """
+    extents = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError, e:
+            if e.errno == errno.ENXIO:
+                # No data past offset
+                break
+            raise
+        end = os.lseek(fd, start, SEEK_HOLE)
+        extents.append((start, end - start))
+        offset = end
+    return extents
+
+def _scan_extents(fd, extents, blocksize):
+    """
+    Read through extents and drop every block that is entirely zero.
+    """
+    zero = '\0' * blocksize
+    found = []
+    for offset, length in extents:
+        os.lseek(fd, offset, os.SEEK_SET)
+        start = None
+        pos = offset
+        end = offset + length
+        while pos < end:
+            buf = os.read(fd, min(blocksize, end - pos))
+            if not buf:
+                break
+            if buf == zero[:len(buf)]:
+                if start is not None:
+                    found.append((start, pos - start))
+                    start = None
+            elif start is None:
+                start = pos
+            pos += len(buf)
+        if start is not None:
+            found.append((start, pos - start))
+    return found
+
+def data_extents(filename, blocksize=BLOCK_SIZE, merge_gap=64*1024,
+                 sparse=True):
+    """
+    Return a sorted list of (offset, length) tuples covering everything in
+    filename that is not a hole, aligned to blocksize. When the filesystem
+    cannot report holes we fall back to looking for zero blocks. With
+    sparse=False the whole file is returned as a single extent.
+    """
+    size = os.path.getsize(filename)
+    if not sparse:
+        return _align([ (0, size) ], blocksize)
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        try:
+            extents = _seek_extents(fd, size)
+        except OSError, e:
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            extents = [(0, size)]
+        # Filesystems without hole reporting claim the whole file is data
+        if extents == [(0, size)]:
+            extents = _scan_extents(fd, extents, blocksize)
+    finally:
+        os.close(fd)
+    return _merge(_align(extents, blocksize), merge_gap)
+
+def write_extent_stream(filename, extents, out, blocksize=BLOCK_SIZE,
+                        bufsize=1024*1024):
+    """
+    Write the given extents of filename to the file object out in the format
+    SPARSE_WRITER expects: a "<seek> <count>" line in blocks, then the data,
+    and a final "0 0" line. Extents must be block aligned; anything past the
+    end of the file is padded with zeros. Returns the number of data bytes
+    written.
+    """
+    total = 0
+    src = open(filename, 'rb')
+    try:
+        for offset, length in extents:
+            blocks = (length + blocksize - 1) // blocksize
+            out.write('%d %d\n' % (offset // blocksize, blocks))
+            src.seek(offset)
+            remaining = blocks * blocksize
+            while remaining:
+                buf = src.read(min(bufsize, remaining))
+                if not buf:
+                    buf = '\0' * min(bufsize, remaining)
+                out.write(buf)
+                remaining -= len(buf)
+            total += blocks * blocksize
+        out.write('0 0\n')
+    finally:
+        src.close()
+    return total
+
+def write_file(filename, out, bufsize=1024*1024):
+    """
+    Copy all of filename to the file object out and return its size.
+    """
+    total = 0
+    src = open(filename, 'rb')
+    try:
+        while True:
+            buf = src.read(bufsize)
+            if not buf:
+                return total
+            out.write(buf)
+            total += len(buf)
+    finally:
+        src.close()
+
+def split_extents(extents, chunk_size=CHUNK_SIZE):
+    """
+    Break extents up so none is longer than chunk_size.
+    """
+    chunks = []
+    for offset, length in extents:
+        while length > chunk_size:
+            chunks.append((offset, chunk_size))
+            offset += chunk_size
+            length -= chunk_size
+        if length:
+            chunks.append((offset, length))
+    return chunks
+
+def _write_wrapped(filename, extents, out, wrap, meter):
+    """
+    write_extent_stream() to whatever wrap(out) returns, if anything,
+    closing it before out is. What goes in is counted on meter.
+    """
+    wrapped = wrap and wrap(out)
+    target = wrapped or out
+    if meter:
+        target = process_utils.CountingWriter(target, meter)
+    sent = write_extent_stream(filename, extents, target)
+    if wrapped:
+        wrapped.close()
+    return sent
+
+def upload_extents(filename, extents, command, workers=1,
+                   chunk_size=CHUNK_SIZE, wrap=None, meter=None):
+    """
+    Push extents of filename through workers copies of the shell pipeline
+    command, each of which must read a write_extent_stream() stream on stdin.
+    Chunks are handed out from a shared queue so a slow stream does not hold
+    the others up. If given, wrap(pipe) returns a file object to write each
+    stream through instead (see compress_utils). A process_utils
+    ProgressMeter reports on the upload, and has it killed if it stalls.
+    Returns the number of data bytes sent.
+    """
+    if workers <= 1:
+        return process_utils.subprocess_feed(
+            lambda out: _write_wrapped(filename, extents, out, wrap, meter),
+            [ command ], shell=True, meter=meter)
+
+    work = Queue()
+    for chunk in split_extents(extents, chunk_size):
+        work.put(chunk)
+    abort = threading.Event()
+    sent = []
+    errors = []
+
+    def _chunks():
+        while not abort.is_set():
+            try:
+                yield work.get_nowait()
+            except Empty:
+                return
+
+    def _worker():
+        try:
+            sent.append(process_utils.subprocess_feed(
+                lambda out: _write_wrapped(filename, _chunks(), out, wrap,
+                    meter),
+                [ command ], shell=True, meter=meter))
+        except Exception, e:
+            abort.set()
+            errors.append(e)
+
+    threads = [ threading.Thread(target=_worker, name='upload-%d' % i)
+                for i in range(workers) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return sum(sent)